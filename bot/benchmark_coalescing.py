@@ -0,0 +1,94 @@
+"""
+Replays an onboarding conversation through Messenger, and counts the Slack API calls made with and without
+coalescing. The replies to the requester arrive a few milliseconds apart, as they do when the setup confirmations
+come in together. No network access is needed: a stand-in channel counts the sends.
+
+Run from the bot directory: python benchmark_coalescing.py [window in ms] [number of onboardings]
+"""
+import sys
+import time
+
+from messenger import Messenger
+from intenthandlers import onboarding
+
+REQUESTER = 'UREQUESTER'
+REQUESTER_CHANNEL = 'DREQUESTER'
+REPLY_GAP = 0.01  # seconds between the replies to the requester
+
+
+class CountingChannel(object):
+    def __init__(self):
+        self.calls = 0
+
+    def send_message(self, msg):
+        self.calls += 1
+
+
+class CountingChannels(object):
+    def __init__(self):
+        self.channel = CountingChannel()
+
+    def find(self, channel_id):
+        return self.channel
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.channels = CountingChannels()
+
+
+class FakeRtm(object):
+    def __init__(self):
+        self.server = FakeServer()
+
+
+class FakeClients(object):
+    def __init__(self):
+        self.rtm = FakeRtm()
+
+
+def wit_entity(value):
+    return [{'confidence': 1.0, 'value': value}]
+
+
+def replay(msg_writer, onboardings):
+    for i in range(onboardings):
+        name = "New Hire {}".format(i)
+        event = {'user': REQUESTER, 'channel': REQUESTER_CHANNEL}
+        onboarding.onboarding_start(msg_writer, event, {'name': wit_entity(name), 'date': wit_entity("Monday")})
+        for reply in ("Account for {} setup, with ldap info",
+                      "Desk for {} setup",
+                      "Phones for {} setup, with 555-0100 number",
+                      "Email for {} setup",
+                      "Slack for {} setup",
+                      "Email sent to {}"):
+            msg_writer.send_message(REQUESTER_CHANNEL, reply.format(name))
+            time.sleep(REPLY_GAP)
+
+
+def run(window, onboardings):
+    clients = FakeClients()
+    msg_writer = Messenger(clients, coalesce_window=window)
+    started = time.time()
+    replay(msg_writer, onboardings)
+    msg_writer.close()
+    return clients.rtm.server.channels.channel.calls, time.time() - started
+
+
+def main(argv):
+    window = float(argv[1]) / 1000 if len(argv) > 1 else 0.2
+    onboardings = int(argv[2]) if len(argv) > 2 else 10
+    onboarding.onboarding_authed_user_ids.append(REQUESTER)
+
+    plain_calls, plain_time = run(0, onboardings)
+    coalesced_calls, coalesced_time = run(window, onboardings)
+    print("{} onboardings, {:.0f} ms coalescing window".format(onboardings, window * 1000))
+    print("{:<12} {:>10} {:>10}".format("mode", "API calls", "seconds"))
+    print("{:<12} {:>10} {:>10.2f}".format("plain", plain_calls, plain_time))
+    print("{:<12} {:>10} {:>10.2f}".format("coalesced", coalesced_calls, coalesced_time))
+    print("API calls saved: {} ({:.0%})".format(plain_calls - coalesced_calls,
+                                               1 - coalesced_calls / plain_calls))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
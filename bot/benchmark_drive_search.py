@@ -0,0 +1,125 @@
+"""
+Compares finding one file by name with a server side "name contains" search, against listing the whole drive to
+rank it locally (what the first lookup for a user does otherwise, to seed their index). A local HTTP server stands in
+for the Drive API, serving a synthetic drive; the drive service is built from the pinned discovery document and
+pointed at it. Reports bytes transferred and latency for each.
+
+Run from the bot directory: python benchmark_drive_search.py [number of files] [number of queries]
+"""
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+from apiclient import discovery
+
+from intenthandlers.drive_index import DriveIndex, search_by_name
+from intenthandlers.google_services import pinned_document
+
+WORDS = ['budget', 'report', 'quarterly', 'minutes', 'roadmap', 'design', 'hiring', 'plan', 'notes', 'draft',
+         'invoice', 'summary', 'london', 'boston', 'tampa', 'review', 'onboarding', 'checklist', 'final', 'copy',
+         'meeting', 'client', 'proposal', 'contract', 'timesheet', 'expenses', 'offsite', 'training', 'slides',
+         'architecture', 'release', 'retro', 'sprint', 'backlog', 'interview', 'feedback', 'policy', 'handbook']
+FULL_FILE = {'kind': 'drive#file', 'mimeType': 'application/vnd.google-apps.document',
+             'modifiedTime': '2016-07-01T12:00:00.000Z', 'owners': [{'displayName': 'Someone'}],
+             'webViewLink': 'https://docs.google.com/document/d/ID/edit'}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DriveStandIn(BaseHTTPRequestHandler):
+    """
+    Serves files.list and changes.getStartPageToken for the synthetic drive in server.files, honouring q (name
+    contains clauses), pageSize, pageToken and a fields projection of files(...)
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.endswith('/changes/startPageToken'):
+            self._reply({'startPageToken': '1'})
+            return
+        files = self.server.files
+        words = re.findall(r"name contains '([^']*)'", params.get('q', ''))
+        if words:
+            files = [f for f in files if all(word in f['name'].lower() for word in words)]
+        start = int(params.get('pageToken', 0))
+        size = int(params.get('pageSize', 100))
+        page = files[start:start + size]
+        fields = re.search(r'files\(([^)]*)\)', params.get('fields', ''))
+        if fields:
+            wanted = [field.strip() for field in fields.group(1).split(',')]
+            page = [{field: f[field] for field in wanted if field in f} for f in page]
+        resp = {'files': page}
+        if start + size < len(files):
+            resp['nextPageToken'] = str(start + size)
+        self._reply(resp)
+
+    def _reply(self, resp):
+        body = json.dumps(resp).encode('utf-8')
+        self.server.bytes_sent += len(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_drive(size, rng):
+    files = []
+    for i in range(size):
+        drive_file = dict(FULL_FILE, id='file{:06d}'.format(i),
+                          name='{} {}'.format(' '.join(rng.sample(WORDS, 3)).title(), rng.randint(2010, 2016)))
+        files.append(drive_file)
+    return files
+
+
+def main(argv):
+    size = int(argv[1]) if len(argv) > 1 else 20000
+    queries = int(argv[2]) if len(argv) > 2 else 10
+    rng = random.Random(2016)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DriveStandIn)
+    server.files = make_drive(size, rng)
+    server.bytes_sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    document = json.loads(pinned_document('drive', 'v3'))
+    document['rootUrl'] = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    document['baseUrl'] = document['rootUrl'] + document['servicePath']
+    service = discovery.build_from_document(document, http=httplib2.Http())
+    asked = [rng.choice(server.files)['name'].lower() for _ in range(queries)]
+
+    def measure(lookup):
+        server.bytes_sent = 0
+        started = time.perf_counter()
+        found = [lookup(query) for query in asked]
+        return (time.perf_counter() - started) / queries, server.bytes_sent / queries, found
+
+    def listed(query):
+        index = DriveIndex()
+        index.seed(service)
+        return index.find(query)
+
+    list_time, list_bytes, list_found = measure(listed)
+    search_time, search_bytes, search_found = measure(lambda query: search_by_name(service, query))
+    server.shutdown()
+
+    agreed = sum(1 for a, b in zip(list_found, search_found) if a and b and a[2] == b[2])
+    print("{} files, {} lookups".format(size, queries))
+    print("{:<14} {:>12} {:>12}".format("lookup", "ms", "KB"))
+    print("{:<14} {:>12.1f} {:>12.1f}".format("full listing", list_time * 1000, list_bytes / 1024))
+    print("{:<14} {:>12.1f} {:>12.1f}".format("name search", search_time * 1000, search_bytes / 1024))
+    print("Same best score for {}/{} lookups".format(agreed, queries))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
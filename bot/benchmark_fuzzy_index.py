@@ -0,0 +1,71 @@
+"""
+Compares finding a file by name with a FuzzyNameIndex against the process.extractOne scan followed by a second scan for
+the file id that drive.py used before, over synthetic drives of 1k, 10k and 100k files.
+
+Run from the bot directory: python benchmark_fuzzy_index.py [number of queries]
+"""
+import random
+import sys
+import time
+
+from fuzzywuzzy import process
+
+from intenthandlers.fuzzy_index import FuzzyNameIndex, MATCH_THRESHOLD
+
+WORDS = ['budget', 'report', 'quarterly', 'minutes', 'roadmap', 'design', 'hiring', 'plan', 'notes', 'draft',
+         'invoice', 'summary', 'london', 'boston', 'tampa', 'review', 'onboarding', 'checklist', 'final', 'copy',
+         'meeting', 'client', 'proposal', 'contract', 'timesheet', 'expenses', 'offsite', 'training', 'slides',
+         'architecture', 'release', 'retro', 'sprint', 'backlog', 'interview', 'feedback', 'policy', 'handbook']
+SIZES = (1000, 10000, 100000)
+EXTENSIONS = ['', '.docx', '.xlsx', '.pdf', '.pptx']
+
+
+def make_drive(size, rng):
+    return [{'id': 'file{}'.format(i),
+             'name': '{} {}{}'.format(' '.join(rng.sample(WORDS, rng.randint(2, 4))).title(),
+                                      rng.randint(2010, 2016), rng.choice(EXTENSIONS))}
+            for i in range(size)]
+
+
+def make_query(files, rng):
+    # A name from the drive, retyped the way people ask for files: lower case, a dropped letter, no extension
+    name = rng.choice(files)['name'].lower().rsplit('.', 1)[0]
+    i = rng.randrange(len(name))
+    return name[:i] + name[i + 1:]
+
+
+def scan(files, query):
+    likely_file = process.extractOne(query, [f['name'] for f in files])
+    if likely_file and likely_file[1] >= MATCH_THRESHOLD:
+        return next(f['id'] for f in files if f['name'] == likely_file[0]), likely_file[1]
+    return None, None
+
+
+def main(argv):
+    queries = int(argv[1]) if len(argv) > 1 else 20
+    rng = random.Random(2016)
+    print("{:>8} {:>10} {:>12} {:>12} {:>10} {:>12}".format("files", "build s", "scan ms", "index ms", "speedup",
+                                                             "same score"))
+    for size in SIZES:
+        files = make_drive(size, rng)
+        started = time.perf_counter()
+        index = FuzzyNameIndex()
+        for f in files:
+            index.add(f['id'], f['name'])
+        build_time = time.perf_counter() - started
+
+        asked = [make_query(files, rng) for _ in range(queries)]
+        started = time.perf_counter()
+        scanned = [scan(files, query) for query in asked]
+        scan_time = (time.perf_counter() - started) / queries
+        started = time.perf_counter()
+        found = [index.best_match(query) for query in asked]
+        index_time = (time.perf_counter() - started) / queries
+
+        same = sum(1 for (_, score), match in zip(scanned, found) if (match[2] if match else None) == score)
+        print("{:>8} {:>10.2f} {:>12.2f} {:>12.2f} {:>9.0f}x {:>9}/{}".format(
+            size, build_time, scan_time * 1000, index_time * 1000, scan_time / index_time, same, queries))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,71 @@
+"""
+Compares running nags as one StoppableThread each, as nag_users used to, against one ReminderScheduler holding them
+all. Starts the given number of nags with the real two hour interval, then reports the threads alive and the CPU time
+the process uses over an idle window, and how long scheduling and cancelling them all takes.
+
+Run from the bot directory: python benchmark_reminders.py [number of nags] [seconds to measure]
+"""
+import sys
+import threading
+import time
+
+from threads import StoppableThread, ReminderScheduler
+
+INTERVAL = 7200
+
+
+def nag(*args, **kwargs):
+    pass
+
+
+def measure_idle(seconds):
+    threads = threading.active_count()
+    cpu = time.process_time()
+    time.sleep(seconds)
+    return threads, time.process_time() - cpu
+
+
+def stoppable_threads(count, seconds):
+    started = time.perf_counter()
+    nags = [StoppableThread(nag, 'D1', "You need to do the thing", delay=INTERVAL) for _ in range(count)]
+    for thread in nags:
+        thread.start()
+    setup = time.perf_counter() - started
+    threads, cpu = measure_idle(seconds)
+    started = time.perf_counter()
+    for thread in nags:
+        thread._stopevent.set()  # Stop them all before joining, as each notices within a second
+    for thread in nags:
+        thread.join()
+    return threads, cpu, setup, time.perf_counter() - started
+
+
+def reminder_scheduler(count, seconds):
+    scheduler = ReminderScheduler(jitter=60)
+    scheduler.start()
+    started = time.perf_counter()
+    for i in range(count):
+        scheduler.schedule(i, INTERVAL, nag, 'D1', "You need to do the thing", delay=i % 60 + INTERVAL)
+    setup = time.perf_counter() - started
+    threads, cpu = measure_idle(seconds)
+    started = time.perf_counter()
+    for i in range(count):
+        scheduler.cancel(i)
+    cancel = time.perf_counter() - started
+    scheduler.join()
+    return threads, cpu, setup, cancel
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    seconds = float(argv[2]) if len(argv) > 2 else 5
+    print("{} nags, CPU measured over {:.0f}s idle".format(count, seconds))
+    print("{:<20} {:>8} {:>10} {:>12} {:>12}".format("", "threads", "CPU ms", "schedule ms", "cancel ms"))
+    for label, run in (("StoppableThread", stoppable_threads), ("ReminderScheduler", reminder_scheduler)):
+        threads, cpu, setup, cancel = run(count, seconds)
+        print("{:<20} {:>8} {:>10.1f} {:>12.1f} {:>12.1f}".format(label, threads, cpu * 1000, setup * 1000,
+                                                                  cancel * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
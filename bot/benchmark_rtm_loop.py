@@ -0,0 +1,142 @@
+"""
+Compares the time from a websocket frame arriving to the event handler being called, for the threaded (polling)
+and asyncio RTM loops in SlackBot. A socket pair stands in for the Slack websocket, so no network access is needed.
+
+Run from the bot directory: python benchmark_rtm_loop.py [number of events]
+"""
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from queue import Queue
+
+from slack_bot import SlackBot, RTM_MODE_ASYNCIO, RTM_MODE_THREADED
+
+
+class FakeServer(object):
+    def __init__(self, sock):
+        self.websocket = FakeWebsocket(sock)
+        self.username = "bench-hal"
+        self.domain = "bench"
+        self.login_data = {'team': {'name': "bench"}, 'self': {'id': 'UBENCH'}}
+
+    def ping(self):
+        pass
+
+
+class FakeWebsocket(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+
+class FakeRtm(object):
+    """
+    Mimics SlackClient.rtm_read on a non-blocking socket: returns every complete frame available, or [] if none.
+    """
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.server = FakeServer(sock)
+        self._buffer = b""
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        try:
+            self._buffer += self.sock.recv(65536)
+        except BlockingIOError:
+            pass
+        *frames, self._buffer = self._buffer.split(b"\n")
+        return [json.loads(frame.decode('utf-8')) for frame in frames if frame]
+
+
+class FakeClients(object):
+    """
+    Has just what SlackBot.start uses of SlackClients. There is no workspace to seed, user directory to warm up, or
+    stored nags to restore
+    """
+    def __init__(self, sock):
+        self.token = "bench"
+        self.created_at = time.time()
+        self.rtm = FakeRtm(sock)
+
+    def seed_workspace(self):
+        pass
+
+    def start_user_warm_up(self):
+        return None
+
+    def start_nag_restore(self, msg_writer, state_q):
+        return None
+
+
+class FakeMessenger(object):
+    def __init__(self, clients, scheduler=None):
+        self.clients = clients
+
+    def write_error(self, channel_id, err_msg):
+        print(err_msg)
+
+
+def run_mode(run_mode, event_count):
+    reader, writer = socket.socketpair()
+    latencies = []
+    bot = SlackBot(Queue(), Queue(), run_mode=run_mode)
+    bot.clients = FakeClients(reader)
+
+    class RecordingEventHandler(object):
+        def __init__(self, slack_clients, msg_writer, event_processing_q, state_updating_q):
+            pass
+
+        def state_check(self):
+            pass
+
+        def process_state(self, state):
+            pass
+
+        def handle(self, event):
+            latencies.append(time.perf_counter() - event['sent'])
+            if len(latencies) >= event_count:
+                bot.stop(None)
+
+    def produce():
+        rng = random.Random(42)
+        for _ in range(event_count):
+            time.sleep(rng.uniform(0.005, 0.03))
+            frame = {'type': 'message', 'channel': 'C1', 'sent': time.perf_counter()}
+            writer.sendall(json.dumps(frame).encode('utf-8') + b"\n")
+
+    producer = threading.Thread(target=produce, daemon=True)
+    cpu_start = time.process_time()
+    producer.start()
+    bot.start({}, messenger=FakeMessenger, rtmEventHandler=RecordingEventHandler)
+    cpu_used = time.process_time() - cpu_start
+    producer.join()
+    reader.close()
+    writer.close()
+    return latencies, cpu_used
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    print("{} events per mode".format(event_count))
+    print("{:<10} {:>10} {:>10} {:>10}".format("mode", "p50 (ms)", "p99 (ms)", "cpu (s)"))
+    for mode in (RTM_MODE_THREADED, RTM_MODE_ASYNCIO):
+        latencies, cpu_used = run_mode(mode, event_count)
+        print("{:<10} {:>10.3f} {:>10.3f} {:>10.3f}".format(mode,
+                                                            percentile(latencies, 50) * 1000,
+                                                            percentile(latencies, 99) * 1000,
+                                                            cpu_used))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import json
 import logging
+import traceback
 
 from gala_wit import GalaWit
+from intent_classifier import LocalIntentClassifier
 from intenthandlers.utils import get_highest_confidence_entity
 from intenthandlers.misc import say_quote
 from intenthandlers.misc import randomize_options
@@ -15,11 +17,16 @@ from intenthandlers.drive import create_drive_file
 from intenthandlers.drive import delete_drive_file
 from intenthandlers.google_helpers import send_email
 from intenthandlers.drive import get_google_drive_list
+from intenthandlers.drive import get_more_drive_files
 from state import WaitState
 from state import ConversationState
+from state import ReplyState
 from slack_clients import is_direct_message
+from threads import OrderedWorkerPool, PoolFullError, IntentPolicy, RETRY_IDEMPOTENT, DEFAULT_INTENT_POLICY
+from threads import POOL_LOCAL, POOL_GOOGLE
 from oauth2client import client
 import os
+import uuid
 from intenthandlers.google_helpers import SCOPES
 
 
@@ -28,6 +35,24 @@ logger = logging.getLogger(__name__)
 # List of users for the bot to ignore
 user_ignore_list = ['USLACKBOT']
 
+# How each intent's handler is supervised, and which pool it runs on, see IntentPolicy. Intents not listed run at most
+# once on the default pool, with the default timeout. Only handlers with no side effects may be retried, as a timed out
+# handler can't be stopped, and keeps running. The galatean count returns its reply as a ReplyState, which is only
+# posted for the first attempt to finish, so it is retried. The others post to Slack themselves, and the drive listing
+# also records which files the user has seen, so a retry would repeat those
+intent_policies = {
+    'movie-quote': IntentPolicy(pool=POOL_LOCAL),
+    'randomize': IntentPolicy(pool=POOL_LOCAL),
+    'coin-flip': IntentPolicy(pool=POOL_LOCAL),
+    'get-google-drive': IntentPolicy(timeout=15, pool=POOL_GOOGLE),
+    'view-drive-file': IntentPolicy(timeout=10, pool=POOL_GOOGLE),
+    'galatean-count': IntentPolicy(timeout=10, retry=RETRY_IDEMPOTENT, pool=POOL_GOOGLE),
+    'more-drive-files': IntentPolicy(timeout=15, pool=POOL_GOOGLE),
+    'create-drive-file': IntentPolicy(timeout=15, pool=POOL_GOOGLE),
+    'delete-drive-file': IntentPolicy(timeout=15, pool=POOL_GOOGLE),
+    'send-email': IntentPolicy(timeout=15, pool=POOL_GOOGLE),
+}
+
 # A list of intents which are part of conversations. Could be merged into intents as a separate entry in the tuple
 conversation_intent_types = {
     # NOTE: none of the functions have been implemented. This is an important TODO for conversation matching!
@@ -48,10 +73,14 @@ class RtmEventHandler(object):
         self.event_processing_q = event_processing_q  # this q holds objects representing events to act upon
         self.clients = slack_clients
         self.msg_writer = msg_writer
-        self.wit_client = GalaWit()
+        self.wit_client = GalaWit(pre_classifier=LocalIntentClassifier.default())
         self.conversations = {}
         self.wait_states = {}
         self.credentials = GoogleCredentials(msg_writer, slack_clients)
+        # Wit and Slack Web lookups happen in this stage rather than on the thread reading the RTM websocket. Its
+        # queue is bounded, so that a Wit outage can't pile up messages without limit
+        self.interpretation_stage = OrderedWorkerPool(int(os.getenv("NLU_WORKERS", "4")),
+                                                      max_queued=int(os.getenv("NLU_QUEUE", "100")), name='nlu')
         # this is a mapping of wit.ai intents to code that will handle those intents
         self.intents = {
             'movie-quote': (say_quote, 'movie quote'),
@@ -59,6 +88,7 @@ class RtmEventHandler(object):
             'randomize': (randomize_options, 'Decide between burgers and tacos'),
             'coin-flip': (flip_coin, 'flip a coin'),
             'get-google-drive': (get_google_drive_list, "What is in your google drive?"),
+            'more-drive-files': (get_more_drive_files, "more"),
             'view-drive-file': (view_drive_file, "show getting started"),
             'create-drive-file': (create_drive_file, "create filename"),
             'delete-drive-file': (delete_drive_file, "delete filename"),
@@ -89,10 +119,16 @@ class RtmEventHandler(object):
             self._handle_message(event)
         elif event_type == 'channel_joined':
             # you joined a channel
+            self.clients.update_workspace(event)
             self.msg_writer.say_hi(event['channel'], event.get('user', ""))
         elif event_type == 'group_joined':
             # you joined a private group
+            self.clients.update_workspace(event)
             self.msg_writer.say_hi(event['channel'], event.get('user', ""))
+        elif event_type in ('channel_created', 'channel_rename', 'channel_deleted', 'group_rename', 'group_archive',
+                            'im_created', 'team_join', 'user_change'):
+            # channels, DMs or users changed
+            self.clients.update_workspace(event)
         else:
             pass
 
@@ -101,11 +137,35 @@ class RtmEventHandler(object):
         if not self._proof_message(event):
             return
 
-        msg_txt = event['text']
-        channel_id = event['channel']
-
         # Remove mention of the bot so that the rest of the code doesn't need to
-        msg_txt = self.clients.remove_mention(msg_txt).strip()
+        event['cleaned_text'] = self.clients.remove_mention(event['text']).strip()
+
+        # Messages are keyed by channel, so each channel's messages are still interpreted in order. The RTM thread
+        # must never wait, so a message arriving while the stage is full is refused
+        try:
+            self.interpretation_stage.submit(event['channel'], self._interpret_message, event)
+        except PoolFullError as e:
+            logger.warning("Refused a message: {}".format(e))
+            self.msg_writer.send_message(event['channel'],
+                                         "I'm too busy to do that right now, please try again in a minute")
+
+    def _interpret_message(self, event):
+        """
+        :param event: A message event which passed _proof_message
+        Runs in the interpretation stage. Asks wit for the intent, fills in user and channel details, and puts the
+        resulting task on the event processing q
+        :return: None
+        """
+        try:
+            self._interpret(event)
+        except:
+            err_msg = traceback.format_exc()
+            logger.error('Unexpected error: {}'.format(err_msg))
+            self.msg_writer.write_error(event['channel'], err_msg)
+
+    def _interpret(self, event):
+        msg_txt = event['cleaned_text']
+        channel_id = event['channel']
 
         # Ask wit to interpret the text and send back a list of entities
         logger.info("Asking wit to interpret| {}".format(msg_txt))
@@ -120,8 +180,7 @@ class RtmEventHandler(object):
         event.update({
             "user_name": user_name,
             "channel_name": channel_name,
-            "user_dm": self.clients.get_dm_id_from_user_id(event['user']),
-            "cleaned_text": msg_txt
+            "user_dm": self.clients.get_dm_id_from_user_id(event['user'])
         })
 
         # Find the intent with the highest confidence that met our default threshold
@@ -141,6 +200,9 @@ class RtmEventHandler(object):
         if intent_value in self.intents:
             t = {
                 'intent': self.intents[intent_value][0],
+                'intent_value': intent_value,
+                'policy': intent_policies.get(intent_value, DEFAULT_INTENT_POLICY),
+                'idempotency_key': uuid.uuid4().hex,
                 'msg_writer': self.msg_writer,
                 'event': event,
                 'wit_entities': wit_resp['entities'],
@@ -153,7 +215,14 @@ class RtmEventHandler(object):
             raise ReferenceError("No function found to handle intent {}".format(intent_value))
 
     def _process_q(self):
-        state = self.state_updating_q.get()
+        self.process_state(self.state_updating_q.get())
+
+    def process_state(self, state):
+        """
+        :param state: An object taken off the state updating q
+        Applies a single state update. Must be called from the thread that owns the RTM connection.
+        :return: None
+        """
         if state['type'] == 'flask_response':
             self._check_flask(state)
         elif state['type'] == 'state_update':
@@ -185,6 +254,9 @@ class RtmEventHandler(object):
 
             t = {
                 'intent': self.intents[state.get_intent_value()][0],
+                'intent_value': state.get_intent_value(),
+                'policy': intent_policies.get(state.get_intent_value(), DEFAULT_INTENT_POLICY),
+                'idempotency_key': uuid.uuid4().hex,
                 'msg_writer': self.msg_writer,
                 'event': state.get_event(),
                 'wit_entities': state.get_wit_entities(),
@@ -208,6 +280,8 @@ class RtmEventHandler(object):
             self._conversations_update(state)
         elif isinstance(state, WaitState):
             self.wait_states.update({state.get_id(): state})
+        elif isinstance(state, ReplyState):
+            self.msg_writer.send_message(state.channel, state.text)
 
     def _proof_message(self, event):
         """
@@ -246,9 +320,10 @@ class RtmEventHandler(object):
         :return: A Conversation State from self.conversations
         """
         possible_matches = []
-        for conversation in self.conversations:
-            if intent in self.conversations[conversation].get_waiting_for():
-                possible_matches.append(self.conversations[conversation])
+        # Copied, as conversations are updated on the RTM thread while this runs in the interpretation stage
+        for conversation in list(self.conversations.values()):
+            if intent in conversation.get_waiting_for():
+                possible_matches.append(conversation)
         if not possible_matches:
             return
         elif len(possible_matches) == 1:
@@ -1,6 +1,13 @@
+import copy
+import json
 import logging
 import os
+import re
+import threading
+import time
 from wit import Wit
+from intenthandlers.utils import TTLCache
+import metrics
 
 
 logger = logging.getLogger(__name__)
@@ -23,8 +30,61 @@ def error(session_id, context, e):
                                                                                                   context))
 
 
+# Slack renders user mentions as <@U123> or <@U123|name>. Only the id matters to wit
+MENTION_LABEL = re.compile(r'<@(\w+)\|[^>]*>')
+
+
+def normalize_message(msg):
+    """
+    :param msg: The text of a message
+    :return: The text lower cased, with mentions reduced to ids and whitespace collapsed, for use as a cache key
+    """
+    msg = MENTION_LABEL.sub(r'<@\1>', msg)
+    return ' '.join(msg.split()).lower()
+
+
+def adapt_cached_response(resp, msg):
+    """
+    :param resp: A wit response cached for a message which normalizes to the same key as msg
+    :param msg: The message actually being interpreted
+    A cached response may have come from a message with different casing, so entity values (file names, people's
+    names) are put back into the casing used in msg. Intent values are names we match on, so they are left alone.
+    The cached response itself is not changed.
+    :return: A copy of resp that reads as if wit had been asked about msg
+    """
+    resp = copy.deepcopy(resp)
+    resp['_text'] = msg
+    for entity_name, entities in resp.get('entities', {}).items():
+        if entity_name == 'intent':
+            continue
+        for entity in entities:
+            value = entity.get('value')
+            if isinstance(value, str):
+                match = re.search(re.escape(value), msg, re.IGNORECASE)
+                if match:
+                    entity['value'] = match.group(0)
+    return resp
+
+
+def intent_confidence(resp):
+    """
+    :return: The value and confidence of the most confident intent in a wit shaped response, or (None, 0)
+    """
+    intents = resp.get('entities', {}).get('intent', [])
+    if not intents:
+        return None, 0
+    best = max(intents, key=lambda entity: entity.get('confidence', 0))
+    return best.get('value'), best.get('confidence', 0)
+
+
 class GalaWit(object):
-    def __init__(self, witlib=Wit):  # Added witlib=Wit to allow test code to send a mock Wit
+    def __init__(self, witlib=Wit, cache=None, pre_classifier=None, threshold=None):
+        """
+        :param witlib: The wit client class. Added witlib=Wit to allow test code to send a mock Wit
+        :param cache: A TTLCache for wit responses
+        :param pre_classifier: Optional local classifier, asked before wit (see intent_classifier.py). Its answer is
+        used when its intent confidence is at least threshold, which defaults to the LOCAL_INTENT_THRESHOLD env var
+        """
         wit_token = os.getenv("WIT_ACCESS_TOKEN", "")
         logger.info("wit access token: {}".format(wit_token))
 
@@ -41,8 +101,75 @@ class GalaWit(object):
 
         self.wit_client = witlib(wit_token, self.actions, logger)
 
-    # @memoized  # This can be memoized in a high volume environment to eliminate wit calls with identical messages
+        # A handful of phrasings make up most of our traffic, so responses are cached to save the round trip to wit
+        if cache is None:
+            cache = TTLCache(maxsize=int(os.getenv("WIT_CACHE_SIZE") or 1024),
+                             ttl=int(os.getenv("WIT_CACHE_TTL") or 3600),
+                             name='wit_cache')
+        self.cache = cache
+
+        self.pre_classifier = pre_classifier
+        self.threshold = threshold if threshold is not None else float(os.getenv("LOCAL_INTENT_THRESHOLD") or 0.9)
+        self.local_hits = metrics.counter('local_intents.hits')
+        self.local_misses = metrics.counter('local_intents.misses')
+        self.wit_latency = metrics.histogram('wit.request_seconds')
+        metrics.gauge('local_intents.hit_ratio', self._local_hit_ratio)
+        metrics.gauge('local_intents.latency_saved_seconds', self._latency_saved)
+
+        # Wit responses can be logged, one JSON object per line, to train and evaluate the local classifier offline
+        self.response_log = os.getenv("WIT_RESPONSE_LOG", "")
+        self._log_lock = threading.Lock()
+
     def interpret(self, msg):
+        if self.pre_classifier is not None:
+            resp = self.pre_classifier.classify(msg)
+            if resp is not None and intent_confidence(resp)[1] >= self.threshold:
+                self.local_hits.inc()
+                logger.info("local resp {}".format(resp))
+                return resp
+            self.local_misses.inc()
+
+        key = normalize_message(msg)
+        resp = self.cache.get(key)
+        if resp is not None:
+            logger.info("cached resp {}".format(resp))
+            return adapt_cached_response(resp, msg)
+
+        started = time.monotonic()
         resp = self.wit_client.message(msg)
+        latency = time.monotonic() - started
+        self.wit_latency.observe(latency)
         logger.info("resp {}".format(resp))
+        self.cache.put(key, copy.deepcopy(resp))
+        if self.response_log:
+            self._log_response(msg, resp, latency)
         return resp
+
+    def local_hit_report(self):
+        """
+        :return: How often the local classifier answered instead of wit, and an estimate of the wit latency that saved
+        """
+        return {
+            'local_hits': self.local_hits.value(),
+            'local_misses': self.local_misses.value(),
+            'local_hit_ratio': self._local_hit_ratio(),
+            'latency_saved_seconds': self._latency_saved()
+        }
+
+    def _local_hit_ratio(self):
+        total = self.local_hits.value() + self.local_misses.value()
+        return self.local_hits.value() / total if total else 0.0
+
+    def _latency_saved(self):
+        # Each local hit saved, on average, one wit round trip
+        snapshot = self.wit_latency.snapshot()
+        if not snapshot['count']:
+            return 0.0
+        return self.local_hits.value() * snapshot['sum'] / snapshot['count']
+
+    def _log_response(self, msg, resp, latency):
+        try:
+            with self._log_lock, open(self.response_log, 'a') as log_file:
+                log_file.write(json.dumps({'msg': msg, 'resp': resp, 'latency': latency}) + "\n")
+        except (IOError, TypeError) as e:
+            logger.error("Failed to log wit response: {}".format(e))
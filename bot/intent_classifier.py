@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Local intent classification, used in front of wit for commands which are easy to recognise without a network call.
+
+Classifiers return responses in the same shape as wit ({'_text': ..., 'entities': {...}}), or None if they have
+no opinion. Run as a script to train the phrase model, or to report on how often the local classifiers would have
+answered for a log of wit responses (see GalaWit and the WIT_RESPONSE_LOG env var):
+
+    python intent_classifier.py train <wit response log> <model file>
+    python intent_classifier.py report <wit response log> [model file]
+"""
+import json
+import logging
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+
+from gala_wit import normalize_message, adapt_cached_response, intent_confidence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.9
+
+# Words that belong to other commands. A message containing one of them is never classified as a randomize
+COMMAND_WORDS = {'nag', 'email', 'send', 'create', 'delete', 'view', 'show', 'file', 'drive', 'galateans'}
+
+# Confidence in a bare "X or Y" being a randomize. Without a cue such as "should I", it is as likely to be a question,
+# e.g. "is it monday or tuesday", so it is kept below DEFAULT_THRESHOLD and only counted, never answered, locally
+BARE_EITHER_CONFIDENCE = 0.6
+
+
+def build_response(msg, intent, confidence, **entities):
+    """
+    :param msg: The message which was classified
+    :param intent: The intent value, as wit would return it
+    :param confidence: Confidence in the intent
+    :param entities: Any further entities, each a list of values
+    :return: A response shaped like a wit response
+    """
+    resp = {'_text': msg, 'entities': {'intent': [{'confidence': confidence, 'value': intent}]}}
+    for entity_name, values in entities.items():
+        resp['entities'][entity_name] = [{'confidence': confidence, 'type': 'value', 'value': value}
+                                         for value in values]
+    return resp
+
+
+def split_options(text):
+    """
+    Splits "a, b or c" into ['a', 'b', 'c']
+    """
+    options = re.split(r'\s*,\s*(?:or\s+|and\s+)?|\s+or\s+|\s+and\s+', text)
+    return [option.strip() for option in options if option.strip()]
+
+
+class RuleClassifier(object):
+    """
+    A RuleClassifier recognises the handful of commands whose phrasing barely varies: coin flips, movie quotes,
+    "X or Y" decisions and asking for more of a drive listing
+    """
+    COIN_FLIP = re.compile(r'^(?:please\s+)?(?:flip|toss)\s+(?:a\s+)?coin\W*$|^heads\s+or\s+tails\W*$', re.IGNORECASE)
+    MOVIE_QUOTE = re.compile(r'^(?:say|give\s+me|tell\s+me)?\s*(?:a\s+)?(?:movie\s+)?quote\W*$', re.IGNORECASE)
+    DECIDE = re.compile(r'^(?:decide|choose|pick)(?:\s+between)?\s+(.+?)[.?!]*$', re.IGNORECASE)
+    SHOULD = re.compile(r'^should\s+(?:i|we)\s+(.+?)\s+or\s+(.+?)[.?!]*$', re.IGNORECASE)
+    EITHER = re.compile(r'^(.+?)\s+or\s+(.+?)[.?!]*$', re.IGNORECASE)
+    MORE_FILES = re.compile(r'^(?:(?:show|give)\s+(?:me\s+)?)?(?:some\s+)?(?:more|next)(?:\s+files)?'
+                            r'(?:\s+please)?\W*$', re.IGNORECASE)
+
+    def classify(self, msg):
+        text = msg.strip()
+        if self.COIN_FLIP.match(text):
+            return build_response(msg, 'coin-flip', 0.98)
+        if self.MOVIE_QUOTE.match(text):
+            return build_response(msg, 'movie-quote', 0.97)
+        if self.MORE_FILES.match(text):
+            return build_response(msg, 'more-drive-files', 0.95)
+
+        match = self.DECIDE.match(text)
+        if match:
+            options = split_options(match.group(1))
+            if not set(text.lower().split()) & COMMAND_WORDS and len(options) > 1:
+                return build_response(msg, 'randomize', 0.95, randomize_option=options)
+
+        for pattern, confidence in ((self.SHOULD, 0.95), (self.EITHER, BARE_EITHER_CONFIDENCE)):
+            match = pattern.match(text)
+            if match:
+                words = set(text.lower().split())
+                options = split_options(match.group(1)) + split_options(match.group(2))
+                # Only short, plain choices, to stay clear of commands which happen to contain an "or"
+                if not words & COMMAND_WORDS and len(options) > 1 and all(len(o.split()) <= 3 for o in options):
+                    return build_response(msg, 'randomize', confidence, randomize_option=options)
+                return None
+
+        return None
+
+
+class PhraseClassifier(object):
+    """
+    A PhraseClassifier is a small model trained offline from logged wit responses. It remembers, for each normalized
+    phrase wit has seen often enough, the response wit gave most often, with a confidence scaled by how consistently
+    wit gave it.
+    """
+    def __init__(self, phrases=None):
+        self.phrases = phrases or {}  # normalized phrase -> {'confidence': float, 'resp': wit response}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as model_file:
+            return cls(json.load(model_file))
+
+    def save(self, path):
+        with open(path, 'w') as model_file:
+            json.dump(self.phrases, model_file)
+
+    @classmethod
+    def train(cls, records, min_count=3):
+        """
+        :param records: Logged wit responses, each a dict with 'msg' and 'resp' keys
+        :param min_count: How many times a phrase must have been seen to be learnt
+        :return: A trained PhraseClassifier
+        """
+        seen = defaultdict(list)
+        for record in records:
+            seen[normalize_message(record['msg'])].append(record['resp'])
+
+        phrases = {}
+        for phrase, responses in seen.items():
+            if len(responses) < min_count:
+                continue
+            intents = Counter(intent_confidence(resp)[0] for resp in responses)
+            intent, agreeing = intents.most_common(1)[0]
+            if intent is None:
+                continue
+            matching = [resp for resp in responses if intent_confidence(resp)[0] == intent]
+            mean_confidence = sum(intent_confidence(resp)[1] for resp in matching) / len(matching)
+            phrases[phrase] = {
+                'confidence': mean_confidence * agreeing / len(responses),
+                'resp': matching[-1]
+            }
+        return cls(phrases)
+
+    def classify(self, msg):
+        learnt = self.phrases.get(normalize_message(msg))
+        if learnt is None:
+            return None
+        resp = adapt_cached_response(learnt['resp'], msg)
+        for entity in resp['entities'].get('intent', []):
+            entity['confidence'] = learnt['confidence']
+        return resp
+
+
+class LocalIntentClassifier(object):
+    """
+    A LocalIntentClassifier asks each of its classifiers in turn, and returns the most confident answer
+    """
+    def __init__(self, classifiers):
+        self.classifiers = classifiers
+
+    @classmethod
+    def default(cls):
+        classifiers = [RuleClassifier()]
+        model_path = os.getenv("LOCAL_INTENT_MODEL", "")
+        if model_path and os.path.exists(model_path):
+            classifiers.append(PhraseClassifier.load(model_path))
+        elif model_path:
+            logger.error("LOCAL_INTENT_MODEL {} not found, only using rules".format(model_path))
+        return cls(classifiers)
+
+    def classify(self, msg):
+        best, best_confidence = None, 0
+        for classifier in self.classifiers:
+            resp = classifier.classify(msg)
+            if resp is None:
+                continue
+            confidence = intent_confidence(resp)[1]
+            if confidence > best_confidence:
+                best, best_confidence = resp, confidence
+        return best
+
+
+def read_log(path):
+    with open(path) as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def report(records, classifier, threshold=DEFAULT_THRESHOLD):
+    """
+    :param records: Logged wit responses, each a dict with 'msg', 'resp' and 'latency' keys
+    :return: How many messages the classifier would have answered locally, how often it agreed with wit, and the wit
+    latency those answers would have saved
+    """
+    local_hits = agreed = 0
+    latency_saved = 0.0
+    for record in records:
+        resp = classifier.classify(record['msg'])
+        if resp is None:
+            continue
+        intent, confidence = intent_confidence(resp)
+        if confidence < threshold:
+            continue
+        local_hits += 1
+        latency_saved += record.get('latency', 0.0)
+        if intent == intent_confidence(record['resp'])[0]:
+            agreed += 1
+    total = len(records)
+    return {
+        'messages': total,
+        'local_hits': local_hits,
+        'local_hit_ratio': local_hits / total if total else 0.0,
+        'agreement_with_wit': agreed / local_hits if local_hits else 0.0,
+        'latency_saved_seconds': latency_saved
+    }
+
+
+def main(argv):
+    if len(argv) >= 4 and argv[1] == 'train':
+        model = PhraseClassifier.train(read_log(argv[2]))
+        model.save(argv[3])
+        print("Learnt {} phrases".format(len(model.phrases)))
+    elif len(argv) >= 3 and argv[1] == 'report':
+        classifiers = [RuleClassifier()]
+        if len(argv) >= 4:
+            classifiers.append(PhraseClassifier.load(argv[3]))
+        results = report(read_log(argv[2]), LocalIntentClassifier(classifiers))
+        for key in sorted(results):
+            print("{:<24} {}".format(key, results[key]))
+    else:
+        print(__doc__)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,145 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from cryptography.fernet import InvalidToken
+from oauth2client import client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class MemoryCredentialStore(object):
+    """
+    A MemoryCredentialStore holds each user's Google credentials for as long as the bot runs. Every store has the same
+    get, put and delete methods, so GoogleCredentials can use any of them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = {}
+
+    def get(self, user):
+        """
+        :return: The user's credentials, or None if they have not authorized the bot
+        """
+        return self._credentials.get(user)
+
+    def put(self, user, credentials):
+        with self._lock:
+            self._credentials[user] = credentials
+
+    def delete(self, user):
+        with self._lock:
+            self._credentials.pop(user, None)
+
+
+class SqliteCredentialStore(object):
+    """
+    A SqliteCredentialStore keeps each user's Google credentials in a SQLite file, encrypted with the bot's Fernet
+    key, so they survive restarts and deploys. A user's row is read the first time their credentials are asked for,
+    and kept in memory from then on, so later lookups are dict accesses. Credentials oauth2client refreshes are
+    written back.
+    """
+    def __init__(self, path, crypt):
+        """
+        :param path: The SQLite file, created if it does not exist
+        :param crypt: A Fernet instance to encrypt rows with
+        """
+        self.path = path
+        self.crypt = crypt
+        self._lock = threading.Lock()  # Guards the connection and the loaded credentials
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS credentials "
+                                 "(user TEXT PRIMARY KEY, credentials BLOB NOT NULL, updated REAL NOT NULL)")
+        self._connection.commit()
+        self._loaded = {}  # user -> credentials, or _MISSING if they have none
+        self._load_time = metrics.histogram('credential_store.load_seconds')
+
+    def get(self, user):
+        credentials = self._loaded.get(user)
+        if credentials is None:
+            credentials = self._load(user)
+        return None if credentials is _MISSING else credentials
+
+    def _load(self, user):
+        started = time.monotonic()
+        with self._lock:
+            credentials = self._loaded.get(user)
+            if credentials is not None:
+                return credentials  # Another thread loaded it while we waited
+            row = self._connection.execute("SELECT credentials FROM credentials WHERE user = ?", (user,)).fetchone()
+            credentials = _MISSING
+            if row is not None:
+                try:
+                    credentials = client.Credentials.new_from_json(self.crypt.decrypt(row[0]).decode('utf-8'))
+                    credentials.set_store(_UserStorage(self, user))
+                except (InvalidToken, ValueError, KeyError) as e:
+                    logger.error("Stored credentials for {} are unreadable, they must authorize again: {}".format(
+                        user, e))
+            self._loaded[user] = credentials
+        self._load_time.observe(time.monotonic() - started)
+        return credentials
+
+    def put(self, user, credentials):
+        self.write(user, credentials)
+        credentials.set_store(_UserStorage(self, user))
+
+    def write(self, user, credentials):
+        """
+        Saves credentials without attaching a storage to them, as oauth2client does after a refresh
+        """
+        encrypted = self.crypt.encrypt(credentials.to_json().encode('utf-8'))
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO credentials (user, credentials, updated) VALUES (?, ?, ?)",
+                                     (user, encrypted, time.time()))
+            self._connection.commit()
+            self._loaded[user] = credentials
+        metrics.counter('credential_store.writes').inc()
+
+    def delete(self, user):
+        with self._lock:
+            self._connection.execute("DELETE FROM credentials WHERE user = ?", (user,))
+            self._connection.commit()
+            self._loaded[user] = _MISSING
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _UserStorage(client.Storage):
+    """
+    Lets oauth2client save a user's credentials back to the store after refreshing their access token
+    """
+    def __init__(self, store, user):
+        client.Storage.__init__(self, lock=threading.Lock())
+        self.store = store
+        self.user = user
+
+    def locked_get(self):
+        return self.store.get(self.user)
+
+    def locked_put(self, credentials):
+        # The credentials already hold this storage, and its lock while refreshing, so it mustn't be replaced
+        self.store.write(self.user, credentials)
+
+    def locked_delete(self):
+        self.store.delete(self.user)
+
+
+def default_store(crypt):
+    """
+    :param crypt: The bot's Fernet instance, or None if it has no key
+    :return: A SqliteCredentialStore at the CREDENTIAL_DB env var's path (default credentials.sqlite), or a
+    MemoryCredentialStore if CREDENTIAL_DB is 'memory' or there is no key to encrypt with
+    """
+    path = os.getenv("CREDENTIAL_DB") or "credentials.sqlite"
+    if path == 'memory':
+        return MemoryCredentialStore()
+    if crypt is None:
+        logger.error("No FERNET_KEY to encrypt credentials with, they will not be kept across restarts")
+        return MemoryCredentialStore()
+    return SqliteCredentialStore(path, crypt)
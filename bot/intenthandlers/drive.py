@@ -1,13 +1,60 @@
-import httplib2
 import logging
+import os
+import threading
 from uuid import uuid4
 from intenthandlers.utils import get_highest_confidence_entity
-from fuzzywuzzy import process
-from apiclient import discovery, errors
+from apiclient import errors
+from intenthandlers.google_services import get_service
+from intenthandlers.drive_index import listing_pages, find_file, remember_file, forget_file, FILE_FIELDS
 from state import WaitState
 
 logger = logging.getLogger(__name__)
 
+# How many files a listing shows, unless the user asks for a number. "more" shows the next as many
+LISTING_LIMIT = int(os.getenv("DRIVE_LISTING_LIMIT") or 100)
+# Listings are sent in code blocks of at most this many characters, within Slack's message size limit
+LISTING_CHUNK_LENGTH = 3900
+
+# The files each user's last listing has shown so far, and how many it showed at a time, so "more" can carry on with
+# as many. Files are remembered by id rather than by position, so carrying on is right whichever order the next page
+# comes in, from the user's drive index or straight from Drive
+listings = {}  # user -> (frozenset of file ids listed, limit)
+listings_lock = threading.Lock()  # Handlers run on several pool workers at once
+
+
+def send_listing(msg_writer, channel, pages, listed=frozenset(), limit=LISTING_LIMIT,
+                 max_length=LISTING_CHUNK_LENGTH):
+    """
+    Sends file names as code blocks of at most max_length characters. A block is sent as soon as it is full, or its
+    page of files is done, so the first names show up while later pages are still being fetched.
+    :param pages: Lists of files, in the order they should be listed
+    :param listed: The ids of files to skip, having been listed already
+    :param limit: How many files to list
+    :return: The ids of the files listed, and whether there were more files after them
+    """
+    lines, length, shown = [], 0, []
+    more = False
+    for page in pages:
+        for drive_file in page:
+            if drive_file['id'] in listed:
+                continue
+            if len(shown) == limit:
+                more = True
+                break
+            line = drive_file['name']
+            if lines and length + len(line) + 1 > max_length - len("``````"):
+                msg_writer.send_message(channel, "```{}```".format("\n".join(lines)))
+                lines, length = [], 0
+            lines.append(line)
+            length += len(line) + 1
+            shown.append(drive_file['id'])
+        if lines:
+            msg_writer.send_message(channel, "```{}```".format("\n".join(lines)))
+            lines, length = [], 0
+        if more:
+            break
+    return shown, more
+
 
 def get_google_drive_list(msg_writer, event, wit_entities, credentials):
     """
@@ -17,29 +64,51 @@ def get_google_drive_list(msg_writer, event, wit_entities, credentials):
     :param credentials GoogleCredentials object used to authorize requests
     :return: None, list of drive files is written to slack channel
     """
+    number = get_highest_confidence_entity(wit_entities, 'number')
+    limit = int(number['value']) if number and number['value'] > 0 else LISTING_LIMIT
+    return _list_drive_files(msg_writer, event, wit_entities, credentials, 'get-google-drive', frozenset(), limit)
+
+
+def get_more_drive_files(msg_writer, event, wit_entities, credentials):
+    """
+    Carries on the user's last drive listing from where it stopped, showing as many files as it did
+    :return: None, the next files are written to slack channel
+    """
+    with listings_lock:
+        listing = listings.get(event['user'])
+    if listing is None:
+        msg_writer.send_message(event['channel'], "There's nothing more to show")
+        return
+    listed, limit = listing
+    return _list_drive_files(msg_writer, event, wit_entities, credentials, 'more-drive-files', listed, limit)
+
+
+def _list_drive_files(msg_writer, event, wit_entities, credentials, intent_value, listed, limit):
+    """
+    :param intent_value: The intent to carry on with once the user has authorized, which for "more" still finds the
+    user's listing, as it is only moved on once files are listed
+    :param listed: The ids of the files the user has already been shown
+    :return: A WaitState if the user must authorize first, otherwise None
+    """
     state_id = uuid4()
     current_creds = credentials.get_credential(event, state_id, user=event['user'])
     if current_creds is None:
-        state = WaitState(build_uuid=state_id, intent_value='get-google-drive', event=event,
+        state = WaitState(build_uuid=state_id, intent_value=intent_value, event=event,
                           wit_entities=wit_entities, credentials=credentials)
         return state
-    http = current_creds.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-
-    files = service.files().list().execute()['files']
-    if not files:
+    service = get_service('drive', 'v3', current_creds, user=event['user'])
+
+    shown, more = send_listing(msg_writer, event['channel'], listing_pages(event['user'], service), listed, limit)
+
+    with listings_lock:
+        if more:
+            listings[event['user']] = (listed.union(shown), limit)
+        else:
+            listings.pop(event['user'], None)
+    if more:
+        msg_writer.send_message(event['channel'], "Say \"more\" to see the next {} files".format(limit))
+    elif not shown and not listed:
         msg_writer.send_message(event['channel'], "No files in this drive")
-    else:
-        file_names = [x['name'] for x in files]
-
-        message_string = "```"
-
-        for file_name in file_names:
-            message_string = message_string + file_name + "\n"
-
-        message_string += "```"
-
-        msg_writer.send_message(event['channel'], message_string)
 
 
 def view_drive_file(msg_writer, event, wit_entities, credentials):
@@ -56,12 +125,7 @@ def view_drive_file(msg_writer, event, wit_entities, credentials):
         state = WaitState(build_uuid=state_id, intent_value='view-drive-file', event=event,
                           wit_entities=wit_entities, credentials=credentials)
         return state
-    http = current_creds.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-
-    files = service.files().list().execute()['files']
-
-    file_names = [x['name'] for x in files]
+    service = get_service('drive', 'v3', current_creds, user=event['user'])
 
     try:
         desired_file_name = get_highest_confidence_entity(wit_entities, 'randomize_option')['value']
@@ -69,10 +133,10 @@ def view_drive_file(msg_writer, event, wit_entities, credentials):
         msg_writer.send_message(event['channel'], "I don't know what file you're talking about")
         return
 
-    likely_file = process.extractOne(desired_file_name, file_names)
+    likely_file = find_file(event['user'], service, desired_file_name)  # Only files scoring at least 75
 
-    if likely_file and likely_file[1] >= 75:  # Arbitrary probability cutoff
-        likely_file_id = get_id_from_name(files, likely_file[0])
+    if likely_file:
+        likely_file_id = likely_file[1]
         msg_writer.send_message(event['channel'], "```File ID: {}```".format(likely_file_id))
 
     else:
@@ -94,14 +158,14 @@ def create_drive_file(msg_writer, event, wit_entities, credentials):
         state = WaitState(build_uuid=state_id, intent_value='create-drive-file', event=event,
                           wit_entities=wit_entities, credentials=credentials)
         return state
-    http = current_creds.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
+    service = get_service('drive', 'v3', current_creds, user=event['user'])
 
     desired_file_name = get_highest_confidence_entity(wit_entities, 'randomize_option')['value']
 
-    blank_id = service.files().create(body={"name": desired_file_name}).execute()
+    blank_id = service.files().create(body={"name": desired_file_name}, fields=FILE_FIELDS).execute()
 
     if blank_id:
+        remember_file(event['user'], blank_id)
         msg_writer.send_message(event['channel'], "Created file '{}'".format(desired_file_name))
     else:
         msg_writer.write_error(event['channel'], "Failure in file creation")
@@ -122,8 +186,7 @@ def delete_drive_file(msg_writer, event, wit_entities, credentials):
         state = WaitState(build_uuid=state_id, intent_value='delete-drive-file', event=event,
                           wit_entities=wit_entities, credentials=credentials)
         return state
-    http = current_creds.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
+    service = get_service('drive', 'v3', current_creds, user=event['user'])
 
     try:
         desired_file_name = get_highest_confidence_entity(wit_entities, 'randomize_option')['value']
@@ -131,24 +194,17 @@ def delete_drive_file(msg_writer, event, wit_entities, credentials):
         msg_writer.send_message(event['channel'], "I don't know what file you're talking about")
         return
 
-    files = service.files().list().execute()['files']
-    file_names = [x['name'] for x in files]
-    likely_file = process.extractOne(desired_file_name, file_names)
+    likely_file = find_file(event['user'], service, desired_file_name)  # Only files scoring at least 75
 
-    if likely_file and likely_file[1] >= 75:  # Arbitrary probability cutoff
-        file_id = get_id_from_name(files, likely_file[0])
+    if likely_file:
+        file_id = likely_file[1]
 
         try:
             service.files().delete(fileId=file_id).execute()
+            forget_file(event['user'], file_id)
             msg_writer.send_message(event['channel'], "{} deleted".format(likely_file[0]))
         except errors.HttpError:
             msg_writer.send_message(event['channel'], "I can't delete that file")
 
     else:
         msg_writer.send_message(event['channel'], "No file found with that name, sorry")
-
-
-def get_id_from_name(files, file_name):
-    for f in files:
-        if f['name'] == file_name:
-            return f['id']
\ No newline at end of file
@@ -0,0 +1,316 @@
+import logging
+import os
+import threading
+import time
+from intenthandlers.utils import TTLCache
+from threads import WarmUpThread
+from intenthandlers.fuzzy_index import FuzzyNameIndex, MATCH_THRESHOLD
+from fuzzywuzzy import utils
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# The only file fields the bot reads, requested as the fields projection of every listing
+FILE_FIELDS = 'id, name, mimeType, modifiedTime'
+LIST_FIELDS = 'nextPageToken, files({})'.format(FILE_FIELDS)
+CHANGE_FIELDS = 'nextPageToken, newStartPageToken, changes(fileId, removed, file({}, trashed))'.format(FILE_FIELDS)
+PAGE_SIZE = 1000  # The most Drive returns per page
+SEARCH_PAGE_SIZE = 100
+
+
+def slim_file(drive_file):
+    return {field: drive_file[field] for field in ('id', 'name', 'mimeType', 'modifiedTime') if field in drive_file}
+
+
+class DriveIndex(object):
+    """
+    A DriveIndex is a local copy of the listing of one user's drive. It is seeded with a full, paginated listing, and
+    then brought up to date by reading the drive's changes feed from where the last sync left off, so a lookup needs
+    at most one small changes request rather than a full listing. The bot's own creates and deletes are written
+    through to it.
+    """
+    def __init__(self, sync_interval=None, clock=time.monotonic):
+        """
+        :param sync_interval: Seconds for which the index is used without asking Drive for changes, defaults to the
+        DRIVE_SYNC_INTERVAL env var, or 30
+        """
+        self.sync_interval = sync_interval if sync_interval is not None else \
+            float(os.getenv("DRIVE_SYNC_INTERVAL") or 30)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # Held while talking to Drive, so one thread syncs at a time
+        self._files = {}  # file id -> slim file
+        self._names = FuzzyNameIndex()  # file names, keyed by file id
+        self._page_token = None  # Where the changes feed was last read up to. None until seeded
+        self._synced_at = None
+
+    def is_seeded(self):
+        return self._page_token is not None
+
+    def refresh(self, service):
+        """
+        Seeds the index, or reads the changes made since the last sync, unless it was synced within sync_interval
+        :param service: A drive v3 service for the index's user
+        :return: The index
+        """
+        with self._sync_lock:
+            if self._synced_at is not None and self._clock() - self._synced_at < self.sync_interval:
+                return self
+            if self.is_seeded():
+                self.sync(service)
+            else:
+                self.seed(service)
+            self._synced_at = self._clock()
+        return self
+
+    def seed(self, service):
+        """
+        Replaces the index with a full listing of the drive
+        """
+        for _ in self._seed_pages(service):
+            pass
+
+    def seeding_pages(self, service):
+        """
+        Seeds the index from a full listing of the drive, yielding each page as it arrives, so that a listing can be
+        sent from the same pages. The index only takes the files once every page has been read. If another thread is
+        already seeding or syncing the index, the drive is just listed.
+        :return: A generator of lists of files, in name order
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            for page in iter_pages(service):
+                yield page
+            return
+        try:
+            for page in self._seed_pages(service):
+                yield page
+            self._synced_at = self._clock()
+        finally:
+            self._sync_lock.release()
+
+    def _seed_pages(self, service):
+        started = time.monotonic()
+        # Take the token before listing, so that changes made while listing are read by the next sync
+        page_token = service.changes().getStartPageToken().execute()['startPageToken']
+        files = {}
+        names = FuzzyNameIndex()
+        for page in iter_pages(service):
+            for drive_file in page:
+                files[drive_file['id']] = drive_file
+                names.add(drive_file['id'], drive_file['name'])
+            yield page
+        with self._lock:
+            self._files = files
+            self._names = names
+            self._page_token = page_token
+        metrics.histogram('drive_index.seed_seconds').observe(time.monotonic() - started)
+        logger.info("Seeded drive index with {} files".format(len(files)))
+
+    def sync(self, service):
+        """
+        Applies every change made since the last sync
+        """
+        started = time.monotonic()
+        page_token = self._page_token
+        applied = 0
+        while page_token is not None:
+            resp = service.changes().list(pageToken=page_token, pageSize=PAGE_SIZE, fields=CHANGE_FIELDS).execute()
+            with self._lock:
+                for change in resp.get('changes', []):
+                    self._apply_change(change)
+                    applied += 1
+                if resp.get('newStartPageToken'):
+                    # The end of the feed, resume from here next time
+                    self._page_token = resp['newStartPageToken']
+                    page_token = None
+                else:
+                    page_token = resp.get('nextPageToken')
+        metrics.histogram('drive_index.sync_seconds').observe(time.monotonic() - started)
+        metrics.counter('drive_index.changes_applied').inc(applied)
+
+    def _apply_change(self, change):
+        # Must be called with the lock held
+        drive_file = change.get('file')
+        if change.get('removed') or drive_file is None or drive_file.get('trashed'):
+            self._remove(change['fileId'])
+        else:
+            self._add(drive_file)
+
+    def _add(self, drive_file):
+        # Must be called with the lock held
+        self._files[drive_file['id']] = slim_file(drive_file)
+        self._names.add(drive_file['id'], drive_file['name'])
+
+    def _remove(self, file_id):
+        # Must be called with the lock held
+        self._files.pop(file_id, None)
+        self._names.remove(file_id)
+
+    def add(self, drive_file):
+        """
+        Writes a file the bot created through to the index
+        """
+        with self._lock:
+            self._add(drive_file)
+
+    def remove(self, file_id):
+        """
+        Writes a file the bot deleted through to the index
+        """
+        with self._lock:
+            self._remove(file_id)
+
+    def get(self, file_id):
+        return self._files.get(file_id)
+
+    def find(self, name, threshold=MATCH_THRESHOLD):
+        """
+        :param name: A file name, as the user typed it
+        :return: The (name, file id, score) of the file whose name is closest to name, or None if no file's name
+        scores at least threshold
+        """
+        return self._names.best_match(name, threshold)
+
+    def files(self):
+        """
+        :return: Every file in the drive, sorted by name, ignoring case
+        """
+        with self._lock:
+            files = list(self._files.values())
+        return sorted(files, key=lambda drive_file: drive_file.get('name', '').lower())
+
+    def __len__(self):
+        return len(self._files)
+
+
+# Indexes are dropped when unused for long, and reseeded from scratch once a day as a check on drift
+_indexes = TTLCache(maxsize=int(os.getenv("DRIVE_INDEX_USERS") or 256),
+                    ttl=int(os.getenv("DRIVE_INDEX_TTL") or 86400),
+                    name='drive_index.indexes')
+_indexes_lock = threading.Lock()
+
+
+def name_query(name):
+    """
+    :param name: A file name, as the user typed it
+    :return: A Drive files.list query for files whose names contain all of its words, or None if it has no words
+    long enough to search for
+    """
+    words = [word for word in utils.full_process(name).split() if len(word) >= 3]
+    if not words:
+        return None
+    # full_process leaves only letters and digits, so the words need no escaping inside quotes
+    clauses = ["name contains '{}'".format(word) for word in words]
+    return "{} and trashed = false".format(' and '.join(clauses))
+
+
+def search_by_name(service, name, threshold=MATCH_THRESHOLD):
+    """
+    Asks Drive for the files whose names contain the words of name, fetching only their ids and names, and ranks those
+    :return: The best (name, file id, score), or None if Drive found nothing scoring at least threshold
+    """
+    query = name_query(name)
+    if query is None:
+        return None
+    started = time.monotonic()
+    resp = service.files().list(q=query, pageSize=SEARCH_PAGE_SIZE, fields='files(id, name)').execute()
+    metrics.histogram('drive_index.search_seconds').observe(time.monotonic() - started)
+    names = FuzzyNameIndex()
+    for drive_file in resp.get('files', []):
+        names.add(drive_file['id'], drive_file['name'])
+    return names.best_match(name, threshold)
+
+
+def find_file(user, service, name, threshold=MATCH_THRESHOLD):
+    """
+    Finds the user's file whose name is closest to name. While the user's index is unseeded, Drive is searched
+    first, so a lookup doesn't wait for a full listing; the index is only seeded and searched if that finds nothing.
+    :return: The best (name, file id, score), or None if no file scores at least threshold
+    """
+    index = _indexes.get(user)
+    if index is None or not index.is_seeded():
+        match = search_by_name(service, name, threshold)
+        if match is not None:
+            metrics.counter('drive_index.search_hits').inc()
+            return match
+        metrics.counter('drive_index.search_misses').inc()
+    return get_drive_index(user, service).find(name, threshold)
+
+
+def iter_pages(service, page_size=PAGE_SIZE):
+    """
+    Lists the drive a page at a time, in name order, so the caller can use each page as soon as it arrives
+    :return: A generator of lists of files
+    """
+    request_kwargs = {'pageSize': page_size, 'fields': LIST_FIELDS, 'q': 'trashed = false', 'orderBy': 'name'}
+    while True:
+        resp = service.files().list(**request_kwargs).execute()
+        yield [slim_file(drive_file) for drive_file in resp.get('files', [])]
+        if not resp.get('nextPageToken'):
+            return
+        request_kwargs['pageToken'] = resp['nextPageToken']
+
+
+def listing_pages(user, service):
+    """
+    :return: The user's files, as a generator of lists in name order: from their index if it is seeded, otherwise
+    straight from Drive, seeding the index with the same pages, so that a first listing doesn't wait for the whole
+    drive to be indexed. If the listing stops early, the rest of the drive is read into the index in the background
+    """
+    index = _index_for(user)
+    if index.is_seeded():
+        yield index.refresh(service).files()
+        return
+    pages = index.seeding_pages(service)
+    finished = False
+    try:
+        for page in pages:
+            yield page
+        finished = True
+    finally:
+        if not finished:
+            WarmUpThread(_read_all, pages, name='DriveSeedThread').start()
+
+
+def _read_all(pages):
+    for _ in pages:
+        pass
+
+
+def remember_file(user, drive_file):
+    """
+    Writes a file the bot created through to the user's index, if they have one
+    """
+    index = _indexes.get(user)
+    if index is not None:
+        index.add(drive_file)
+
+
+def forget_file(user, file_id):
+    """
+    Writes a file the bot deleted through to the user's index, if they have one
+    """
+    index = _indexes.get(user)
+    if index is not None:
+        index.remove(file_id)
+
+
+def get_drive_index(user, service):
+    """
+    :param user: The slack id of the user whose drive it is
+    :param service: A drive v3 service for the user
+    :return: The user's DriveIndex, brought up to date
+    """
+    return _index_for(user).refresh(service)
+
+
+def _index_for(user):
+    """
+    :return: The user's DriveIndex, created unseeded if they have none
+    """
+    with _indexes_lock:
+        index = _indexes.get(user)
+        if index is None:
+            index = DriveIndex()
+            _indexes.put(user, index)
+    return index
@@ -0,0 +1,110 @@
+import heapq
+import threading
+from collections import defaultdict
+from fuzzywuzzy import fuzz, utils
+
+# The score, out of 100, a name must reach to count as a match, as used with process.extractOne before
+MATCH_THRESHOLD = 75
+
+# How many of the names sharing the most trigrams with a query are rescored
+CANDIDATES = 64
+
+
+def trigrams(processed):
+    """
+    :param processed: A name, as processed by fuzzywuzzy's full_process
+    :return: The set of three character substrings of each word, padded so short words have trigrams too
+    """
+    grams = set()
+    for word in processed.split():
+        padded = ' ' + word + ' '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class FuzzyNameIndex(object):
+    """
+    A FuzzyNameIndex finds the names closest to a query without scoring every name. Names are indexed by their
+    trigrams; a search counts, for each name, the trigrams it shares with the query, and then rescores only the names
+    sharing the most with fuzzywuzzy's WRatio, the scorer process.extractOne uses. Scores, and so the match threshold,
+    mean the same as they did with extractOne.
+    """
+    def __init__(self, candidates=CANDIDATES):
+        self.candidates = candidates
+        self._lock = threading.Lock()
+        self._names = {}  # key -> (name, processed name)
+        self._gram_counts = {}  # key -> how many trigrams the name has
+        self._postings = defaultdict(set)  # trigram -> keys of the names containing it
+
+    def add(self, key, name):
+        """
+        :param key: Identifies the name, e.g. a file id. Adding an existing key replaces its name
+        """
+        processed = utils.full_process(name, force_ascii=True)
+        with self._lock:
+            self._remove(key)
+            self._names[key] = (name, processed)
+            grams = trigrams(processed)
+            self._gram_counts[key] = len(grams)
+            for gram in grams:
+                self._postings[gram].add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        # Must be called with the lock held
+        old = self._names.pop(key, None)
+        if old is None:
+            return
+        del self._gram_counts[key]
+        for gram in trigrams(old[1]):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+
+    def search(self, query, limit=1, threshold=MATCH_THRESHOLD):
+        """
+        :param query: The name as the user typed it
+        :param limit: How many matches to return
+        :param threshold: The lowest score a match may have
+        :return: Up to limit (name, key, score) tuples, best first, each scoring at least threshold
+        """
+        processed = utils.full_process(query, force_ascii=True)
+        if not processed:
+            return []
+        with self._lock:
+            if len(self._names) <= self.candidates:
+                # Small enough to score everything, exactly as extractOne would
+                candidates = list(self._names.items())
+            else:
+                query_grams = trigrams(processed)
+                shared = defaultdict(int)
+                for gram in query_grams:
+                    for key in self._postings.get(gram, ()):
+                        shared[key] += 1
+                # Rank by Dice similarity, which like WRatio favours names of about the query's length
+                gram_counts = self._gram_counts
+                best = heapq.nlargest(self.candidates, shared.items(),
+                                      key=lambda item: item[1] / (len(query_grams) + gram_counts[item[0]]))
+                candidates = [(key, self._names[key]) for key, _ in best]
+
+        scored = []
+        for key, (name, processed_name) in candidates:
+            score = fuzz.WRatio(processed, processed_name)
+            if score >= threshold:
+                scored.append((name, key, score))
+        return heapq.nlargest(limit, scored, key=lambda match: match[2])
+
+    def best_match(self, query, threshold=MATCH_THRESHOLD):
+        """
+        :return: The best (name, key, score), or None if nothing scores at least threshold
+        """
+        matches = self.search(query, limit=1, threshold=threshold)
+        return matches[0] if matches else None
+
+    def __len__(self):
+        return len(self._names)
@@ -1,34 +1,44 @@
 import logging
-import httplib2
+import os
+from collections import OrderedDict
 from uuid import uuid4
-from state import WaitState
-from apiclient import discovery
-from intenthandlers.utils import get_highest_confidence_entity, CallOnce
+from state import WaitState, ReplyState
+from intenthandlers.google_services import get_service
+from intenthandlers.utils import get_highest_confidence_entity, RefreshingCache
+import metrics
 
 logger = logging.getLogger(__name__)
 
+SPREADSHEET_ID = "14Sl7L5r5R1OLX9FmY4yZABsSD4b8GuX0uC8btlSl1cM"
+# Every range the stats are read from, fetched together in one batchGet
+STATS_RANGES = ['Count by office!Gala_Count']
+
+# Seconds for which office counts are answered from memory before being re-read in the background
+REFRESH_INTERVAL = float(os.getenv("GALASTATS_REFRESH_INTERVAL") or 900)
+
+# We need to find a geocoding service for this so we don't need to hardcode
+LOCATION_NORMALIZATION = {
+    "london": "LN",
+    "england": "LN",
+    "britain": "LN",
+    "great britain": "LN",
+    "uk": "LN",
+    "boston": "MA",
+    "somerville": "MA",
+    "davis": "MA",
+    "davis square": "MA",
+    "davis sq": "MA",
+    "massachusetts": "MA",
+    "mass": "MA",
+    "tampa": "FL",
+    "florida": "FL"
+}
+OFFICE_CODES = set(LOCATION_NORMALIZATION.values())
+
 
 # added ghce=get_highest_confidence_entity to allow for testing with alternate GHCE
 def count_galateans(msg_writer, event, wit_entities, credentials, ghce=get_highest_confidence_entity):
 
-    # We need to find a geocoding service for this so we don't need to hardcode
-    location_normalization = {
-        "london": "LN",
-        "england": "LN",
-        "britain": "LN",
-        "great britain": "LN",
-        "uk": "LN",
-        "boston": "MA",
-        "somerville": "MA",
-        "davis": "MA",
-        "davis square": "MA",
-        "davis sq": "MA",
-        "massachusetts": "MA",
-        "mass": "MA",
-        "tampa": "FL",
-        "florida": "FL"
-    }
-
     # Find the location with the highest confidence that met our default threshold
     loc_entity = ghce(wit_entities, 'location')
     if loc_entity is not None:
@@ -38,46 +48,103 @@ def count_galateans(msg_writer, event, wit_entities, credentials, ghce=get_highe
 
     # We need to normalize the location since wit doesn't do that for us
     # Need to use a geocode service for this instead of our hack
-    normalized_loc = location_normalization.get(loc, "all")  # should we return all if we get a valid location,
+    normalized_loc = LOCATION_NORMALIZATION.get(loc, "all")  # should we return all if we get a valid location,
                                                              # but where we have no office?
-    state_id = uuid4()
-    current_creds = credentials.get_credential(event, state_id, user=event['user'])
+    # The counts are the same whoever asks, so they are read as DEFAULT_USER once they have authorized the bot
+    user = credentials.default_user
+    current_creds = credentials.service_credential()
     if current_creds is None:
-        state = WaitState(build_uuid=state_id, intent_value='galatean-count', event=event,
-                          wit_entities=wit_entities, credentials=credentials)
-        return state
-    location_totals = get_galateans(current_creds)
+        state_id = uuid4()
+        user = event['user']
+        current_creds = credentials.get_credential(event, state_id, user=user)
+        if current_creds is None:
+            state = WaitState(build_uuid=state_id, intent_value='galatean-count', event=event,
+                              wit_entities=wit_entities, credentials=credentials)
+            return state
+    location_totals = get_galateans(current_creds, user)
     text = "*Office | Count*"
     if normalized_loc == "all":
         for office in location_totals:
             text += "\n" + office + "             " + location_totals[office]
-    else:
-        if normalized_loc == "LN":
-            text += "\nLN             " + location_totals['LN']
-        elif normalized_loc == "MA":
-            text += "\nMA             " + location_totals['MA']
-        elif normalized_loc == "FL":
-            text += "\nFL             " + location_totals['FL']
-    msg_writer.send_message(event['channel'], "Count of Galateans\n" + text)
+    elif normalized_loc in location_totals:
+        text += "\n" + normalized_loc + "             " + location_totals[normalized_loc]
+    # Posted once delivered, so that a retry after a timeout doesn't post the counts twice
+    return ReplyState(channel=event['channel'], text="Count of Galateans\n" + text)
+
+
+def office_code(label):
+    """
+    :param label: The first cell of a Gala_Count row
+    :return: The office code it names, or None
+    """
+    label = label.strip()
+    if label.upper() in OFFICE_CODES:
+        return label.upper()
+    return LOCATION_NORMALIZATION.get(label.lower())
+
+
+def parse_office_counts(rows):
+    """
+    :param rows: The rows of Gala_Count, each an office followed by its count
+    :return: An OrderedDict of office code -> count, in the sheet's order. Rows whose label isn't an office code or
+    known location, e.g. a total, are skipped
+    """
+    table = OrderedDict()
+    for row in rows:
+        if len(row) < 2:
+            continue
+        code = office_code(row[0])
+        if code is None:
+            logger.warning("Skipping unknown office {} in office counts".format(row[0]))
+            continue
+        table[code] = row[1]
+    return table
+
+
+class OfficeStatsLoader(object):
+    """
+    An OfficeStatsLoader reads the office counts, but first asks Drive for the spreadsheet's version, and only
+    downloads the values when that has changed since the last read. All of STATS_RANGES are read in one batchGet.
+    """
+    def __init__(self, spreadsheet_id=SPREADSHEET_ID, ranges=STATS_RANGES):
+        self.spreadsheet_id = spreadsheet_id
+        self.ranges = ranges
+        self._version = None
+        self._table = None
+        self._checks = metrics.counter('galastats.version_checks')
+        self._downloads = metrics.counter('galastats.downloads')
+
+    def __call__(self, current_creds, user=None):
+        """
+        :return: an OrderedDict of office code -> count of galateans at that office
+        """
+        drive = get_service('drive', 'v3', current_creds, user=user)
+        metadata = drive.files().get(fileId=self.spreadsheet_id, fields='version, modifiedTime').execute()
+        self._checks.inc()
+        if self._table is not None and metadata.get('version') == self._version:
+            return self._table
+
+        sheets = get_service('sheets', 'v4', current_creds, user=user)
+        result = sheets.spreadsheets().values().batchGet(spreadsheetId=self.spreadsheet_id, ranges=self.ranges,
+                                                          majorDimension='ROWS').execute()
+        self._downloads.inc()
+        rows = []
+        for value_range in result.get('valueRanges', []):
+            rows.extend(value_range.get('values', []))
+        self._table = parse_office_counts(rows)
+        self._version = metadata.get('version')
+        logger.info("Read office counts, spreadsheet modified {}".format(metadata.get('modifiedTime')))
+        return self._table
+
+
+load_galateans = OfficeStatsLoader()
+office_counts = RefreshingCache(load_galateans, REFRESH_INTERVAL, name='galastats.office_counts')
 
 
-@CallOnce
-def get_galateans(current_creds):
+def get_galateans(current_creds, user=None):
     """
-    This function is only actually called once, any subsequent calls will always return the same result
+    Only the first call waits on the spreadsheet. Later calls answer from memory, and re-read it in the background
+    with their credentials once the counts are older than REFRESH_INTERVAL
     :return: an object representing the count of galateans at our various offices
     """
-    http = current_creds.authorize(httplib2.Http())
-    discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                    'version=v4')
-    service = discovery.build('sheets', 'v4', http=http, discoveryServiceUrl=discoveryUrl)
-    spreadsheetId = "14Sl7L5r5R1OLX9FmY4yZABsSD4b8GuX0uC8btlSl1cM"
-    rangeName = 'Count by office!Gala_Count'
-    result = service.spreadsheets().values().get(spreadsheetId=spreadsheetId, range=rangeName).execute()
-    values = result.get('values', [])
-    offices = {
-        "LN": values[1][1],
-        "FL": values[0][1],
-        "MA": values[2][1]
-    }
-    return offices
+    return office_counts.get(current_creds, user)
@@ -1,10 +1,10 @@
 import os
 import logging
 import json
-import httplib2
 import base64
 import re
 import uuid
+import httplib2
 from uuid import uuid4
 from email.mime.text import MIMEText
 from state import WaitState
@@ -12,7 +12,10 @@ from intenthandlers.utils import get_highest_confidence_entity
 from cryptography.fernet import Fernet, InvalidToken
 from oauth2client import client
 from slack_clients import is_direct_message
-from apiclient import discovery
+from threads import PRIORITY_AUTH, TokenRefresher
+from intenthandlers.google_services import get_service
+from intenthandlers.credential_store import default_store
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -25,19 +28,53 @@ class GoogleCredentials(object):
     GoogleCredentials creates and holds credential objects used with Google OAuth. In addition, it handles encrypting
     and decrypting state uuids as they are passed through the Google environment
     """
-    def __init__(self, msg_writer, slack_client):
+    def __init__(self, msg_writer, slack_client, store=None):
+        """
+        :param store: Where users' credentials are kept, defaults to the store credential_store.default_store picks
+        """
         self.msg_writer = msg_writer
         self.slack_client = slack_client
-        self.default_user = slack_client.get_id_from_user_name(os.getenv("DEFAULT_USER", ""))
+        self._default_user = None
         # The following two lines are used to typecast the string env variable to a base64 accepted by Fernet
         b_key = base64.urlsafe_b64decode(os.getenv('FERNET_KEY', ""))
         key = base64.urlsafe_b64encode(b_key)
         logger.info("Fernet Key {}".format(key))
+        self.crypt = None
         try:
             self.crypt = Fernet(key)
         except ValueError:
             logger.error("Null decryption key given")
-        self._credentials_dict = {}
+        self.store = store if store is not None else default_store(self.crypt)
+        # Keeps the access token of each user fresh from their first command on, so later ones don't wait on a token
+        # exchange. Users are tracked as their credentials are looked up or added, not all at start up
+        self.refresher = TokenRefresher(refresh_credentials)
+        self.refresher.start()
+
+    @property
+    def default_user(self):
+        """
+        The slack id of DEFAULT_USER, or None if it is unset or names no one. Looked up on first use, as the user
+        directory is still loading at start up, and without waiting for it to finish, so commands are never held up
+        """
+        if self._default_user is None:
+            name = os.getenv("DEFAULT_USER", "")
+            user = self.slack_client.users.find_by_name(name) if name else None
+            if user is None:
+                logger.warning("DEFAULT_USER {!r} is not a known user".format(name))
+                return None
+            self._default_user = user['id']
+        return self._default_user
+
+    def service_credential(self):
+        """
+        The credentials of DEFAULT_USER, for reading shared data which doesn't depend on who is asking. Never starts
+        the credentialing process
+        :return: a credentials object, or None if DEFAULT_USER has not authorized the bot
+        """
+        user = self.default_user
+        if user is None:
+            return None
+        return self.store.get(user)
 
     def get_credential(self, event, state_id, user=None):
         """
@@ -47,10 +84,23 @@ class GoogleCredentials(object):
         if user is None:
             user = self.default_user
         try:
-            if self._credentials_dict[user].access_token_expired:
-                raise GoogleAccessError
-            return self._credentials_dict[user]
-        except KeyError or GoogleAccessError:
+            credentials = self.store.get(user)
+            if credentials is None:
+                raise KeyError(user)
+            if credentials.access_token_expired:
+                # Only when the background refresh failed or fell behind
+                logger.warning("Token for {} expired before it was refreshed".format(user))
+                metrics.counter('token_refresh.inline').inc()
+                try:
+                    refresh_credentials(credentials)
+                except (client.Error, httplib2.HttpLib2Error, OSError) as e:
+                    raise GoogleAccessError(e)
+                self.refresher.track(user, credentials)
+            elif user not in self.refresher:
+                # The user's first command since start up, or credentials which can't be refreshed
+                self.refresher.track(user, credentials)
+            return credentials
+        except (KeyError, GoogleAccessError):
             # create and encrypt state
             state = {'state_id': str(state_id.hex), 'user_id': user}
             encrypted_state = self.crypt.encrypt(json.dumps(state).encode('utf-8'))
@@ -68,7 +118,8 @@ class GoogleCredentials(object):
                 self.msg_writer.send_message(event['channel'],
                                              "I'll send you the authorization link in a direct message")
             channel = event['user_dm']
-            self.msg_writer.send_message_with_attachments(channel, "Authorization Link", [{'text': "<{}|Click here to authorize>".format(auth_uri)}])
+            self.msg_writer.send_message_with_attachments(channel, "Authorization Link", [{'text': "<{}|Click here to authorize>".format(auth_uri)}],
+                                                          priority=PRIORITY_AUTH)
             return None
 
     # This function feels really janky
@@ -76,7 +127,7 @@ class GoogleCredentials(object):
         """
         :param credentials: an actual credentials object as returned by flow.step2_exchange from the oauth library
         :param state: An encrypted string representing a slack user ID and a WaitState UUID.
-        NOTE: this has the major, and important side effect, of storing the user's credentials in the credentials dict
+        NOTE: this has the major, and important side effect, of storing the user's credentials in the credential store
         :return: the UUID representing the WaitState
         """
         try:
@@ -87,7 +138,8 @@ class GoogleCredentials(object):
 
         state_json = json.loads(raw_string.decode('ascii'))
         user_id = state_json.get('user_id')
-        self._credentials_dict.update({user_id: credentials})
+        self.store.put(user_id, credentials)
+        self.refresher.track(user_id, credentials)
 
         return uuid.UUID(state_json.get('state_id'))
 
@@ -103,6 +155,14 @@ class GoogleCredentials(object):
         return uuid.UUID(state_json.get('state_id'))
 
 
+def refresh_credentials(credentials):
+    """
+    Exchanges the credentials' refresh token for a new access token. oauth2client saves the result to the credentials'
+    store
+    """
+    credentials.refresh(httplib2.Http())
+
+
 def send_email(msg_writer, event, wit_entities, credentials):
     """
     :param msg_writer: A message writer used to write output to slack
@@ -118,8 +178,7 @@ def send_email(msg_writer, event, wit_entities, credentials):
         state = WaitState(build_uuid=state_id, intent_value='send-email', event=event,
                           wit_entities=wit_entities, credentials=credentials)
         return state
-    http = current_creds.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
+    service = get_service('gmail', 'v1', current_creds, user=event['user'])
 
     msg_text = event['cleaned_text']
     email_string = "<mailto:.*@.*\..*\|.*@.*\..*>"  # matches <mailto:example@sample.com|example@sample.com>
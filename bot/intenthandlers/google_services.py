@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import httplib2
+from apiclient import discovery
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pinned discovery documents, named <api>.<version>.json. refresh_discovery.py updates them
+DISCOVERY_DIR = os.getenv("GOOGLE_DISCOVERY_DIR") or \
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'discovery')
+
+# Where each pinned discovery document is fetched from
+DISCOVERY_URLS = {
+    ('drive', 'v3'): 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest',
+    ('gmail', 'v1'): 'https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest',
+    ('sheets', 'v4'): 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+}
+
+_documents = {}  # (api, version) -> pinned discovery document, read on first use
+_documents_lock = threading.Lock()
+
+
+def discovery_document_path(api, version):
+    return os.path.join(DISCOVERY_DIR, '{}.{}.json'.format(api, version))
+
+
+def pinned_document(api, version):
+    """
+    :return: The pinned discovery document for the api, as a JSON string, or None if none is pinned
+    """
+    with _documents_lock:
+        if (api, version) not in _documents:
+            path = discovery_document_path(api, version)
+            try:
+                with open(path) as document_file:
+                    _documents[(api, version)] = document_file.read()
+            except IOError:
+                _documents[(api, version)] = None
+        return _documents[(api, version)]
+
+
+def build_service(api, version, http, **build_kwargs):
+    """
+    Builds a service from its pinned discovery document, which needs no network access. Falls back to fetching the
+    discovery document when none is pinned, or the pinned one can't be used.
+    :param build_kwargs: Passed on to discovery.build when falling back
+    """
+    document = pinned_document(api, version)
+    if document is not None:
+        try:
+            return discovery.build_from_document(document, http=http)
+        except ValueError as e:
+            logger.error("Pinned discovery document for {} {} is unusable: {}".format(api, version, e))
+    else:
+        logger.warning("No pinned discovery document for {} {}, fetching it".format(api, version))
+    metrics.counter('google_services.discovery_fetches').inc()
+    return discovery.build(api, version, http=http, **build_kwargs)
+
+
+class LockedHttp(object):
+    """
+    httplib2.Http is not thread safe, so a LockedHttp makes one authorized Http safe to share between the threads
+    handling a user's commands, by letting one request through at a time. Anything else is passed to the wrapped Http.
+    """
+    def __init__(self, http):
+        self._http = http
+        self._lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._lock:
+            return self._http.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+
+class _ServiceEntry(object):
+    def __init__(self):
+        self.lock = threading.Lock()  # Held while building, so concurrent first calls build once
+        self.credentials = None
+        self.service = None
+
+
+class GoogleServiceRegistry(object):
+    """
+    A GoogleServiceRegistry holds built Google API service objects, keyed by (api, version, user), so that a command
+    reuses the discovery document and the open connections of the last command rather than building a new service.
+    The least recently used services are dropped once there are more than maxsize, and a service is rebuilt when the
+    user's credentials object changes, e.g. after they authorize again.
+    """
+    def __init__(self, maxsize=None, build=build_service):
+        """
+        :param maxsize: How many services to keep, defaults to the GOOGLE_SERVICE_CACHE_SIZE env var, or 64
+        :param build: Builds a service, called as build(api, version, http=http, **kwargs)
+        """
+        self.maxsize = maxsize or int(os.getenv("GOOGLE_SERVICE_CACHE_SIZE") or 64)
+        self._build = build
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (api, version, user) -> _ServiceEntry, least recently used first
+        self._hits = metrics.counter('google_services.hits')
+        self._misses = metrics.counter('google_services.misses')
+        self._build_time = metrics.histogram('google_services.build_seconds')
+        metrics.gauge('google_services.size', lambda: len(self._entries))
+
+    def get(self, api, version, credentials, user=None, **build_kwargs):
+        """
+        :param api: e.g. 'drive'
+        :param version: e.g. 'v3'
+        :param credentials: The oauth2client credentials to authorize the service with
+        :param user: The slack id of the user the credentials belong to
+        :param build_kwargs: Passed on to discovery.build when the service has to be built
+        :return: A service object, which may be shared with other threads handling the same user's commands
+        """
+        key = (api, version, user)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _ServiceEntry()
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+
+        with entry.lock:
+            if entry.service is not None and entry.credentials is credentials:
+                self._hits.inc()
+                return entry.service
+            self._misses.inc()
+            started = time.monotonic()
+            http = LockedHttp(credentials.authorize(httplib2.Http()))
+            entry.service = self._build(api, version, http=http, **build_kwargs)
+            entry.credentials = credentials
+            self._build_time.observe(time.monotonic() - started)
+            logger.info("Built {} {} service for {}".format(api, version, user))
+            return entry.service
+
+    def invalidate(self, user):
+        """
+        Drops every service built for user, e.g. when their credentials are revoked
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[2] == user]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+registry = GoogleServiceRegistry()
+
+
+def get_service(api, version, credentials, user=None, **build_kwargs):
+    """
+    :return: A shared service object from the module's GoogleServiceRegistry, see GoogleServiceRegistry.get
+    """
+    return registry.get(api, version, credentials, user=user, **build_kwargs)
@@ -1,7 +1,11 @@
 import logging
 import collections
 import functools
+import threading
 import time
+import weakref
+import metrics
+from threads import WarmUpThread
 
 logger = logging.getLogger(__name__)
 
@@ -30,64 +34,240 @@ def get_highest_confidence_entity(entities_dict, entity_name, confidence_thresho
     return highest_confidence_entity
 
 
-# Copied from Python Decorator Library
-# https://wiki.python.org/moin/PythonDecoratorLibrary
-class memoized(object):
-    """Decorator. Caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned
-    (not reevaluated).
+class cached(object):
+    """Decorator for instance methods. Caches return values in a size and ttl bounded
+    TTLCache, kept on the instance rather than keyed on self, so that caches are dropped
+    along with their instance. Values for which is_negative(value) is true, such as failed
+    lookups, are kept for negative_ttl seconds instead. Exceptions are never cached.
+
+    The decorated method gains invalidate(*args) and clear() for explicit invalidation, e.g.
+    self.get_user_name_from_id.invalidate(user_id)
     """
+    def __init__(self, maxsize=1024, ttl=3600, negative_ttl=60, is_negative=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative
+        self.func = None
+        self._lock = threading.Lock()
 
-    def __init__(self, func):
+    def __call__(self, func):
         self.func = func
-        self.cache = {}
+        self.attr_name = '_cached_{}'.format(func.__name__)
+        self.metric_name = '{}.{}'.format(func.__module__, func.__name__)
+        functools.update_wrapper(self, func)
+        return self
+
+    def cache_for(self, obj):
+        cache = obj.__dict__.get(self.attr_name)
+        if cache is None:
+            with self._lock:
+                cache = obj.__dict__.get(self.attr_name)
+                if cache is None:
+                    cache = TTLCache(maxsize=self.maxsize, ttl=self.ttl, name=self.metric_name)
+                    obj.__dict__[self.attr_name] = cache
+        return cache
+
+    def __get__(self, obj, objtype):
+        """Support instance methods."""
+        if obj is None:
+            return self
+        return _BoundCachedMethod(self, obj)
+
+
+class _BoundCachedMethod(object):
+    def __init__(self, decorator, obj):
+        self.decorator = decorator
+        self.obj = obj
+        self.cache = decorator.cache_for(obj)
+        self.__name__ = decorator.func.__name__
+        self.__doc__ = decorator.func.__doc__
 
     def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
+        try:
+            hash(args)
+        except TypeError:
             # uncacheable. a list, for instance.
             # better to not cache than blow up.
-            return self.func(*args)
+            return self.decorator.func(self.obj, *args)
 
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
+        value = self.cache.get(args, _MISSING)
+        if value is not _MISSING:
             return value
+        value = self.decorator.func(self.obj, *args)
+        if self.decorator.is_negative is not None and self.decorator.is_negative(value):
+            self.cache.put(args, value, ttl=self.decorator.negative_ttl)
+        else:
+            self.cache.put(args, value)
+        return value
+
+    def invalidate(self, *args):
+        self.cache.invalidate(args)
+
+    def clear(self):
+        self.cache.clear()
 
     def __repr__(self):
-        """Return the function's docstring."""
-        return self.func.__doc__
+        return '<cached method {} of {!r}>'.format(self.__name__, self.obj)
 
-    def __get__(self, obj, objtype):
-        """Support instance methods."""
-        return functools.partial(self.__call__, obj)
+
+_MISSING = object()
 
 
-class CallOnce(object):
-    """Decorator. Caches a functions return value the
-    first time it is called, and always returns that value for
-    every call in the future, irrespective of arguments
+class RefreshingCache(object):
     """
-    def __init__(self, func):
-        self.func = func
-        self.cache = None
+    A RefreshingCache holds the value of a function which is slow to call, e.g. one reading a spreadsheet. The first
+    get loads it, and concurrent first callers wait on that one load. Once the value is older than refresh_interval,
+    get still returns it at once, and reloads it in the background with the arguments it was called with; only one
+    reload runs at a time, and one that fails leaves the old value in place.
+    """
+    def __init__(self, load, refresh_interval, name=None, clock=time.monotonic, background=None):
+        """
+        :param load: Called as load(*args, **kwargs) with the arguments given to get
+        :param refresh_interval: Seconds after loading before the value is reloaded
+        :param background: Called as background(function, *args) to run a reload, defaults to a WarmUpThread
+        """
+        self._load = load
+        self.refresh_interval = refresh_interval
+        self.name = name or 'RefreshingCache'
+        self._clock = clock
+        self._background = background or self._start_thread
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # Held while loading, so there is only ever one load
+        self._value = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._hits = metrics.counter('{}.hits'.format(self.name))
+        self._stale_hits = metrics.counter('{}.stale_hits'.format(self.name))
+        self._load_failures = metrics.counter('{}.load_failures'.format(self.name))
+        self._load_time = metrics.histogram('{}.load_seconds'.format(self.name))
 
-    def __call__(self, *args, **kwargs):
-        if self.cache:
-            return self.cache
-        else:
-            value = self.func(*args, **kwargs)
-            self.cache = value
-            return value
+    def get(self, *args, **kwargs):
+        """
+        :return: The cached value, loading it first if there is none. Exceptions from a first load are raised here
+        """
+        with self._lock:
+            if self._loaded_at is not None:
+                if self._clock() - self._loaded_at < self.refresh_interval:
+                    self._hits.inc()
+                elif not self._refreshing:
+                    self._stale_hits.inc()
+                    self._refreshing = True
+                    self._background(self._refresh, args, kwargs)
+                else:
+                    self._stale_hits.inc()
+                return self._value
+        with self._load_lock:
+            if self._loaded_at is not None:
+                return self._value  # Loaded by another caller while we waited
+            return self._timed_load(args, kwargs)
 
-    def __repr__(self):
-        """Return the function's docstring."""
-        return self.func.__doc__
+    def _refresh(self, args, kwargs):
+        try:
+            with self._load_lock:
+                self._timed_load(args, kwargs)
+        except Exception as e:
+            self._load_failures.inc()
+            logger.error("Failed to refresh {}, keeping the old value: {}".format(self.name, e))
+        finally:
+            with self._lock:
+                self._refreshing = False
 
-    def __get__(self, obj, objtype):
-        """Support instance methods."""
-        return functools.partial(self.__call__, obj)
+    def _timed_load(self, args, kwargs):
+        # Must be called with the load lock held
+        started = self._clock()
+        value = self._load(*args, **kwargs)
+        with self._lock:
+            self._value = value
+            self._loaded_at = self._clock()
+        self._load_time.observe(self._loaded_at - started)
+        return value
+
+    def _start_thread(self, function, *args):
+        WarmUpThread(function, *args, name='{}.refresh'.format(self.name)).start()
+
+    def invalidate(self):
+        """
+        Drops the value, so the next get loads it again
+        """
+        with self._lock:
+            self._value = None
+            self._loaded_at = None
+
+
+class TTLCache(object):
+    """
+    A thread-safe, size bounded LRU cache whose entries also expire ttl seconds after they are stored. Keeps hit, miss
+    and eviction counts, which are published as gauges if the cache is given a name. The gauges only hold a weak
+    reference to the cache, so a named cache is still dropped along with whatever owns it.
+    """
+    def __init__(self, maxsize=1024, ttl=300, name=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (expiry time, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # removed to make room
+        self.expirations = 0  # removed because their ttl ran out
+        if name is not None:
+            cache = weakref.ref(self)
+            for stat in ('size', 'hits', 'misses', 'evictions', 'expirations', 'hit_rate'):
+                metrics.gauge('{}.{}'.format(name, stat), functools.partial(_cache_stat, cache, stat))
 
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
 
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
 
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hit_rate()
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _cache_stat(cache_ref, stat):
+    """
+    :return: One of a TTLCache's stats, or None once the cache has been dropped
+    """
+    cache = cache_ref()
+    return cache.stats()[stat] if cache is not None else None
@@ -1,25 +1,98 @@
+import asyncio
 import logging
+import os
 import random
+from threads import MessageCoalescer, PRIORITY_ERROR, PRIORITY_NORMAL
 
 logger = logging.getLogger(__name__)
 
 
 class Messenger(object):
-    def __init__(self, slack_clients):
+    def __init__(self, slack_clients, scheduler=None, coalesce_window=None):
+        """
+        :param slack_clients: SlackClients
+        :param scheduler: An OutboundScheduler which paces sends to within Slack's rate limits. Without one, messages
+        are sent as soon as they are written
+        :param coalesce_window: Seconds to wait for more messages to the same channel, so they can be sent as one.
+        Defaults to the MESSAGE_COALESCE_WINDOW_MS env var; 0, the default, sends each message on its own
+        """
         self.clients = slack_clients
+        self.scheduler = scheduler
+        self.loop = None
+        if coalesce_window is None:
+            coalesce_window = float(os.getenv("MESSAGE_COALESCE_WINDOW_MS") or 0) / 1000
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = MessageCoalescer(coalesce_window, self._send_coalesced)
+            self.coalescer.start()
 
-    def send_message_with_attachments(self, channel_id, msg, attachments):
+    def close(self):
+        """
+        Sends any messages still being held for coalescing
+        """
+        if self.coalescer is not None:
+            self.coalescer.join()
+
+    def attach_loop(self, loop):
+        """
+        :param loop: The asyncio loop which owns the RTM websocket
+        Once attached, websocket writes are handed to the loop instead of being made from the calling thread
+        """
+        self.loop = loop
+
+    def detach_loop(self):
+        self.loop = None
+
+    def _schedule(self, channel_id, priority, function, *args, **kwargs):
+        if self.scheduler is not None:
+            self.scheduler.submit(channel_id, priority, function, *args, **kwargs)
+        else:
+            function(*args, **kwargs)
+
+    def send_message_with_attachments(self, channel_id, msg, attachments, priority=PRIORITY_NORMAL):
         # Note: With attachments, attatchments must be a list of attachments, even if there is only one attachment
         # to attach, i.e. attachments=[{'text':'attachment_text'}], or the posting of attachments will fail silently.
         logger.debug('Sending msg: {} to channel: {}'.format(msg, channel_id))
-        self.clients.web.chat.post_message(channel_id, msg, attachments=attachments, as_user='true')
+        self._schedule(channel_id, priority, self.clients.web.chat.post_message,
+                       channel_id, msg, attachments=attachments, as_user='true')
 
-    def send_message(self, channel_id, msg):
+    def send_message(self, channel_id, msg, priority=PRIORITY_NORMAL):
+        """
+        Queues msg for channel_id. Never blocks on Slack's rate limits
+        :param priority: One of the outbound.PRIORITY_* classes. More urgent messages are sent first
+        """
         # in the case of Group and Private channels, RTM channel payload is a complex dictionary
         if isinstance(channel_id, dict):
             channel_id = channel_id['id']
         logger.debug('Sending msg: {} to channel: {}'.format(msg, channel_id))
+        if self.coalescer is not None:
+            self.coalescer.add(channel_id, "{}".format(msg), priority)
+        else:
+            self._schedule(channel_id, priority, self._send_now, channel_id, msg)
+
+    def _send_coalesced(self, channel_id, msg, priority):
+        self._schedule(channel_id, priority, self._send_now, channel_id, msg)
+
+    def _send_now(self, channel_id, msg):
+        loop = self.loop
+        if loop is not None:
+            future = asyncio.run_coroutine_threadsafe(self._send_on_loop(channel_id, msg), loop)
+            future.add_done_callback(self._log_send_failure)
+        else:
+            self._write_to_channel(channel_id, msg)
+
+    async def _send_on_loop(self, channel_id, msg):
+        self._write_to_channel(channel_id, msg)
+
+    @staticmethod
+    def _log_send_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Failed to send msg: {}'.format(future.exception()))
+
+    def _write_to_channel(self, channel_id, msg):
         channel = self.clients.rtm.server.channels.find(channel_id)
+        if channel is None:
+            raise LookupError("Unknown channel {}".format(channel_id))
         channel.send_message("{}".format(msg))
 
     def write_prompt(self, channel_id, handlers):
@@ -48,7 +121,7 @@ class Messenger(object):
 
     def write_error(self, channel_id, err_msg):
         txt = ":face_with_head_bandage: my maker didn't handle this error very well:\n>```{}```".format(err_msg)
-        self.send_message(channel_id, txt)
+        self.send_message(channel_id, txt, priority=PRIORITY_ERROR)
 
     def demo_attachment(self, channel_id):
         txt = "Beep Beep Boop is a ridiculously simple hosting platform for your Slackbots."
@@ -0,0 +1,175 @@
+import bisect
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets every histogram counts into
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter(object):
+    """
+    A Counter is a thread-safe, monotonically increasing count, e.g. of requests made or errors seen
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge(object):
+    """
+    A Gauge is a value that can go up and down, e.g. a queue depth. If it is given a function, the function is called
+    each time the gauge is read, which suits values that are cheaper to compute on demand than to keep updated.
+    """
+    def __init__(self, name, function=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._value = 0
+        self._function = function
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                logger.error("Failed to read gauge {}: {}".format(self.name, e))
+                return None
+        return self._value
+
+    def snapshot(self):
+        return self.value()
+
+
+class Histogram(object):
+    """
+    A Histogram counts observations (usually durations in seconds) into fixed buckets, and keeps a window of the most
+    recent observations so that percentiles can be reported
+    """
+    def __init__(self, name, buckets=DEFAULT_BUCKETS, window=1024):
+        self.name = name
+        self._lock = threading.Lock()
+        self._buckets = tuple(buckets)
+        self._bucket_counts = [0] * (len(self._buckets) + 1)  # The last bucket catches everything above the bounds
+        self._recent = deque(maxlen=window)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._recent.append(value)
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def count(self):
+        return self._count
+
+    def percentile(self, pct):
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return None
+        index = min(len(recent) - 1, int(round(pct / 100.0 * (len(recent) - 1))))
+        return recent[index]
+
+    def snapshot(self):
+        with self._lock:
+            buckets = dict(zip([str(b) for b in self._buckets] + ['+Inf'], self._bucket_counts))
+            count = self._count
+            total = self._sum
+            maximum = self._max
+        return {
+            'count': count,
+            'sum': total,
+            'max': maximum,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': buckets
+        }
+
+
+class Registry(object):
+    """
+    A Registry holds every named metric, so that all of them can be reported together. Asking for a metric that
+    already exists returns the existing one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, name, metric_type, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_type(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_type):
+                raise TypeError("Metric {} is already registered as a {}".format(name, type(metric).__name__))
+            return metric
+
+    def counter(self, name):
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name, function=None):
+        gauge = self._get_or_create(name, Gauge)
+        if function is not None:
+            gauge.set_function(function)
+        return gauge
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(name, Histogram, buckets)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+registry = Registry()
+
+
+def counter(name):
+    return registry.counter(name)
+
+
+def gauge(name, function=None):
+    return registry.gauge(name, function)
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS):
+    return registry.histogram(name, buckets)
+
+
+def snapshot():
+    return registry.snapshot()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Refreshes the pinned Google discovery documents in bot/discovery, which Google API services are built from (see
+intenthandlers/google_services.py). Run it when the bot needs a newer revision of an API, review the diff, and commit.
+
+Run from the bot directory: python refresh_discovery.py [api.version ...]
+"""
+import json
+import os
+import sys
+
+import requests
+
+from intenthandlers.google_services import DISCOVERY_DIR, DISCOVERY_URLS, discovery_document_path
+
+
+def current_revision(api, version):
+    try:
+        with open(discovery_document_path(api, version)) as document_file:
+            return json.load(document_file).get('revision')
+    except (IOError, ValueError):
+        return None
+
+
+def refresh(api, version):
+    """
+    Fetches the discovery document for api and version, and pins it if it is a usable discovery document
+    :return: The old and new revisions
+    """
+    resp = requests.get(DISCOVERY_URLS[(api, version)], timeout=30)
+    resp.raise_for_status()
+    document = resp.json()
+    if 'resources' not in document or 'rootUrl' not in document:
+        raise ValueError("{} {} discovery document has no resources".format(api, version))
+    old_revision = current_revision(api, version)
+    with open(discovery_document_path(api, version), 'w') as document_file:
+        document_file.write(resp.text)
+    return old_revision, document.get('revision')
+
+
+def main(argv):
+    wanted = set(argv[1:])
+    if not os.path.isdir(DISCOVERY_DIR):
+        os.makedirs(DISCOVERY_DIR)
+    for api, version in sorted(DISCOVERY_URLS):
+        if wanted and '{}.{}'.format(api, version) not in wanted:
+            continue
+        old_revision, new_revision = refresh(api, version)
+        print("{}.{}: {} -> {}".format(api, version, old_revision, new_revision))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RESTORE_BATCH_SIZE = 500
+
+
+class ReminderStore(object):
+    """
+    A ReminderStore keeps recurring reminders, e.g. nags, in a SQLite file so that they survive restarts. Each row is
+    a reminder's id, when it next fires (seconds since the epoch), its interval, the channel and text it sends, and
+    the context needed to rebuild the conversation it belongs to.
+    """
+    def __init__(self, path):
+        """
+        :param path: The SQLite file, created if it does not exist, or ':memory:' to keep nothing across restarts
+        """
+        self.path = path
+        self._lock = threading.Lock()  # Guards the connection, which the reminder thread shares
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS reminders (id TEXT PRIMARY KEY, next_fire REAL NOT NULL, "
+                                 "interval REAL NOT NULL, channel TEXT NOT NULL, text TEXT NOT NULL, context TEXT)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS reminders_by_next_fire ON reminders (next_fire, id)")
+        self._connection.commit()
+        metrics.gauge('reminders.stored', self.__len__)
+
+    @classmethod
+    def from_env(cls):
+        """
+        :return: A store at the REMINDER_DB env var's path, default reminders.sqlite. REMINDER_DB=memory keeps
+        reminders in memory only
+        """
+        path = os.getenv("REMINDER_DB") or "reminders.sqlite"
+        return cls(':memory:' if path == 'memory' else path)
+
+    def put(self, reminder_id, next_fire, interval, channel, text, context=None):
+        """
+        :param context: A JSON serializable dict, returned with the reminder when it is restored
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?, ?)",
+                                     (str(reminder_id), next_fire, interval, channel, text, json.dumps(context)))
+            self._connection.commit()
+
+    def reschedule(self, reminder_id, next_fire):
+        """
+        Records when the reminder next fires, after it has fired
+        """
+        with self._lock:
+            self._connection.execute("UPDATE reminders SET next_fire = ? WHERE id = ?", (next_fire, str(reminder_id)))
+            self._connection.commit()
+
+    def delete(self, reminder_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM reminders WHERE id = ?", (str(reminder_id),))
+            self._connection.commit()
+
+    def batches(self, batch_size=RESTORE_BATCH_SIZE):
+        """
+        Reads the reminders a batch at a time, soonest first, so that those due soonest can be scheduled before the
+        rest are read
+        :return: A generator of lists of dicts with the keys id, next_fire, interval, channel, text and context
+        """
+        after = (float('-inf'), '')
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, next_fire, interval, channel, text, context FROM reminders "
+                    "WHERE next_fire > ? OR (next_fire = ? AND id > ?) ORDER BY next_fire, id LIMIT ?",
+                    (after[0], after[0], after[1], batch_size)).fetchall()
+            if not rows:
+                return
+            yield [{'id': row[0], 'next_fire': row[1], 'interval': row[2], 'channel': row[3], 'text': row[4],
+                    'context': json.loads(row[5]) if row[5] else None} for row in rows]
+            if len(rows) < batch_size:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM reminders").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,28 +1,45 @@
+import asyncio
+import os
 import time
 import logging
 import traceback
+import metrics
 from slack_clients import SlackClients
 from messenger import Messenger
+from threads import OutboundScheduler
 from event_handler import RtmEventHandler
 
 logger = logging.getLogger(__name__)
 
+# Run modes for the RTM loop. The threaded mode is the original polling loop, kept as a fallback
+RTM_MODE_ASYNCIO = 'asyncio'
+RTM_MODE_THREADED = 'threaded'
+
+PING_INTERVAL = 3  # seconds
+
+# Put on the state updating queue when the asyncio loop stops, to wake the executor thread waiting on it
+_STOP_DRAINING = object()
+
 
 def spawn_bot():
     return SlackBot()
 
 
 class SlackBot(object):
-    def __init__(self, state_updating_q, event_processing_q, token=None, slack_clients=SlackClients):
+    def __init__(self, state_updating_q, event_processing_q, token=None, slack_clients=SlackClients, run_mode=None):
         """Creates Slacker Web and RTM clients with API Bot User token.
 
         Args:
             token (str): Slack API Bot User token (for development token set in env)
+            run_mode (str): 'asyncio' or 'threaded', defaults to the RTM_MODE env var, or 'asyncio' if it is unset
         """
         self.event_processing_q = event_processing_q
         self.state_updating_q = state_updating_q
         self.last_ping = 0
         self.keep_running = True
+        self.run_mode = run_mode or os.getenv("RTM_MODE", RTM_MODE_ASYNCIO)
+        self.loop = None
+        self._finished = None
         if token is not None:
             self.clients = slack_clients(token)
 
@@ -40,35 +57,135 @@ class SlackBot(object):
             self.clients = SlackClients(res_access_token)
 
         if self.clients.rtm.rtm_connect():
-            logging.info(u'Connected {} to {} team at https://{}.slack.com'.format(
+            connected_after = time.time() - self.clients.created_at
+            metrics.gauge('startup.connected_seconds').set(connected_after)
+            logging.info(u'Connected {} to {} team at https://{}.slack.com, {:.2f}s after start'.format(
                 self.clients.rtm.server.username,
                 self.clients.rtm.server.login_data['team']['name'],
-                self.clients.rtm.server.domain))
-            msg_writer = messenger(self.clients)
+                self.clients.rtm.server.domain,
+                connected_after))
+            self.clients.seed_workspace()
+            self.clients.start_user_warm_up()
+            scheduler = OutboundScheduler.from_env()
+            scheduler.start()
+            msg_writer = messenger(self.clients, scheduler=scheduler)
 
             event_handler = rtmEventHandler(self.clients, msg_writer, self.event_processing_q, self.state_updating_q)
-
-            while self.keep_running:
-                for event in self.clients.rtm.rtm_read():
-                    event_handler.state_check()
-                    try:
-                        event_handler.handle(event)
-                    except:
-                        err_msg = traceback.format_exc()
-                        logging.error('Unexpected error: {}'.format(err_msg))
-                        msg_writer.write_error(event['channel'], err_msg)
-                        continue
-
-                self._auto_ping()
-                time.sleep(.1)
+            self.clients.start_nag_restore(msg_writer, self.state_updating_q)
+
+            try:
+                if self.run_mode == RTM_MODE_THREADED:
+                    self._run_threaded(event_handler, msg_writer)
+                else:
+                    self._run_asyncio(event_handler, msg_writer)
+            finally:
+                if hasattr(msg_writer, 'close'):
+                    msg_writer.close()
+                scheduler.join(timeout=5)
 
         else:
             logger.error('Failed to connect to RTM client with token: {}'.format(self.clients.token))
 
+    def _dispatch(self, event_handler, msg_writer, event):
+        try:
+            event_handler.handle(event)
+        except:
+            err_msg = traceback.format_exc()
+            logging.error('Unexpected error: {}'.format(err_msg))
+            msg_writer.write_error(event['channel'], err_msg)
+
+    def _run_threaded(self, event_handler, msg_writer):
+        """
+        The original polling loop: read whatever is on the socket, then sleep for 100ms
+        """
+        while self.keep_running:
+            for event in self.clients.rtm.rtm_read():
+                event_handler.state_check()
+                self._dispatch(event_handler, msg_writer, event)
+
+            self._auto_ping()
+            time.sleep(.1)
+
+    def _run_asyncio(self, event_handler, msg_writer):
+        """
+        Event driven loop: the websocket is registered as a reader on an asyncio loop, so events are dispatched as
+        soon as a frame arrives. Pings, state queue draining and outbound sends all run on the same loop.
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._finished = self.loop.create_future()
+        if hasattr(msg_writer, 'attach_loop'):
+            msg_writer.attach_loop(self.loop)
+
+        sock_fd = self.clients.rtm.server.websocket.sock.fileno()
+        self.loop.add_reader(sock_fd, self._on_readable, event_handler, msg_writer)
+        ping = self.loop.create_task(self._ping_forever())
+        drain = self.loop.create_task(self._drain_state_q(event_handler))
+        # Anything already buffered before the reader was registered would not wake the loop
+        self.loop.call_soon(self._on_readable, event_handler, msg_writer)
+        try:
+            if self.keep_running:
+                self.loop.run_until_complete(self._finished)
+        finally:
+            self.loop.remove_reader(sock_fd)
+            ping.cancel()
+            # Cancelling the drain would drop a state its executor thread had already taken off the queue, so it is
+            # left to apply everything queued before the sentinel, and return
+            self.state_updating_q.put(_STOP_DRAINING)
+            self.loop.run_until_complete(asyncio.gather(ping, drain, return_exceptions=True))
+            if hasattr(msg_writer, 'detach_loop'):
+                msg_writer.detach_loop()
+            self.loop.close()
+            self.loop = None
+
+    def _finish(self, error=None):
+        if self._finished.done():
+            return
+        if error is None:
+            self._finished.set_result(None)
+        else:
+            self._finished.set_exception(error)
+
+    def _on_readable(self, event_handler, msg_writer):
+        # A single readable notification can carry several frames, and an SSL socket can buffer frames that select
+        # will not report, so keep reading until the client reports nothing left
+        try:
+            while self.keep_running:
+                events = self.clients.rtm.rtm_read()
+                if not events:
+                    break
+                for event in events:
+                    self._dispatch(event_handler, msg_writer, event)
+        except Exception as e:
+            logger.error('RTM read failed, stopping the event loop: {}'.format(e))
+            self._finish(e)
+            return
+
+        if not self.keep_running:
+            self._finish()
+
+    async def _ping_forever(self):
+        while self.keep_running:
+            self.clients.rtm.server.ping()
+            self.last_ping = int(time.time())
+            await asyncio.sleep(PING_INTERVAL)
+
+    async def _drain_state_q(self, event_handler):
+        # Queue.get blocks, so it runs on the loop's executor, while the state update itself runs on the loop thread.
+        # It runs until it takes the sentinel _run_asyncio puts on the queue when the loop stops
+        while True:
+            state = await self.loop.run_in_executor(None, self.state_updating_q.get)
+            if state is _STOP_DRAINING:
+                return
+            try:
+                event_handler.process_state(state)
+            except:
+                logging.error('Unexpected error while updating state: {}'.format(traceback.format_exc()))
+
     def _auto_ping(self):
         # hard code the interval to 3 seconds
         now = int(time.time())
-        if now > self.last_ping + 3:
+        if now > self.last_ping + PING_INTERVAL:
             self.clients.rtm.server.ping()
             self.last_ping = now
 
@@ -80,3 +197,9 @@ class SlackBot(object):
             resource (dict of Resource JSON): See message payloads - https://beepboophq.com/docs/article/resourcer-api
         """
         self.keep_running = False
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._finish)
+            except RuntimeError:
+                pass  # The loop closed on its own in the meantime
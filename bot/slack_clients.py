@@ -1,14 +1,22 @@
-import requests
 import logging
+import os
+import requests
 import re
 import time
 import json
+import random
+import uuid
 from intenthandlers.utils import get_highest_confidence_entity
-from intenthandlers.utils import memoized
+from intenthandlers.utils import cached
 from slacker import Slacker
 from slackclient import SlackClient
-from threads import StoppableThread
+from slack_http import SlackHttp
+from threads import ReminderScheduler, WarmUpThread, PRIORITY_BULK
 from state import NaggingConversation
+from user_directory import UserDirectory
+from workspace import WorkspaceMetadata
+from reminder_store import ReminderStore
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -17,25 +25,48 @@ def is_direct_message(channel_id):
     return re.search('^D', channel_id)
 
 
+def is_failed_request(value):
+    """
+    The Web API lookups below return a string ending in "request failed" when Slack doesn't answer. Those results are
+    only cached briefly, so that a blip doesn't stick for the life of the process.
+    """
+    return isinstance(value, str) and value.endswith("request failed")
+
+
+USERS_LIST_PAGE_SIZE = 200
+
+NAG_INTERVAL = 7200  # 2 hour repeat delay
+
+
 class SlackClients(object):
-    def __init__(self, token):
+    def __init__(self, token, reminder_store=None):
+        """
+        :param reminder_store: Where nags are kept across restarts, defaults to ReminderStore.from_env()
+        """
         self.token = token
+        self.created_at = time.time()
 
-        data = {"token": self.token}
-        target_url = "https://slack.com/api/users.list"
-        resp = requests.get(target_url, data)
-        if resp.status_code == 200:
-            resp_json = json.loads(resp.text)
-            self.users = resp_json['members']
-        else:
-            self.users = []
-            logger.error("Failed to get user list")
+        # Every Slack Web API call, including Slacker's and rtm.start, shares this pooled keep-alive session
+        self.http = SlackHttp(token)
+
+        # Seeded from the rtm.start snapshot once we are connected, see seed_workspace, and kept current from RTM
+        # events. Users missing from the snapshot are filled in the background, see start_user_warm_up
+        self.users = UserDirectory()
+        self.workspace = WorkspaceMetadata(self.users)
+        self.warm_up_wait = float(os.getenv("USER_WARM_UP_WAIT") or 10)
 
         # Slacker is a Slack Web API Client
-        self.web = Slacker(token)
+        self.web = self.http.bind_slacker(Slacker(token))
 
         # SlackClient is a Slack Websocket RTM API Client
         self.rtm = SlackClient(token)
+        self.rtm.server.api_requester = self.http.requester()
+
+        # Every nag is a reminder on this one thread, keyed by the id of its NaggingConversation. They are also kept
+        # in the reminder store, and restored from it after a restart, see start_nag_restore
+        self.reminders = ReminderScheduler(jitter=float(os.getenv("NAG_JITTER") or 60))
+        self.reminders.start()
+        self.reminder_store = reminder_store if reminder_store is not None else ReminderStore.from_env()
 
     def bot_user_id(self):
         return self.rtm.server.login_data['self']['id']
@@ -61,38 +92,133 @@ class SlackClients(object):
         self.rtm.server.send_to_websocket(user_typing_json)
         time.sleep(sleep_time)
 
-    @memoized
-    def get_id_from_user_name(self, user_name):
-        for user in self.users:
-            if user_name == user['profile']['real_name']:
-                return user['id']
+    def seed_workspace(self):
+        """
+        Fills the workspace metadata from the channels, groups, IMs and users rtm.start already sent us
+        """
+        self.workspace.seed(self.rtm.server.login_data)
+
+    def update_workspace(self, event):
+        """
+        :param event: An RTM event, e.g. channel_rename or user_change
+        Keeps the workspace metadata current without reloading it
+        """
+        return self.workspace.apply_event(event)
+
+    def start_user_warm_up(self):
+        """
+        Loads the user directory on a background thread, so that connecting to RTM doesn't wait on it. Not needed if
+        rtm.start already sent every user.
+        """
+        if self.users.is_complete():
+            return None
+        thread = WarmUpThread(self.warm_up_users, name='UserWarmUpThread')
+        thread.start()
+        return thread
 
-        raise LookupError
+    def warm_up_users(self):
+        """
+        Pages through users.list, adding each page to the user directory as it arrives, so that neither a single huge
+        response nor the API's page cap gets in the way. Lookups made before this finishes fall back to users.info.
+        """
+        cursor = None
+        pages = 0
+        try:
+            while True:
+                resp_json = self._fetch_users_page(cursor)
+                if resp_json is None:
+                    # Lookups are not left waiting on a directory that will never finish. Missing users still come
+                    # from users.info
+                    logger.error("Giving up on the user list after {} pages".format(pages))
+                    break
+                for member in resp_json.get('members', []):
+                    self.users.upsert(member)
+                pages += 1
+                cursor = resp_json.get('response_metadata', {}).get('next_cursor')
+                if not cursor:
+                    break
+        finally:
+            # Even if paging fails, lookups waiting on the directory must go on to users.info
+            self.users.mark_complete()
+        elapsed = time.time() - self.created_at
+        metrics.gauge('startup.directory_complete_seconds').set(elapsed)
+        logger.info("User directory loaded with {} users from {} pages, {:.2f}s after start".format(
+            len(self.users), pages, elapsed))
+
+    def _fetch_users_page(self, cursor, attempts=3):
+        params = {'limit': USERS_LIST_PAGE_SIZE}
+        if cursor:
+            params['cursor'] = cursor
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(2 ** attempt)
+            try:
+                resp = self.http.get("users.list", **params)
+            except requests.RequestException as e:
+                logger.error("Failed to get user list page: {}".format(e))
+                continue
+            if resp.status_code != 200:
+                logger.error("Failed to get user list page, status {}".format(resp.status_code))
+                continue
+            resp_json = json.loads(resp.text)
+            if resp_json.get('ok', True):
+                return resp_json
+            logger.error("Failed to get user list page: {}".format(resp_json.get('error')))
+        return None
+
+    def find_user_by_name(self, user_name):
+        """
+        :return: The user with this name, waiting for the user directory to finish loading if the name isn't there yet,
+        or None if there is no such user
+        """
+        user = self.users.find_by_name(user_name)
+        if user is None and not self.users.is_complete():
+            # Names can't be looked up one at a time the way ids can with users.info
+            self.users.wait_until_complete(self.warm_up_wait)
+            user = self.users.find_by_name(user_name)
+        return user
+
+    def get_id_from_user_name(self, user_name):
+        user = self.find_user_by_name(user_name)
+        if user is None:
+            raise LookupError
+        return user['id']
 
-    @memoized
     def get_user_name_from_id(self, user_id):
-        for user in self.users:
-            if user['id'] == user_id:
-                return user
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
 
         # Called when user is not found in self.users
-        data = {"token": self.token, "user": user_id}
-        target_url = "https://slack.com/api/users.info"
-        resp = requests.get(target_url, data)
+        user = self._fetch_user_info(user_id)
+        if not is_failed_request(user):
+            user = self.users.upsert(user)
+        return user
+
+    @cached(maxsize=1024, ttl=60, negative_ttl=60, is_negative=is_failed_request)
+    def _fetch_user_info(self, user_id):
+        resp = self.http.get("users.info", user=user_id)
         if resp.status_code == 200:
             resp_json = json.loads(resp.text)
-            user = resp_json['user']
-            self.users.append(user)
-            return user
+            return resp_json['user']
         else:
             logger.error("username request failed")
             return "username request failed"
 
-    @memoized
     def get_channel_name_from_id(self, channel_id):
-        data = {"token": self.token, "channel": channel_id}
-        target_url = "https://slack.com/api/channels.info"
-        resp = requests.get(target_url, data)
+        channel = self.workspace.channel(channel_id)
+        if channel is not None:
+            return channel
+
+        # Only reached for channels created before a reconnect, or that we missed the event for
+        channel = self._fetch_channel_info(channel_id)
+        if not is_failed_request(channel):
+            channel = self.workspace.add_channel(channel)
+        return channel
+
+    @cached(maxsize=1024, ttl=60, negative_ttl=60, is_negative=is_failed_request)
+    def _fetch_channel_info(self, channel_id):
+        resp = self.http.get("channels.info", channel=channel_id)
         if resp.status_code == 200:
             resp_json = json.loads(resp.text)
             channel = resp_json['channel']
@@ -101,11 +227,21 @@ class SlackClients(object):
             logger.info("channel name request failed")
             return "channel name request failed"
 
-    @memoized
     def get_dm_id_from_user_id(self, user_id):
-        data = {"token": self.token, "user": user_id}
-        target_url = "https://slack.com/api/im.open"
-        resp = requests.get(target_url, data)
+        dm_id = self.workspace.dm_for_user(user_id)
+        if dm_id is not None:
+            return dm_id
+
+        dm_id = self._open_dm(user_id)
+        if not is_failed_request(dm_id):
+            self.workspace.add_dm(user_id, dm_id)
+            # As slackclient does for its own im.open calls, so that the RTM client can send to the new DM
+            self.rtm.server.attach_channel(user_id, dm_id)
+        return dm_id
+
+    @cached(maxsize=1024, ttl=60, negative_ttl=60, is_negative=is_failed_request)
+    def _open_dm(self, user_id):
+        resp = self.http.get("im.open", user=user_id)
         if resp.status_code == 200:
             resp_json = json.loads(resp.text)
             dm_id = resp_json['channel']['id']
@@ -130,28 +266,79 @@ class SlackClients(object):
         nagger = event['user_name'].get('real_name')
         dm = None
 
-        for member in self.users:
-            # This equality might prove buggy. Perhaps some fuzzy matching here to allow for tolerances?
-            if member.get('profile').get('real_name') == user_name_to_nag:
-                dm = self.get_dm_id_from_user_id(member.get('id'))
-                message = "You need to {}. {} said so".format(nag_subject, nagger)
+        # Exact real name first, then a case and whitespace insensitive match
+        member = self.find_user_by_name(user_name_to_nag)
+        if member is not None:
+            dm = self.get_dm_id_from_user_id(member.get('id'))
+            message = "You need to {}. {} said so".format(nag_subject, nagger)
 
         if not dm:
             msg_writer.send_message(event['channel'], "I couldn't find anyone named {} to nag".format(user_name_to_nag))
             return
 
-        thread = StoppableThread(msg_writer.send_message, dm, message, delay=7200)  # 2 hour repeat delay
-        msg_writer.send_message(event['channel'], "Nagging {}".format(user_name_to_nag))
-        thread.start()
-
-        conversation = NaggingConversation({'user': event['user'], 'channel': event['channel']},
+        return_target = {'user': event['user'], 'channel': event['channel']}
+        conversation = NaggingConversation(return_target,
                                            dm,
                                            user_name_to_nag,
-                                           nag_subject,
-                                           thread)
+                                           nag_subject)
+        msg_writer.send_message(event['channel'], "Nagging {}".format(user_name_to_nag))
+        self.reminder_store.put(conversation.get_id(), time.time(), NAG_INTERVAL, dm, message,
+                                context={'return': return_target, 'user_name_to_nag': user_name_to_nag,
+                                         'nag_subject': nag_subject})
+        self._schedule_nag(msg_writer, conversation.get_id(), NAG_INTERVAL, dm, message, delay=0)
 
         return conversation
 
+    def _schedule_nag(self, msg_writer, conversation_id, interval, dm, message, delay):
+        self.reminders.schedule(conversation_id, interval, self._send_nag, msg_writer, conversation_id, interval, dm,
+                                message, delay=delay)
+
+    def _send_nag(self, msg_writer, conversation_id, interval, dm, message):
+        msg_writer.send_message(dm, message, priority=PRIORITY_BULK)
+        self.reminder_store.reschedule(conversation_id, time.time() + interval)
+
+    def start_nag_restore(self, msg_writer, state_q):
+        """
+        Restores the nags that were running before the bot restarted, on a background thread so that start up doesn't
+        wait on them
+        """
+        thread = WarmUpThread(self.restore_nags, msg_writer, state_q, name='NagRestoreThread')
+        thread.start()
+        return thread
+
+    def restore_nags(self, msg_writer, state_q):
+        """
+        Reschedules every stored nag, reading them in batches, soonest first. A nag that should have fired while the
+        bot was down fires once, however many times it missed, at a random point in the next NAG_JITTER seconds so
+        that a backlog isn't sent in one burst. Each nag's NaggingConversation is put back on state_q, so that it can
+        still be answered. Nags fire while later batches are read, moving their next firing past where the read has
+        got to, so a nag that is already scheduled is skipped rather than restored twice.
+        """
+        now = time.time()
+        restored = missed = 0
+        for batch in self.reminder_store.batches():
+            for reminder in batch:
+                conversation_id = uuid.UUID(reminder['id'])
+                if conversation_id in self.reminders:
+                    continue
+                context = reminder['context'] or {}
+                delay = reminder['next_fire'] - now
+                if delay <= 0:
+                    missed += 1
+                    delay = random.uniform(0, self.reminders.jitter)
+                self._schedule_nag(msg_writer, conversation_id, reminder['interval'], reminder['channel'],
+                                   reminder['text'], delay=delay)
+                conversation = NaggingConversation(context.get('return'),
+                                                   reminder['channel'],
+                                                   context.get('user_name_to_nag'),
+                                                   context.get('nag_subject'),
+                                                   conversation_id=conversation_id)
+                state_q.put({'type': 'state_update', 'state': conversation})
+                restored += 1
+        metrics.counter('reminders.restored').inc(restored)
+        metrics.counter('reminders.missed').inc(missed)
+        logger.info("Restored {} nags, {} of which missed firings while the bot was down".format(restored, missed))
+
     def nag_response(self, msg_writer, event, wit_entities, credentials):
         """
         Closes a nag conversation and informs the relevant users
@@ -163,11 +350,11 @@ class SlackClients(object):
                                     "I know you want me to stop nagging you, but I'm not sure what about")
             return
         context = conversation.get_context()
-        thread = context.get('reminder_thread')
         msg_writer.send_message(context['return']['channel'],
                                 "{} completed {}".format(context['user_name_to_nag'], context['nag_subject']))
         msg_writer.send_message(event['channel'], "Nagging about {} complete".format(context['nag_subject']))
-        thread.join()  # Kills the nagging cycle
+        self.reminders.cancel(conversation.get_id())  # Ends the nagging cycle
+        self.reminder_store.delete(conversation.get_id())
         conversation.complete()
         conversation.remove_from_waiting('nag-response')
         return conversation
@@ -0,0 +1,128 @@
+import logging
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from slacker import BaseAPI
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SLACK_API_URL = "https://slack.com/api/"
+
+
+class SlackHttp(object):
+    """
+    SlackHttp is the single pooled, keep-alive HTTP session that every Slack Web API call in the bot goes through,
+    our own lookups as well as those made by Slacker and by slackclient's rtm.start. Reusing connections saves a TCP
+    and TLS handshake per call.
+    """
+    def __init__(self, token, base_url=None, pool_size=None, timeout=None):
+        """
+        :param token: Slack API token, added to every call
+        :param base_url: Where the Web API lives, defaults to the SLACK_API_URL env var, or slack.com
+        :param pool_size: How many connections to keep open, defaults to the SLACK_HTTP_POOL_SIZE env var, or 10
+        :param timeout: Per request timeout in seconds, defaults to the SLACK_HTTP_TIMEOUT env var, or 10
+        """
+        self.token = token
+        self.base_url = base_url or os.getenv("SLACK_API_URL") or SLACK_API_URL
+        pool_size = pool_size or int(os.getenv("SLACK_HTTP_POOL_SIZE") or 10)
+        self.timeout = timeout or float(os.getenv("SLACK_HTTP_TIMEOUT") or 10)
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.requests_made = metrics.counter('slack_http.requests')
+        # The registered counter is shared by every SlackHttp in the process, the reuse ratio needs this one's own
+        self._own_requests = metrics.Counter('slack_http.requests')
+        self.failures = metrics.counter('slack_http.failures')
+        self.latency = metrics.histogram('slack_http.request_seconds')
+        metrics.gauge('slack_http.connections_opened', self.connections_opened)
+        metrics.gauge('slack_http.connection_reuse_ratio', self.connection_reuse_ratio)
+
+    def get(self, method, **params):
+        """
+        :param method: A Web API method, e.g. users.info
+        :return: The requests.Response
+        """
+        params['token'] = self.token
+        return self.request('GET', self.base_url + method, params=params)
+
+    def post(self, method, **data):
+        data['token'] = self.token
+        return self.request('POST', self.base_url + method, data=data)
+
+    def request(self, verb, url, **kwargs):
+        # Callers such as Slacker build slack.com URLs themselves, so point them at our base URL
+        if url.startswith(SLACK_API_URL):
+            url = self.base_url + url[len(SLACK_API_URL):]
+        kwargs.setdefault('timeout', self.timeout)
+        self.requests_made.inc()
+        self._own_requests.inc()
+        try:
+            resp = self.session.request(verb, url, **kwargs)
+        except requests.RequestException:
+            self.failures.inc()
+            raise
+        self.latency.observe(resp.elapsed.total_seconds())
+        return resp
+
+    def connections_opened(self):
+        """
+        :return: How many connections the pool has opened, across every host it has talked to
+        """
+        pools = self.adapter.poolmanager.pools
+        # A pool may be evicted between listing the keys and looking it up
+        return sum(pool.num_connections for pool in (pools.get(key) for key in pools.keys()) if pool is not None)
+
+    def connection_reuse_ratio(self):
+        """
+        :return: The share of this instance's requests that went over an already open connection
+        """
+        made = self._own_requests.value()
+        if not made:
+            return 0.0
+        return 1 - min(made, self.connections_opened()) / made
+
+    def bind_slacker(self, web):
+        """
+        :param web: A Slacker client
+        Slacker calls requests.get and requests.post directly, opening a connection per call. This points each of
+        its API objects at our session instead.
+        """
+        for api in vars(web).values():
+            if isinstance(api, BaseAPI):
+                self._bind_api(api)
+        return web
+
+    def _bind_api(self, api):
+        api.timeout = self.timeout
+        api.get = lambda method, **kwargs: api._request(self._session_verb('GET'), method, **kwargs)
+        api.post = lambda method, **kwargs: api._request(self._session_verb('POST'), method, **kwargs)
+        # Some APIs, e.g. users.profile, hold further APIs of their own
+        for sub_api in vars(api).values():
+            if isinstance(sub_api, BaseAPI):
+                self._bind_api(sub_api)
+
+    def _session_verb(self, verb):
+        return lambda url, **kwargs: self.request(verb, url, **kwargs)
+
+    def requester(self):
+        """
+        :return: A replacement for slackclient's SlackRequest, so that rtm.start shares the session too
+        """
+        return SlackRequester(self)
+
+
+class SlackRequester(object):
+    """
+    Has the same interface as slackclient's SlackRequest, but makes its calls through a SlackHttp session
+    """
+    def __init__(self, http):
+        self.http = http
+
+    def do(self, token, request="?", post_data=None, domain="slack.com"):
+        if post_data is None:
+            post_data = {}
+        return self.http.request('POST', self.http.base_url + request, data=dict(post_data, token=token))
@@ -82,6 +82,29 @@ class WaitState(State):
         return obj
 
 
+class ReplyState(State):
+    """
+    A ReplyState carries a message for the bot to post, so that a handler which sends nothing itself may be retried:
+    only the state of its first attempt to finish is delivered, and so only one reply is posted
+    """
+    def __init__(self, channel=None, text=None, obj=None):
+        State.__init__(self, obj)
+        if obj:
+            self.channel = obj.get('channel')
+            self.text = obj.get('text')
+        else:
+            self.channel = channel
+            self.text = text
+
+    def objectify(self):
+        obj = State.objectify(self)
+        obj.update({
+            'channel': self.channel,
+            'text': self.text
+        })
+        return obj
+
+
 class ConversationState(State):
     """
     A generic conversation state, used as a base for specific conversations
@@ -136,15 +159,19 @@ class OnboardingConversation(ConversationState):
 class NaggingConversation(ConversationState):
     """
     A Conversation used to keep track of who is currently being nagged, to ensure that when they complete their task,
-    they are no longer nagged.
+    they are no longer nagged. The nags themselves are a reminder keyed by the conversation's id.
     """
-    def __init__(self, return_target, dm, user_name_to_nag, nag_subject, thread):
+    def __init__(self, return_target, dm, user_name_to_nag, nag_subject, conversation_id=None):
+        """
+        :param conversation_id: The id of the conversation being restored, e.g. after a restart
+        """
         ConversationState.__init__(self)
+        if conversation_id is not None:
+            self.id = conversation_id
         self.waiting_for = ['nag-response']
         self.context = {
                 'return': return_target,
                 'dm_channel': dm,
                 'user_name_to_nag': user_name_to_nag,
-                'nag_subject': nag_subject,
-                'reminder_thread': thread
+                'nag_subject': nag_subject
         }
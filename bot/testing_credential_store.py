@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import datetime
+from cryptography.fernet import Fernet
+from mock import Mock, patch
+from oauth2client import client
+from intenthandlers.credential_store import MemoryCredentialStore, SqliteCredentialStore, default_store
+
+
+def make_credentials(access_token='access'):
+    return client.OAuth2Credentials(access_token, 'client id', 'client secret', 'refresh-token',
+                                    datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+                                    'https://oauth2.googleapis.com/token', 'hal')
+
+
+class TestSqliteCredentialStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'credentials.sqlite')
+        self.crypt = Fernet(Fernet.generate_key())
+        self.store = SqliteCredentialStore(self.path, self.crypt)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    # Test that credentials are still there after a restart, and are encrypted on disk
+    def test_persisted(self):
+        self.store.put('U1', make_credentials())
+        self.store.close()
+        with open(self.path, 'rb') as db:
+            self.assertNotIn(b'refresh-token', db.read())
+        self.store = SqliteCredentialStore(self.path, self.crypt)
+        creds = self.store.get('U1')
+        self.assertEqual(creds.access_token, 'access')
+        self.assertEqual(creds.refresh_token, 'refresh-token')
+        self.assertIs(self.store.get('U1'), creds)
+        self.assertIsNone(self.store.get('U2'))
+
+    # Test that rows written with another key read as missing
+    def test_wrong_key(self):
+        self.store.put('U1', make_credentials())
+        self.store.close()
+        self.store = SqliteCredentialStore(self.path, Fernet(Fernet.generate_key()))
+        self.assertIsNone(self.store.get('U1'))
+
+    def test_delete(self):
+        self.store.put('U1', make_credentials())
+        self.store.delete('U1')
+        self.assertIsNone(self.store.get('U1'))
+        self.store.close()
+        self.store = SqliteCredentialStore(self.path, self.crypt)
+        self.assertIsNone(self.store.get('U1'))
+
+    # Test that a token oauth2client refreshes is written back, without replacing the storage it holds the lock of
+    def test_refresh_written_back(self):
+        creds = make_credentials()
+        self.store.put('U1', creds)
+        storage = creds.store
+        storage.acquire_lock()
+        creds.access_token = 'refreshed'
+        storage.locked_put(creds)
+        storage.release_lock()
+        self.assertIs(creds.store, storage)
+        self.store.close()
+        self.store = SqliteCredentialStore(self.path, self.crypt)
+        self.assertEqual(self.store.get('U1').access_token, 'refreshed')
+
+    # Test that concurrent first lookups load the row once
+    def test_concurrent_get(self):
+        self.store.put('U1', make_credentials())
+        self.store.close()
+        self.store = SqliteCredentialStore(self.path, self.crypt)
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(self.store.get('U1'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(id(creds) for creds in found)), 1)
+
+
+class TestDefaultStore(unittest.TestCase):
+    def test_memory(self):
+        with patch.dict(os.environ, {'CREDENTIAL_DB': 'memory'}):
+            self.assertIsInstance(default_store(Mock()), MemoryCredentialStore)
+
+    def test_no_key(self):
+        self.assertIsInstance(default_store(None), MemoryCredentialStore)
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with patch.dict(os.environ, {'CREDENTIAL_DB': os.path.join(directory, 'creds.sqlite')}):
+                store = default_store(Fernet(Fernet.generate_key()))
+            self.assertIsInstance(store, SqliteCredentialStore)
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestGoogleCredentials(unittest.TestCase):
+    def setUp(self):
+        from intenthandlers.google_helpers import GoogleCredentials
+        self.msg_writer = Mock()
+        self.store = MemoryCredentialStore()
+        self.credentials = GoogleCredentials(self.msg_writer, Mock(), store=self.store)
+        self.event = {'channel': 'D1', 'user_dm': 'D1'}
+
+    def tearDown(self):
+        self.credentials.refresher.join(5)
+
+    # Test that an expired token is refreshed, rather than sending the user an authorization link
+    def test_expired_refreshed(self):
+        creds = Mock(access_token_expired=True, refresh_token=None)
+        self.store.put('U1', creds)
+        self.assertIs(self.credentials.get_credential(self.event, Mock(hex='ab'), user='U1'), creds)
+        self.assertEqual(creds.refresh.call_count, 1)
+        self.msg_writer.send_message_with_attachments.assert_not_called()
+
+    # Test that a token which can't be refreshed sends the user an authorization link
+    def test_refresh_failed(self):
+        creds = Mock(access_token_expired=True, refresh=Mock(side_effect=client.HttpAccessTokenRefreshError()))
+        self.store.put('U1', creds)
+        self.credentials.crypt = Fernet(Fernet.generate_key())
+        self.assertIsNone(self.credentials.get_credential(self.event, Mock(hex='ab'), user='U1'))
+        self.assertEqual(self.msg_writer.send_message_with_attachments.call_count, 1)
+
+    # Test that stored users are tracked for refreshing on their first lookup, not when the bot starts
+    def test_tracked_lazily(self):
+        from intenthandlers.google_helpers import GoogleCredentials
+        store = Mock(get=Mock(return_value=make_credentials()))
+        credentials = GoogleCredentials(self.msg_writer, Mock(), store=store)
+        self.addCleanup(credentials.refresher.join, 5)
+        store.get.assert_not_called()
+        self.assertNotIn('U1', credentials.refresher)
+        credentials.get_credential(self.event, Mock(hex='ab'), user='U1')
+        self.assertIn('U1', credentials.refresher)
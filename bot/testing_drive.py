@@ -0,0 +1,90 @@
+import unittest
+from mock import MagicMock, Mock, patch
+import intenthandlers.drive as drive
+from state import WaitState
+
+
+def pages(*sizes):
+    number = 0
+    for size in sizes:
+        yield [{'id': str(i), 'name': 'file{:02d}'.format(i)} for i in range(number, number + size)]
+        number += size
+
+
+class TestSendListing(unittest.TestCase):
+    def setUp(self):
+        self.msg_writer = Mock(send_message=MagicMock())
+
+    def sent(self):
+        return [call[0][1] for call in self.msg_writer.send_message.call_args_list]
+
+    # Test that each page is sent as it arrives, in code blocks no longer than max_length
+    def test_chunks(self):
+        self.assertEqual(drive.send_listing(self.msg_writer, 'C1', pages(5, 3), max_length=30),
+                         ([str(i) for i in range(8)], False))
+        self.assertEqual(self.sent(), ["```file00\nfile01\nfile02```", "```file03\nfile04```",
+                                       "```file05\nfile06\nfile07```"])
+        self.assertTrue(all(len(message) <= 30 for message in self.sent()))
+
+    # Test limit and skipping files already listed, and reporting whether more files are left
+    def test_limit_listed(self):
+        listed = frozenset(['0', '1'])
+        self.assertEqual(drive.send_listing(self.msg_writer, 'C1', pages(4, 4), listed, limit=3),
+                         (['2', '3', '4'], True))
+        self.assertEqual(self.sent(), ["```file02\nfile03```", "```file04```"])
+        listed = frozenset(str(i) for i in range(6))
+        self.assertEqual(drive.send_listing(self.msg_writer, 'C1', pages(4, 4), listed, limit=3), (['6', '7'], False))
+
+    # Test that "more" without an earlier listing says so
+    def test_more_without_listing(self):
+        self.assertEqual(drive.get_more_drive_files(self.msg_writer, {'user': 'UNONE', 'channel': 'C1'}, {}, None),
+                         None)
+        self.assertEqual(self.sent(), ["There's nothing more to show"])
+
+
+class TestDriveListing(unittest.TestCase):
+    def setUp(self):
+        self.msg_writer = Mock(send_message=MagicMock())
+        self.credentials = Mock()
+        self.event = {'user': 'U1', 'channel': 'C1'}
+        self.addCleanup(drive.listings.clear)
+        self.listing_pages = lambda: pages(4, 4)
+        for name in ('get_service', 'listing_pages'):
+            patcher = patch('intenthandlers.drive.' + name, side_effect=lambda *args, **kwargs: self.listing_pages())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Test that "more" pages by the number of files the listing asked for
+    def test_more_keeps_limit(self):
+        wit_entities = {'number': [{'value': 3, 'confidence': 1}]}
+        drive.get_google_drive_list(self.msg_writer, self.event, wit_entities, self.credentials)
+        self.assertEqual(drive.listings['U1'], (frozenset(['0', '1', '2']), 3))
+        drive.get_more_drive_files(self.msg_writer, self.event, {}, self.credentials)
+        self.assertEqual(drive.listings['U1'], (frozenset(str(i) for i in range(6)), 3))
+        self.assertEqual([call[0][1] for call in self.msg_writer.send_message.call_args_list[-3:]],
+                         ["```file03```", "```file04\nfile05```", "Say \"more\" to see the next 3 files"])
+
+    # Test that a "more" which waits for authorization carries on from the same place afterwards
+    def test_more_after_authorization(self):
+        drive.listings['U1'] = (frozenset(['0']), 2)
+        self.credentials.get_credential.return_value = None
+        state = drive.get_more_drive_files(self.msg_writer, self.event, {}, self.credentials)
+        self.assertIsInstance(state, WaitState)
+        self.assertEqual(state.get_intent_value(), 'more-drive-files')
+        self.assertEqual(drive.listings['U1'], (frozenset(['0']), 2))
+
+    # Test that "more" neither skips nor repeats files when the next listing comes in a different order
+    def test_more_in_another_order(self):
+        wit_entities = {'number': [{'value': 3, 'confidence': 1}]}
+        drive.get_google_drive_list(self.msg_writer, self.event, wit_entities, self.credentials)
+        self.listing_pages = lambda: [list(reversed(next(pages(8))))]
+        drive.get_more_drive_files(self.msg_writer, self.event, {}, self.credentials)
+        drive.get_more_drive_files(self.msg_writer, self.event, {}, self.credentials)
+        listed = [name for call in self.msg_writer.send_message.call_args_list if call[0][1].startswith("```")
+                  for name in call[0][1].strip("`").split("\n")]
+        self.assertEqual(sorted(listed), ['file{:02d}'.format(i) for i in range(8)])
+        self.assertNotIn('U1', drive.listings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import time
+import unittest
+from mock import MagicMock, Mock
+from intenthandlers import drive_index
+from intenthandlers.drive_index import DriveIndex, name_query, find_file, get_drive_index, forget_file, listing_pages
+
+
+def request(result):
+    return Mock(execute=MagicMock(return_value=result))
+
+
+class FakeDrive(object):
+    """
+    Serves a listing in pages of two files, and a changes feed
+    """
+    def __init__(self, files, changes=()):
+        self.listing = files
+        self.change_pages = list(changes)
+        self.list_calls = []
+        self.search_calls = []
+        self.change_calls = []
+
+    def files(self):
+        return Mock(list=self._list)
+
+    def changes(self):
+        return Mock(getStartPageToken=MagicMock(return_value=request({'startPageToken': '1'})), list=self._changes)
+
+    def _list(self, pageToken=None, q=None, **kwargs):
+        if q is not None and 'name contains' in q:
+            self.search_calls.append(q)
+            return request({'files': [f for f in self.listing if 'file 3' in f['name'] and 'file' in q]})
+        self.list_calls.append(pageToken)
+        start = int(pageToken or 0)
+        resp = {'files': self.listing[start:start + 2]}
+        if start + 2 < len(self.listing):
+            resp['nextPageToken'] = str(start + 2)
+        return request(resp)
+
+    def _changes(self, pageToken, **kwargs):
+        self.change_calls.append(pageToken)
+        return request(self.change_pages.pop(0))
+
+
+class TestDriveIndex(unittest.TestCase):
+    def setUp(self):
+        self.clock = Mock(return_value=0)
+        self.index = DriveIndex(sync_interval=30, clock=self.clock)
+        self.files = [{'id': str(i), 'name': 'file {}'.format(i), 'kind': 'drive#file'} for i in range(5)]
+
+    # Test that seeding pages through the whole listing
+    def test_seed(self):
+        drive = FakeDrive(self.files)
+        self.index.refresh(drive)
+        self.assertEqual(drive.list_calls, [None, '2', '4'])
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.get('3'), {'id': '3', 'name': 'file 3'})
+        self.assertTrue(self.index.is_seeded())
+
+    # Test that later refreshes read the changes feed, and only once the sync interval has passed
+    def test_sync(self):
+        drive = FakeDrive(self.files, changes=[
+            {'changes': [{'fileId': '0', 'removed': True},
+                         {'fileId': '1', 'file': {'id': '1', 'name': 'file 1', 'trashed': True}}],
+             'nextPageToken': '2'},
+            {'changes': [{'fileId': '9', 'file': {'id': '9', 'name': 'new file'}},
+                         {'fileId': '2', 'file': {'id': '2', 'name': 'renamed'}}],
+             'newStartPageToken': '3'}])
+        self.index.refresh(drive)
+        self.index.refresh(drive)
+        self.assertEqual(drive.change_calls, [])
+        self.clock.return_value = 31
+        self.index.refresh(drive)
+        self.assertEqual(drive.change_calls, ['1', '2'])
+        self.assertEqual([f['name'] for f in self.index.files()], ['file 3', 'file 4', 'new file', 'renamed'])
+        self.assertEqual(self.index._page_token, '3')
+
+    # Test writing the bot's own changes through
+    def test_write_through(self):
+        self.index.refresh(FakeDrive(self.files))
+        self.index.add({'id': '7', 'name': 'created'})
+        self.index.remove('0')
+        self.assertEqual(self.index.get('7')['name'], 'created')
+        self.assertEqual(self.index.get('0'), None)
+
+
+class TestFindFile(unittest.TestCase):
+    def setUp(self):
+        self.files = [{'id': str(i), 'name': 'file {}'.format(i)} for i in range(5)]
+
+    # Test the Drive query built from a typed name
+    def test_name_query(self):
+        self.assertEqual(name_query("Q3 budget-report's"),
+                         "name contains 'budget' and name contains 'report' and trashed = false")
+        self.assertEqual(name_query("a b"), None)
+
+    # Test that an unseeded user's lookup asks Drive, without listing the whole drive
+    def test_search_first(self):
+        drive = FakeDrive(self.files)
+        self.assertEqual(find_file('USEARCH', drive, 'file 3')[:2], ('file 3', '3'))
+        self.assertEqual(len(drive.search_calls), 1)
+        self.assertEqual(drive.list_calls, [])
+
+    # Test falling back to seeding the index when Drive finds nothing, and using the index once seeded
+    def test_fallback(self):
+        drive = FakeDrive(self.files)
+        self.assertEqual(find_file('UFALLBACK', drive, 'fiel 2')[:2], ('file 2', '2'))
+        self.assertEqual(drive.list_calls, [None, '2', '4'])
+        find_file('UFALLBACK', drive, 'file 3')
+        self.assertEqual(len(drive.search_calls), 1)
+        forget_file('UFALLBACK', '3')
+        self.assertEqual(get_drive_index('UFALLBACK', drive).get('3'), None)
+
+
+class TestListingPages(unittest.TestCase):
+    def setUp(self):
+        self.files = [{'id': str(i), 'name': 'file {}'.format(i)} for i in range(5)]
+
+    # Test that a first listing streams from Drive and seeds the index with the same pages
+    def test_seeds_index(self):
+        drive = FakeDrive(self.files)
+        self.assertEqual([len(page) for page in listing_pages('ULIST', drive)], [2, 2, 1])
+        self.assertEqual(drive.list_calls, [None, '2', '4'])
+        self.assertEqual(list(listing_pages('ULIST', drive)), [self.files])
+        self.assertEqual(drive.list_calls, [None, '2', '4'])
+
+    # Test that a listing which stops early still has the rest of the drive read into the index
+    def test_stopped_early(self):
+        drive = FakeDrive(self.files)
+        pages = listing_pages('USTOPPED', drive)
+        self.assertEqual(len(next(pages)), 2)
+        pages.close()
+        index = drive_index._indexes.get('USTOPPED')
+        deadline = time.monotonic() + 5
+        while not index.is_seeded() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(drive.list_calls, [None, '2', '4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
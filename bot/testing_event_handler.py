@@ -3,13 +3,16 @@ import types
 import unittest
 
 from schema import Schema
-from mock import MagicMock
+from mock import MagicMock, Mock
 from wit import Wit
 
 
 from event_handler import RtmEventHandler
 from messenger import Messenger
 from slack_clients import SlackClients
+from reminder_store import ReminderStore
+from state import ReplyState
+from threads import PoolFullError
 
 
 def merge(session_id, context, entities, msg):
@@ -31,7 +34,7 @@ def error(session_id, context, e):
 
 class TestEventHandler(unittest.TestCase, RtmEventHandler):
     def setUp(self):
-        self.clients = SlackClients('na')
+        self.clients = SlackClients('na', reminder_store=ReminderStore(':memory:'))
         self.logger = logging.getLogger(__name__)
         self.actions = {
             'say': say,
@@ -50,16 +53,37 @@ class TestEventHandler(unittest.TestCase, RtmEventHandler):
             self.assertEqual(schema.validate(self.intents[c]), self.intents[c])
 
     def test_handle_message(self):
+        # The RTM thread only cleans the message and hands it to the interpretation stage
         message_text = 'say quote'
         test_message = {'type': 'message', 'channel': 'dummy_channel', 'user': 'dummy_user', 'text': message_text,
                         'ts': '1355517523.000005'}
         self.clients.is_message_from_me = MagicMock(return_value=False)
         self.clients.is_bot_mention = MagicMock(return_value=True)
         self.clients.remove_mention = MagicMock(return_value=message_text)
+        self.interpretation_stage = Mock()
+        self.assertEqual(self._handle_message(test_message), None)
+        self.interpretation_stage.submit.assert_called_once_with('dummy_channel', self._interpret_message,
+                                                                 test_message)
+        self.assertEqual(test_message['cleaned_text'], message_text)
+
+        # A message arriving while the interpretation stage is full is refused, rather than blocking the RTM thread
+        self.interpretation_stage.submit.side_effect = PoolFullError("full")
+        self.msg_writer.send_message = MagicMock(return_value=None)
+        self.assertEqual(self._handle_message(test_message), None)
+        self.assertEqual(self.msg_writer.send_message.call_args[0][0], 'dummy_channel')
+
+    def test_interpret_message(self):
+        message_text = 'say quote'
+        test_message = {'type': 'message', 'channel': 'dummy_channel', 'user': 'dummy_user', 'text': message_text,
+                        'ts': '1355517523.000005', 'cleaned_text': message_text}
         self.wit_client.interpret = MagicMock(return_value={u'entities': {u'randomize_option': [{u'suggested': True, u'confidence': 0.5173704573627974, u'type': u'value', u'value': u'quote'}], u'intent': [{u'confidence': 0.7794858005199589, u'value': u'movie-quote'}]}, u'msg_id': u'89b1ea5b-8844-4106-bfb6-642cd7a48b97', u'_text': u'say quote'})
+        self.clients.get_user_name_from_id = MagicMock(return_value={'id': 'dummy_user'})
+        self.clients.get_channel_name_from_id = MagicMock(return_value={'id': 'dummy_channel'})
+        self.clients.get_dm_id_from_user_id = MagicMock(return_value='dummy_dm')
         self.msg_writer.write_prompt = MagicMock(return_value=None)
+        self.msg_writer.write_error = MagicMock(return_value=None)
         self.msg_writer.send_message = MagicMock(return_value=None)
-        self.assertEqual(self._handle_message(test_message), None)
+        self.assertEqual(self._interpret_message(test_message), None)
 
     # Implicitly tests _handle_by_type
     def test_handle(self):
@@ -76,6 +100,13 @@ class TestEventHandler(unittest.TestCase, RtmEventHandler):
                  'ts': '1355517523.000005'}
         self.assertEqual(self.handle(event), None)
 
+    # Test that a handler's reply is posted once its state is delivered
+    def test_process_reply_state(self):
+        self.msg_writer.send_message = MagicMock(return_value=None)
+        state = {'type': 'state_update', 'state': ReplyState(channel='dummy_channel', text='dummy reply')}
+        self.assertEqual(self.process_state(state), None)
+        self.msg_writer.send_message.assert_called_once_with('dummy_channel', 'dummy reply')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+import random
+import unittest
+from fuzzywuzzy import process
+from intenthandlers.fuzzy_index import FuzzyNameIndex, trigrams
+
+WORDS = ['budget', 'report', 'quarterly', 'minutes', 'roadmap', 'design', 'hiring', 'plan', 'notes', 'draft',
+         'invoice', 'summary', 'london', 'boston', 'tampa', 'review', 'onboarding', 'checklist', 'final', 'v2']
+
+
+class TestFuzzyNameIndex(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.names = {str(i): ' '.join(rng.sample(WORDS, 3)).title() for i in range(500)}
+        self.index = FuzzyNameIndex(candidates=32)
+        for key, name in self.names.items():
+            self.index.add(key, name)
+
+    # Test trigram generation, including words shorter than three characters
+    def test_trigrams(self):
+        self.assertEqual(trigrams('v2 ab'), {' v2', 'v2 ', ' ab', 'ab '})
+
+    # Test that the best match scores (all but) as well as extractOne's, so the threshold means the same
+    def test_matches_extract_one(self):
+        for query in ('budget report', 'quartrly minutes', 'Hiring Plan Final', 'london', 'tampa review notes'):
+            expected = process.extractOne(query, list(self.names.values()))
+            match = self.index.best_match(query, threshold=0)
+            self.assertAlmostEqual(match[2], expected[1], delta=2, msg=query)
+            self.assertEqual(match[2] >= 75, expected[1] >= 75, query)
+            self.assertEqual(self.names[match[1]], match[0])
+
+    # Test the threshold, top k, and removing names
+    def test_search(self):
+        self.assertEqual(self.index.best_match('zzzzqqqq'), None)
+        matches = self.index.search('budget report', limit=5)
+        self.assertEqual(len(matches), 5)
+        self.assertEqual(sorted(matches, key=lambda match: -match[2]), matches)
+        self.index.remove(matches[0][1])
+        self.assertNotIn(matches[0][1], [match[1] for match in self.index.search('budget report', limit=5)])
+        self.index.add('new', 'Budget Report 2016')
+        self.assertEqual(self.index.best_match('budget report 2016')[1], 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
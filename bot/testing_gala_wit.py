@@ -2,7 +2,7 @@ import unittest
 import gala_wit
 import os
 import logging
-from mock import MagicMock
+from mock import MagicMock, patch
 
 
 logging.disable(logging.CRITICAL)
@@ -13,9 +13,10 @@ class TestGalaWit(unittest.TestCase):
 
     # Test galawit initialization
     def test_init(self):
-        os.getenv = MagicMock(return_value="")
         Wit = MagicMock(return_value=None)
-        gw = gala_wit.GalaWit(Wit)
+        # Patch the environment rather than os.getenv, which other modules' tests rely on
+        with patch.dict(os.environ, clear=True):
+            gw = gala_wit.GalaWit(Wit)
         self.assertEqual(gw.wit_client, None)
 
     # Test interpret
@@ -24,5 +25,24 @@ class TestGalaWit(unittest.TestCase):
         gw.wit_client.message = MagicMock(return_value="test1")
         self.assertEqual(gw.interpret("dummy message"), 'test1')
 
+    # Test that messages differing only in case, spacing or mention labels share a cache key
+    def test_normalize_message(self):
+        self.assertEqual(gala_wit.normalize_message("Flip a coin "), "flip a coin")
+        self.assertEqual(gala_wit.normalize_message("nag  <@U123|john> about\thal"), "nag <@u123> about hal")
+
+    # Test that a cached response is reused, with entity values in the casing of the new message
+    def test_interpret_cached(self):
+        gw = gala_wit.GalaWit()
+        resp = {'_text': 'create Notes', 'entities': {'intent': [{'confidence': 0.9, 'value': 'create'}],
+                                                      'randomize_option': [{'confidence': 0.9, 'value': 'Notes'}]}}
+        gw.wit_client.message = MagicMock(return_value=resp)
+        gw.interpret("create Notes")
+        cached = gw.interpret("Create notes ")
+        self.assertEqual(gw.wit_client.message.call_count, 1)
+        self.assertEqual(cached['_text'], "Create notes ")
+        self.assertEqual(cached['entities']['randomize_option'][0]['value'], 'notes')
+        self.assertEqual(cached['entities']['intent'][0]['value'], 'create')
+        self.assertEqual(resp['entities']['randomize_option'][0]['value'], 'Notes')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
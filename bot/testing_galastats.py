@@ -1,6 +1,10 @@
+import os
 import unittest
-from mock import MagicMock, Mock
+from mock import MagicMock, Mock, patch
 import intenthandlers.galastats as gs
+from intenthandlers.credential_store import MemoryCredentialStore
+from intenthandlers.google_helpers import GoogleCredentials
+from user_directory import UserDirectory
 
 
 class TestGalastats(unittest.TestCase):
@@ -13,16 +17,92 @@ class TestGalastats(unittest.TestCase):
         attrs = {'send_message.return_value': None}
         msg_writer_mock = Mock()
         msg_writer_mock.configure_mock(**attrs)
-        event = {'channel': 'dummy channel'}
+        event = {'channel': 'dummy channel', 'user': 'U1'}
         wit_entities = "dummy entities"
+        credentials = Mock(default_user='UHAL')
+        office_counts = Mock()
+        office_counts.get.return_value = {'LN': '10', 'FL': '20', 'MA': '30'}
 
-        # Test no location, valid location, and invalid location
-        get_highest_confidence_entity = MagicMock(return_value=None)
-        self.assertEqual(gs.count_galateans(msg_writer_mock, event, wit_entities, get_highest_confidence_entity), None)
-        get_highest_confidence_entity = MagicMock(return_value={'value': 'england'})
-        self.assertEqual(gs.count_galateans(msg_writer_mock, event, wit_entities, get_highest_confidence_entity), None)
-        get_highest_confidence_entity = MagicMock(return_value={'value': 'atlanta'})
-        self.assertEqual(gs.count_galateans(msg_writer_mock, event, wit_entities, get_highest_confidence_entity), None)
+        # Test no location, valid location, and invalid location. The counts are returned as a reply, not sent
+        with patch.object(gs, 'office_counts', office_counts):
+            get_highest_confidence_entity = MagicMock(return_value=None)
+            reply = gs.count_galateans(msg_writer_mock, event, wit_entities, credentials, get_highest_confidence_entity)
+            self.assertEqual(reply.channel, 'dummy channel')
+            self.assertEqual(reply.text.count('\n'), 4)
+            get_highest_confidence_entity = MagicMock(return_value={'value': 'england'})
+            reply = gs.count_galateans(msg_writer_mock, event, wit_entities, credentials, get_highest_confidence_entity)
+            self.assertTrue(reply.text.endswith('LN             10'))
+            get_highest_confidence_entity = MagicMock(return_value={'value': 'atlanta'})
+            reply = gs.count_galateans(msg_writer_mock, event, wit_entities, credentials, get_highest_confidence_entity)
+            self.assertEqual(reply.text.count('\n'), 4)
+        msg_writer_mock.send_message.assert_not_called()
+        # The counts are read as the service identity, not the asking user
+        office_counts.get.assert_called_with(credentials.service_credential.return_value, 'UHAL')
+        credentials.get_credential.assert_not_called()
+
+    # Test that the asking user's credentials are used until the service identity has authorized the bot
+    def test_count_galateans_no_service_credential(self):
+        credentials = Mock(default_user='UHAL')
+        credentials.service_credential.return_value = None
+        credentials.get_credential.return_value = None
+        event = {'channel': 'dummy channel', 'user': 'U1'}
+        state = gs.count_galateans(Mock(), event, {}, credentials, MagicMock(return_value=None))
+        self.assertEqual(state.intent_value, 'galatean-count')
+        self.assertEqual(credentials.get_credential.call_args[1], {'user': 'U1'})
+
+    # Test that a DEFAULT_USER naming no one falls back to the asking user, without waiting on the user directory
+    def test_count_galateans_unknown_default_user(self):
+        slack_client = Mock(users=UserDirectory(), get_id_from_user_name=Mock(side_effect=LookupError))
+        credentials = GoogleCredentials(Mock(), slack_client, store=MemoryCredentialStore())
+        self.addCleanup(credentials.refresher.join, 5)
+        credentials.get_credential = Mock(return_value=None)
+        event = {'channel': 'dummy channel', 'user': 'U1'}
+        for default_user in ('Nobody', ''):
+            with patch.dict(os.environ, {'DEFAULT_USER': default_user}):
+                state = gs.count_galateans(Mock(), event, {}, credentials, MagicMock(return_value=None))
+            self.assertEqual(state.intent_value, 'galatean-count')
+            self.assertEqual(credentials.get_credential.call_args[1], {'user': 'U1'})
+        slack_client.get_id_from_user_name.assert_not_called()
+
+
+class FakeServices(object):
+    """
+    Stands in for get_service, with a spreadsheet whose version and rows the test sets
+    """
+    def __init__(self, rows):
+        self.version = '1'
+        self.drive = MagicMock()
+        self.drive.files().get().execute.side_effect = lambda: {'version': self.version,
+                                                                'modifiedTime': '2016-07-01T12:00:00.000Z'}
+        self.sheets = MagicMock()
+        self.sheets.spreadsheets().values().batchGet().execute.return_value = {'valueRanges': [{'values': rows}]}
+        self.batch_get = self.sheets.spreadsheets().values().batchGet
+        self.batch_get.reset_mock()
+
+    def __call__(self, api, version, credentials, user=None, **kwargs):
+        return self.drive if api == 'drive' else self.sheets
+
+
+class TestOfficeStatsLoader(unittest.TestCase):
+    # Test that the values are only downloaded, in one batchGet, when the spreadsheet's version changes
+    def test_conditional_download(self):
+        services = FakeServices([['FL', '20'], ['LN', '10'], ['MA', '30']])
+        loader = gs.OfficeStatsLoader()
+        with patch.object(gs, 'get_service', services):
+            table = loader(Mock(), 'UHAL')
+            self.assertEqual(dict(table), {'FL': '20', 'LN': '10', 'MA': '30'})
+            self.assertIs(loader(Mock(), 'UHAL'), table)
+            self.assertEqual(services.batch_get.call_count, 1)
+            services.version = '2'
+            loader(Mock(), 'UHAL')
+            self.assertEqual(services.batch_get.call_count, 2)
+        self.assertEqual(services.batch_get.call_args[1]['ranges'], gs.STATS_RANGES)
+
+    # Test that rows are keyed by the office they name, and rows naming no office are skipped
+    def test_parse_office_counts(self):
+        table = gs.parse_office_counts([['Tampa', '20'], ['ln ', '10'], ['Total', '30'], ['Atlantis', '1'],
+                                        ['Boston', '5'], ['MA']])
+        self.assertEqual(list(table.items()), [('FL', '20'), ('LN', '10'), ('MA', '5')])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import threading
+import unittest
+from mock import MagicMock, Mock, patch
+from intenthandlers import google_services
+from intenthandlers.google_services import GoogleServiceRegistry, LockedHttp, DISCOVERY_URLS, build_service
+
+
+def make_credentials():
+    return Mock(authorize=MagicMock(side_effect=lambda http: http))
+
+
+class TestGoogleServiceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.build = MagicMock(side_effect=lambda api, version, http, **kwargs: Mock(api=api, http=http))
+        self.registry = GoogleServiceRegistry(maxsize=2, build=self.build)
+
+    # Test that services are built once per (api, version, user), on a shared, locked http
+    def test_get(self):
+        creds = make_credentials()
+        drive = self.registry.get('drive', 'v3', creds, user='U1')
+        self.assertIs(self.registry.get('drive', 'v3', creds, user='U1'), drive)
+        self.assertIsInstance(drive.http, LockedHttp)
+        self.assertIsNot(self.registry.get('drive', 'v3', make_credentials(), user='U2'), drive)
+        self.assertEqual(self.build.call_count, 2)
+
+    # Test that a service is rebuilt when the user's credentials are replaced
+    def test_credentials_rotated(self):
+        drive = self.registry.get('drive', 'v3', make_credentials(), user='U1')
+        self.assertIsNot(self.registry.get('drive', 'v3', make_credentials(), user='U1'), drive)
+        self.assertEqual(self.build.call_count, 2)
+
+    # Test that the least recently used service is dropped
+    def test_lru(self):
+        creds = make_credentials()
+        self.registry.get('drive', 'v3', creds, user='U1')
+        self.registry.get('gmail', 'v1', creds, user='U1')
+        self.registry.get('drive', 'v3', creds, user='U1')
+        self.registry.get('sheets', 'v4', creds, user='U1')
+        self.assertEqual(len(self.registry), 2)
+        self.registry.get('drive', 'v3', creds, user='U1')
+        self.assertEqual(self.build.call_count, 3)
+        self.registry.invalidate('U1')
+        self.assertEqual(len(self.registry), 0)
+
+    # Test that threads asking for the same service at once build it once
+    def test_concurrent_build(self):
+        creds = make_credentials()
+        threads = [threading.Thread(target=self.registry.get, args=('drive', 'v3', creds, 'U1')) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.build.call_count, 1)
+
+
+class TestBuildService(unittest.TestCase):
+    # Test that every api the bot uses has a pinned discovery document, and is built without the network
+    def test_pinned(self):
+        http = Mock(request=MagicMock(side_effect=Exception("No network")))
+        for api, version in DISCOVERY_URLS:
+            self.assertTrue(hasattr(build_service(api, version, http), 'new_batch_http_request'))
+        self.assertEqual(http.request.call_count, 0)
+
+    # Test falling back to fetching the discovery document when none is pinned
+    def test_fallback(self):
+        with patch.object(google_services, 'pinned_document', return_value=None), \
+                patch.object(google_services.discovery, 'build', return_value="fetched") as build:
+            self.assertEqual(build_service('sheets', 'v4', "http", discoveryServiceUrl="url"), "fetched")
+            build.assert_called_once_with('sheets', 'v4', http="http", discoveryServiceUrl="url")
+
+
+if __name__ == '__main__':
+    unittest.main()
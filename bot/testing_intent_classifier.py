@@ -0,0 +1,85 @@
+import unittest
+import gala_wit
+import intent_classifier as ic
+from mock import MagicMock
+
+
+class TestRuleClassifier(unittest.TestCase):
+    def setUp(self):
+        self.classifier = ic.RuleClassifier()
+
+    def intent_of(self, msg):
+        resp = self.classifier.classify(msg)
+        return ic.intent_confidence(resp)[0] if resp else None
+
+    # Test the commands the rules should recognise
+    def test_recognised(self):
+        self.assertEqual(self.intent_of("flip a coin"), 'coin-flip')
+        self.assertEqual(self.intent_of("Toss a coin!"), 'coin-flip')
+        self.assertEqual(self.intent_of("movie quote"), 'movie-quote')
+        self.assertEqual(self.intent_of("say quote"), 'movie-quote')
+        self.assertEqual(self.intent_of("Decide between burgers and tacos"), 'randomize')
+        self.assertEqual(self.intent_of("burgers or tacos?"), 'randomize')
+        self.assertEqual(self.intent_of("more"), 'more-drive-files')
+        self.assertEqual(self.intent_of("show me more files please"), 'more-drive-files')
+
+    # Test that randomize options come back as wit would send them
+    def test_randomize_options(self):
+        resp = self.classifier.classify("pick pizza, burgers or tacos")
+        options = [entity['value'] for entity in resp['entities']['randomize_option']]
+        self.assertEqual(options, ['pizza', 'burgers', 'tacos'])
+
+    # Test that other commands are left to wit
+    def test_not_recognised(self):
+        self.assertEqual(self.intent_of("nag John Casey about lunch or dinner"), None)
+        self.assertEqual(self.intent_of("delete notes or drafts"), None)
+        self.assertEqual(self.intent_of("how many galateans are in boston"), None)
+        self.assertEqual(self.intent_of("pick drive files or email"), None)
+
+    # Test that only an "X or Y" with a decision cue is confident enough to skip wit
+    def test_either_needs_cue(self):
+        resp = self.classifier.classify("Should I stay or go?")
+        self.assertEqual(ic.intent_confidence(resp), ('randomize', 0.95))
+        self.assertEqual([entity['value'] for entity in resp['entities']['randomize_option']], ['stay', 'go'])
+        for msg in ("is it monday or tuesday", "burgers or tacos", "more or less"):
+            self.assertLess(ic.intent_confidence(self.classifier.classify(msg))[1], ic.DEFAULT_THRESHOLD)
+
+
+class TestPhraseClassifier(unittest.TestCase):
+    # Test training from logged responses, including the minimum count and the agreement scaling
+    def test_train(self):
+        quote = {'entities': {'intent': [{'confidence': 1.0, 'value': 'galatean-count'}]}}
+        other = {'entities': {'intent': [{'confidence': 1.0, 'value': 'movie-quote'}]}}
+        records = [{'msg': "How many galateans", 'resp': quote}] * 3 + [{'msg': "how many galateans", 'resp': other}]
+        records += [{'msg': "rare phrase", 'resp': quote}]
+        model = ic.PhraseClassifier.train(records)
+        self.assertEqual(list(model.phrases), ['how many galateans'])
+        resp = model.classify("how many  Galateans")
+        self.assertEqual(ic.intent_confidence(resp), ('galatean-count', 0.75))
+        self.assertEqual(model.classify("rare phrase"), None)
+
+
+class TestGalaWitPreClassifier(unittest.TestCase):
+    # Test that confident local answers skip wit, and unsure ones fall through
+    def test_fall_through(self):
+        gw = gala_wit.GalaWit(pre_classifier=ic.LocalIntentClassifier([ic.RuleClassifier()]), threshold=0.95)
+        gw.wit_client.message = MagicMock(return_value={'entities': {}})
+        self.assertEqual(ic.intent_confidence(gw.interpret("flip a coin"))[0], 'coin-flip')
+        self.assertEqual(gw.wit_client.message.call_count, 0)
+        gw.interpret("burgers or tacos")  # Has no decision cue, so wit is asked
+        self.assertEqual(gw.wit_client.message.call_count, 1)
+        self.assertEqual(gw.local_hit_report()['local_hits'] >= 1, True)
+
+    # Test the offline report
+    def test_report(self):
+        coin = {'entities': {'intent': [{'confidence': 1.0, 'value': 'coin-flip'}]}}
+        records = [{'msg': "flip a coin", 'resp': coin, 'latency': 0.5},
+                   {'msg': "send an email", 'resp': {'entities': {}}, 'latency': 0.5}]
+        results = ic.report(records, ic.LocalIntentClassifier([ic.RuleClassifier()]))
+        self.assertEqual(results['local_hit_ratio'], 0.5)
+        self.assertEqual(results['agreement_with_wit'], 1.0)
+        self.assertEqual(results['latency_saved_seconds'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
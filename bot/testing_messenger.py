@@ -3,12 +3,15 @@ import logging
 
 from mock import MagicMock, Mock
 from messenger import Messenger
+from threads import MessageCoalescer, PRIORITY_ERROR, PRIORITY_NORMAL
 
 logger = logging.getLogger(__name__)
 
 class TestMessenger(unittest.TestCase, Messenger):
     def setUp(self):
-        pass
+        self.scheduler = None
+        self.coalescer = None
+        self.loop = None
 
     # Test send message
     def test_send_message(self):
@@ -17,6 +20,30 @@ class TestMessenger(unittest.TestCase, Messenger):
         self.clients.send_message = MagicMock(return_value=None)
         self.assertEqual(self.send_message("dummy channel", "dummy message"), None)
 
+    # Test that messages go through the scheduler when there is one, and that errors jump the queue
+    def test_send_message_scheduled(self):
+        self.scheduler = Mock(submit=MagicMock())
+        self.send_message({'id': 'C1'}, "dummy message")
+        self.write_error('C1', "dummy error message")
+        self.assertEqual(self.scheduler.submit.call_args_list[0][0][:2], ('C1', PRIORITY_NORMAL))
+        self.assertEqual(self.scheduler.submit.call_args_list[1][0][:2], ('C1', PRIORITY_ERROR))
+
+    # Test that messages to the same channel within the window are sent as one, in order
+    def test_send_message_coalesced(self):
+        self.scheduler = Mock(submit=MagicMock())
+        self.coalescer = MessageCoalescer(60, self._send_coalesced)
+        self.coalescer.start()
+        self.send_message('C1', "first")
+        self.send_message('C2', "other")
+        self.send_message('C1', "second")
+        self.write_error('C1', "oops")
+        self.close()
+        calls = sorted(call[0] for call in self.scheduler.submit.call_args_list)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][:2], ('C1', PRIORITY_ERROR))
+        self.assertTrue(calls[0][4].startswith("first\nsecond\n:face_with_head_bandage:"))
+        self.assertEqual(calls[1][4], "other")
+
     # Test write prompt
     def test_write_prompt(self):
         dummy_handlers = {
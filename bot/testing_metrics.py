@@ -0,0 +1,55 @@
+import threading
+import unittest
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    # Test that counters count across threads
+    def test_counter(self):
+        counter = self.registry.counter('test.counter')
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(), 4000)
+
+    # Test that asking for an existing metric returns the same metric
+    def test_registry_reuse(self):
+        self.assertIs(self.registry.counter('test.counter'), self.registry.counter('test.counter'))
+        self.assertRaises(TypeError, self.registry.gauge, 'test.counter')
+
+    # Test gauges, both set directly and backed by a function
+    def test_gauge(self):
+        gauge = self.registry.gauge('test.gauge')
+        gauge.inc(3)
+        gauge.dec()
+        self.assertEqual(gauge.value(), 2)
+        depth = [5]
+        function_gauge = self.registry.gauge('test.function_gauge', lambda: depth[0])
+        depth[0] = 7
+        self.assertEqual(function_gauge.value(), 7)
+
+    # Test histogram percentiles and buckets
+    def test_histogram(self):
+        histogram = self.registry.histogram('test.histogram', buckets=(1, 10))
+        for value in range(1, 101):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['max'], 100)
+        self.assertEqual(snapshot['p50'], 51)
+        self.assertEqual(snapshot['buckets'], {'1': 1, '10': 9, '+Inf': 90})
+
+    # Test that the snapshot covers every metric
+    def test_snapshot(self):
+        self.registry.counter('test.counter').inc()
+        self.registry.gauge('test.gauge').set(4)
+        self.assertEqual(self.registry.snapshot(), {'test.counter': 1, 'test.gauge': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ from messenger import Messenger
 from mock import MagicMock
 from wit import Wit
 from slack_clients import SlackClients
+from reminder_store import ReminderStore
 
 
 def merge(session_id, context, entities, msg):
@@ -28,7 +29,7 @@ def error(session_id, context, e):
 class TestMisc(unittest.TestCase):
     def setUp(self):
         # Set up environment to allow for misc testing
-        self.clients = SlackClients('na')
+        self.clients = SlackClients('na', reminder_store=ReminderStore(':memory:'))
         self.logger = logging.getLogger(__name__)
         self.actions = {
             'say': say,
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from reminder_store import ReminderStore
+
+
+class TestReminderStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'reminders.sqlite')
+        self.store = ReminderStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    # Test that reminders survive a restart, with their next firing time updated
+    def test_persisted(self):
+        self.store.put('n1', 100, 7200, 'D1', "You need to do the thing", context={'nag_subject': 'the thing'})
+        self.store.put('n2', 50, 7200, 'D2', "You need to do the other thing")
+        self.store.reschedule('n1', 7300)
+        self.store.delete('n2')
+        self.store.close()
+        self.store = ReminderStore(self.path)
+        self.assertEqual(list(self.store.batches()), [[{'id': 'n1', 'next_fire': 7300, 'interval': 7200, 'channel': 'D1',
+                                                        'text': "You need to do the thing",
+                                                        'context': {'nag_subject': 'the thing'}}]])
+
+    # Test that batches are soonest first, and every reminder is read once, including ones due at the same time
+    def test_batches(self):
+        for i in range(25):
+            self.store.put('n{:02d}'.format(i), i // 4, 7200, 'D1', "nag")
+        batches = list(self.store.batches(batch_size=10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        ids = [reminder['id'] for batch in batches for reminder in batch]
+        self.assertEqual(ids, ['n{:02d}'.format(i) for i in range(25)])
+        self.assertEqual(len(self.store), 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
+import socket
 import unittest
-from mock import MagicMock, Mock
-from slack_bot import SlackBot
+from queue import Queue
+from mock import MagicMock, Mock, patch
+from reminder_store import ReminderStore
+from slack_bot import SlackBot, RTM_MODE_ASYNCIO, RTM_MODE_THREADED
 
 class TestSlackBot(unittest.TestCase):
     def setUp(self):
@@ -36,8 +39,65 @@ class TestSlackBot(unittest.TestCase):
         slackbot.clients.rtm.server.domain = "dummy domain"
         slackbot.clients.rtm.rtm_read = MagicMock(return_value=['event1', 'event2', 'event3'])
 
-        # Ensure that start completes without error
-        self.assertEqual(slackbot.start(resource, mock_messenger, mock_rtm), None)
+        # Ensure that start completes without error. The clients it creates keep their nags in memory
+        with patch('slack_clients.ReminderStore.from_env', return_value=ReminderStore(':memory:')):
+            self.assertEqual(slackbot.start(resource, mock_messenger, mock_rtm), None)
+
+    def test_start_threaded(self):
+        # The polling fallback should dispatch every event read, and exit once stopped
+        slackbot = SlackBot(Queue(), Queue(), run_mode=RTM_MODE_THREADED)
+        slackbot.clients = Mock(rtm=Mock(server=Mock(login_data={'team': {'name': None}})))
+        slackbot.clients.created_at = 0
+        slackbot.clients.rtm.rtm_connect = MagicMock(return_value=True)
+        slackbot.clients.rtm.rtm_read = MagicMock(return_value=['event1', 'event2'])
+        mock_event_handler = Mock()
+        mock_event_handler.handle = MagicMock(side_effect=lambda event: slackbot.stop(None))
+        mock_rtm = MagicMock(return_value=mock_event_handler)
+
+        self.assertEqual(slackbot.start({}, MagicMock(), mock_rtm), None)
+        self.assertEqual(mock_event_handler.handle.call_count, 2)
+        # The user directory warms up in the background once connected
+        slackbot.clients.start_user_warm_up.assert_called_once_with()
+
+    def test_start_asyncio(self):
+        # The event driven loop should dispatch events that are already buffered, and exit once stopped
+        reader, writer = socket.socketpair()
+        slackbot = SlackBot(Queue(), Queue(), run_mode=RTM_MODE_ASYNCIO)
+        slackbot.clients = Mock(rtm=Mock(server=Mock(login_data={'team': {'name': None}},
+                                                     websocket=Mock(sock=reader))))
+        slackbot.clients.created_at = 0
+        slackbot.clients.rtm.rtm_connect = MagicMock(return_value=True)
+        slackbot.clients.rtm.rtm_read = MagicMock(side_effect=[['event1', 'event2'], []])
+        mock_event_handler = Mock()
+        mock_event_handler.handle = MagicMock(side_effect=lambda event: slackbot.stop(None))
+        mock_rtm = MagicMock(return_value=mock_event_handler)
+
+        self.assertEqual(slackbot.start({}, MagicMock(), mock_rtm), None)
+        self.assertEqual(mock_event_handler.handle.call_count, 2)
+        self.assertEqual(slackbot.loop, None)
+        reader.close()
+        writer.close()
+
+    def test_start_asyncio_drains_state(self):
+        # A state queued while the loop runs is applied before start returns, and the drain leaves nothing behind
+        reader, writer = socket.socketpair()
+        state_q = Queue()
+        state_q.put({'type': 'state_update', 'state': 'dummy state'})
+        slackbot = SlackBot(state_q, Queue(), run_mode=RTM_MODE_ASYNCIO)
+        slackbot.clients = Mock(rtm=Mock(server=Mock(login_data={'team': {'name': None}},
+                                                     websocket=Mock(sock=reader))))
+        slackbot.clients.created_at = 0
+        slackbot.clients.rtm.rtm_connect = MagicMock(return_value=True)
+        slackbot.clients.rtm.rtm_read = MagicMock(side_effect=[['event1'], []])
+        mock_event_handler = Mock()
+        mock_event_handler.handle = MagicMock(side_effect=lambda event: slackbot.stop(None))
+        mock_rtm = MagicMock(return_value=mock_event_handler)
+
+        self.assertEqual(slackbot.start({}, MagicMock(), mock_rtm), None)
+        mock_event_handler.process_state.assert_called_once_with({'type': 'state_update', 'state': 'dummy state'})
+        self.assertTrue(state_q.empty())
+        reader.close()
+        writer.close()
 
     def test_stop(self):
         # Test to ensure that the keep_running variable is properly set to false
@@ -1,6 +1,13 @@
+import time
 import unittest
+import uuid
+from queue import Queue
 from mock import MagicMock, Mock
 import slack_clients
+from threads import ReminderScheduler, PRIORITY_BULK
+from reminder_store import ReminderStore
+from user_directory import UserDirectory
+from workspace import WorkspaceMetadata
 
 
 class TestSlackClients(unittest.TestCase, slack_clients.SlackClients):
@@ -48,5 +55,119 @@ class TestSlackClients(unittest.TestCase, slack_clients.SlackClients):
         self.rtm.server.send_to_websocket = MagicMock(return_value=None)
         self.assertEqual(self.send_user_typing_pause("dummy channel"), None)
 
+    # Test that name lookups use the user directory, and see updates from user_change events
+    def test_get_id_from_user_name(self):
+        self.users = UserDirectory([{'id': 'U1', 'profile': {'real_name': 'John Casey'}}])
+        self.users.mark_complete()
+        self.assertEqual(self.get_id_from_user_name('John Casey'), 'U1')
+        self.workspace = WorkspaceMetadata(self.users)
+        self.update_workspace({'type': 'user_change', 'user': {'id': 'U1', 'profile': {'real_name': 'Johnny Casey'}}})
+        self.assertEqual(self.get_id_from_user_name('johnny casey'), 'U1')
+        self.assertRaises(LookupError, self.get_id_from_user_name, 'John Casey')
+
+    # Test that the user list is paged through with cursors, and marks the directory complete
+    def test_warm_up_users(self):
+        pages = [
+            '{"ok": true, "members": [{"id": "U1", "profile": {}}], "response_metadata": {"next_cursor": "abc"}}',
+            '{"ok": true, "members": [{"id": "U2", "profile": {}}], "response_metadata": {"next_cursor": ""}}'
+        ]
+        self.http = Mock(get=MagicMock(side_effect=[Mock(status_code=200, text=page) for page in pages]))
+        self.users = UserDirectory()
+        self.created_at = 0
+        self.warm_up_users()
+        self.assertEqual(len(self.users), 2)
+        self.assertTrue(self.users.is_complete())
+        self.http.get.assert_called_with("users.list", limit=slack_clients.USERS_LIST_PAGE_SIZE, cursor="abc")
+
+    # Test that the directory is marked complete even if paging through the user list raises
+    def test_warm_up_users_error(self):
+        self.http = Mock(get=MagicMock(side_effect=[Mock(status_code=200, text='not json')]))
+        self.users = UserDirectory()
+        self.created_at = 0
+        self.assertRaises(ValueError, self.warm_up_users)
+        self.assertTrue(self.users.is_complete())
+
+    # Test that channel and DM lookups come from the workspace metadata, and only go to the Web API on a miss
+    def test_workspace_lookups(self):
+        self.workspace = WorkspaceMetadata()
+        self.workspace.seed({'channels': [{'id': 'C1', 'name': 'general', 'members': ['U1']}],
+                             'groups': [], 'ims': [{'id': 'D1', 'user': 'U1'}], 'users': []})
+        self.http = Mock(get=MagicMock(return_value=Mock(status_code=200, text='{"channel": {"id": "D2"}}')))
+        self.assertEqual(self.get_channel_name_from_id('C1'), {'id': 'C1', 'name': 'general'})
+        self.assertEqual(self.get_dm_id_from_user_id('U1'), 'D1')
+        self.assertEqual(self.http.get.call_count, 0)
+        self.assertEqual(self.get_dm_id_from_user_id('U2'), 'D2')
+        self.assertEqual(self.get_dm_id_from_user_id('U2'), 'D2')
+        self.assertEqual(self.http.get.call_count, 1)
+
+    # Test that a nag is a stored reminder keyed by its conversation, sent at once, and cancelled by the response
+    def test_nag(self):
+        self.users = UserDirectory([{'id': 'U1', 'profile': {'real_name': 'John Casey'}}])
+        self.workspace = WorkspaceMetadata(self.users)
+        self.workspace.seed({'channels': [], 'groups': [], 'ims': [{'id': 'D1', 'user': 'U1'}], 'users': []})
+        self.reminders = ReminderScheduler()
+        self.reminder_store = ReminderStore(':memory:')
+        msg_writer = Mock()
+        wit_entities = {'name': [{'value': 'John Casey', 'confidence': 1}],
+                        'randomize_option': [{'value': 'file expenses', 'confidence': 1}]}
+        event = {'user': 'U2', 'channel': 'C1', 'user_name': {'real_name': 'Sarah Walker'}}
+        conversation = self.nag_users(msg_writer, event, wit_entities, None)
+        self.assertIn(conversation.get_id(), self.reminders)
+        for _, function, args, kwargs in self.reminders._take_due():
+            function(*args, **kwargs)
+        msg_writer.send_message.assert_called_with('D1', "You need to file expenses. Sarah Walker said so",
+                                                   priority=PRIORITY_BULK)
+        stored = list(self.reminder_store.batches())[0][0]
+        self.assertGreater(stored['next_fire'], time.time() + slack_clients.NAG_INTERVAL - 60)
+        self.assertEqual(stored['context']['nag_subject'], 'file expenses')
+
+        self.nag_response(msg_writer, {'channel': 'D1', 'conversation': conversation}, {}, None)
+        self.assertNotIn(conversation.get_id(), self.reminders)
+        self.assertEqual(len(self.reminder_store), 0)
+        self.assertTrue(conversation.finished)
+
+    # Test that stored nags are rescheduled, missed ones fire once within the jitter window, and their conversations
+    # are put back
+    def test_restore_nags(self):
+        self.reminders = ReminderScheduler(jitter=60)
+        self.reminder_store = ReminderStore(':memory:')
+        missed, upcoming = uuid.uuid4(), uuid.uuid4()
+        context = {'return': {'user': 'U2', 'channel': 'C1'}, 'user_name_to_nag': 'John Casey',
+                   'nag_subject': 'file expenses'}
+        self.reminder_store.put(missed, time.time() - 5 * slack_clients.NAG_INTERVAL, slack_clients.NAG_INTERVAL,
+                                'D1', "nag", context=context)
+        self.reminder_store.put(upcoming, time.time() + 600, slack_clients.NAG_INTERVAL, 'D1', "nag", context=context)
+        state_q = Queue()
+        self.restore_nags(Mock(), state_q)
+        now = self.reminders._clock()
+        self.assertLessEqual(self.reminders._reminders[missed][0], now + 60)
+        self.assertGreater(self.reminders._reminders[upcoming][0], now + 590)
+        restored = [state_q.get()['state'] for _ in range(2)]
+        self.assertEqual([conversation.get_id() for conversation in restored], [missed, upcoming])
+        self.assertEqual(restored[0].get_context()['nag_subject'], 'file expenses')
+        self.assertEqual(restored[0].get_waiting_for(), ['nag-response'])
+
+    # Test that a nag which fires during the restore, and so is read again by a later batch, is restored once
+    def test_restore_nags_fired_during_restore(self):
+        self.reminders = ReminderScheduler(jitter=60)
+        self.reminder_store = ReminderStore(':memory:')
+        nags = [uuid.uuid4(), uuid.uuid4()]
+        for i, nag in enumerate(nags):
+            self.reminder_store.put(nag, time.time() - 10 + i, slack_clients.NAG_INTERVAL, 'D1', "nag")
+        batches = self.reminder_store.batches
+
+        def firing_batches():
+            # Each nag fires, and is rescheduled, as soon as it has been read, as a missed nag may
+            fired = set()
+            for batch in batches(batch_size=1):
+                yield batch
+                if batch[0]['id'] not in fired:
+                    fired.add(batch[0]['id'])
+                    self.reminder_store.reschedule(batch[0]['id'], time.time() + slack_clients.NAG_INTERVAL)
+        self.reminder_store.batches = firing_batches
+        state_q = Queue()
+        self.restore_nags(Mock(), state_q)
+        self.assertEqual(sorted(state_q.get_nowait()['state'].get_id() for _ in range(state_q.qsize())), sorted(nags))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
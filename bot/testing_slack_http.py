@@ -0,0 +1,97 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from slacker import Slacker
+from slack_http import SlackHttp
+
+
+class CountingServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand in for slack.com which counts the TCP connections it accepts
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.connections = 0
+        self.paths = []
+
+    def get_request(self):
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.paths.append(self.path)
+        body = json.dumps({'ok': True, 'user': {'id': 'U1'}, 'channel': {'id': 'D1'}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSlackHttp(unittest.TestCase):
+    def setUp(self):
+        self.server = CountingServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        base_url = 'http://127.0.0.1:{}/api/'.format(self.server.server_address[1])
+        self.http = SlackHttp('token', base_url=base_url, pool_size=2, timeout=5)
+
+    def tearDown(self):
+        self.http.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    # Sequential calls should all go over one kept-alive connection
+    def test_connection_reuse(self):
+        for _ in range(20):
+            resp = self.http.get('users.info', user='U1')
+            self.assertEqual(resp.json()['user']['id'], 'U1')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.http.connections_opened(), 1)
+        self.assertAlmostEqual(self.http.connection_reuse_ratio(), 0.95)
+        self.assertTrue(self.server.paths[0].startswith('/api/users.info?'))
+        self.assertIn('token=token', self.server.paths[0])
+
+    # Requests made through another instance should not count towards this one's reuse ratio
+    def test_reuse_ratio_per_instance(self):
+        other = SlackHttp('token', base_url=self.http.base_url, pool_size=2, timeout=5)
+        for _ in range(3):
+            other.get('users.info', user='U1')
+        self.http.get('users.info', user='U1')
+        self.assertEqual(self.http.connection_reuse_ratio(), 0.0)
+        self.assertAlmostEqual(other.connection_reuse_ratio(), 2.0 / 3)
+        other.session.close()
+
+    # Slacker and slackclient style calls should share the same pool
+    def test_shared_by_slacker_and_rtm(self):
+        web = self.http.bind_slacker(Slacker('token'))
+        web.chat.post_message('C1', 'hello', as_user='true')
+        web.users.info('U1')
+        self.http.requester().do('token', 'rtm.start')
+        self.http.post('im.open', user='U1')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([path.split('?')[0] for path in self.server.paths],
+                         ['/api/chat.postMessage', '/api/users.info', '/api/rtm.start', '/api/im.open'])
+
+
+if __name__ == '__main__':
+    unittest.main()
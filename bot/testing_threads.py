@@ -0,0 +1,455 @@
+import threading
+import time
+import unittest
+import datetime
+from concurrent.futures import Future
+from queue import Queue
+from mock import MagicMock, Mock
+from threads import OrderedWorkerPool, TokenBucket, OutboundScheduler, MessageCoalescer, TokenRefresher, ReminderScheduler, PRIORITY_ERROR, PRIORITY_NORMAL, PRIORITY_BULK
+from threads import FutureSupervisor, IntentPolicy, WorkerPoolThread, RETRY_IDEMPOTENT, RETRY_NEVER
+from threads import BulkheadPool, PoolFullError, POOL_LOCAL, POOL_GOOGLE, POOL_DEFAULT
+
+
+class TestOrderedWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = OrderedWorkerPool(4, name='test_pool')
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    # Tasks with the same key must run in submission order, even when earlier ones are slower
+    def test_order_within_key(self):
+        results = []
+        for i in range(20):
+            self.pool.submit('channel', lambda i=i: (time.sleep(0.001 * (20 - i)), results.append(i)))
+        self.pool.shutdown()
+        self.assertEqual(results, list(range(20)))
+
+    # A slow task for one key must not hold up another key
+    def test_keys_run_concurrently(self):
+        release = threading.Event()
+        done = threading.Event()
+        self.pool.submit('slow channel', release.wait, 5)
+        self.pool.submit('fast channel', done.set)
+        self.assertTrue(done.wait(1))
+        release.set()
+
+    # A failing task must not stop later tasks for the same key
+    def test_failure_is_contained(self):
+        results = []
+        self.pool.submit('channel', lambda: 1 / 0)
+        self.pool.submit('channel', results.append, 'after')
+        self.pool.shutdown()
+        self.assertEqual(results, ['after'])
+        self.assertEqual(self.pool.queue_depth(), 0)
+
+    # Tasks beyond the queue limit must be refused, and counted, while the queued ones still run
+    def test_queue_limit(self):
+        pool = OrderedWorkerPool(1, max_queued=1, name='test_full_pool')
+        release = threading.Event()
+        results = []
+        pool.submit('channel', release.wait, 5)
+        time.sleep(0.05)  # Let the worker take the first task
+        pool.submit('other channel', results.append, 'queued')
+        self.assertRaises(PoolFullError, pool.submit, 'channel', results.append, 'refused')
+        self.assertEqual(pool.queue_depth(), 1)
+        release.set()
+        pool.shutdown()
+        self.assertEqual(results, ['queued'])
+        self.assertEqual(pool._rejected.value(), 1)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    # Test bursting, then refilling at the given rate
+    def test_take(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1, 2, clock)
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        self.assertAlmostEqual(bucket.delay(), 1.0)
+        clock.now = 0.5
+        self.assertAlmostEqual(bucket.delay(), 0.5)
+        clock.now = 1.0
+        self.assertTrue(bucket.take())
+        clock.now = 10.0
+        self.assertTrue(bucket.is_full())
+
+
+class TestOutboundScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = OutboundScheduler(channel_rate=1, channel_burst=1, global_rate=100, global_burst=100,
+                                           clock=self.clock)
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def run_ready(self):
+        while True:
+            entry, wait = self.scheduler._next_entry()
+            if entry is None:
+                return wait
+            entry[3](*entry[4], **entry[5])
+
+    # Test that a channel is held to its rate, and that more urgent messages go first
+    def test_channel_rate_and_priority(self):
+        self.scheduler.submit('C1', PRIORITY_NORMAL, self.send, 'first')
+        self.scheduler.submit('C1', PRIORITY_BULK, self.send, 'nag')
+        self.scheduler.submit('C1', PRIORITY_NORMAL, self.send, 'second')
+        self.scheduler.submit('C1', PRIORITY_ERROR, self.send, 'error')
+        self.assertAlmostEqual(self.run_ready(), 1.0)
+        self.assertEqual(self.sent, ['error'])
+        self.clock.now = 1.0
+        self.run_ready()
+        self.clock.now = 2.0
+        self.run_ready()
+        self.clock.now = 3.0
+        self.run_ready()
+        self.assertEqual(self.sent, ['error', 'first', 'second', 'nag'])
+        self.assertEqual(self.scheduler.queue_depth(), 0)
+
+    # Test that channels are paced independently, but share the global budget
+    def test_global_budget(self):
+        scheduler = OutboundScheduler(channel_rate=1, channel_burst=1, global_rate=1, global_burst=2,
+                                      clock=self.clock)
+        self.scheduler = scheduler
+        for channel in ('C1', 'C2', 'C3'):
+            scheduler.submit(channel, PRIORITY_NORMAL, self.send, channel)
+        self.assertAlmostEqual(self.run_ready(), 1.0)
+        self.assertEqual(len(self.sent), 2)
+        self.clock.now = 1.0
+        self.run_ready()
+        self.assertEqual(sorted(self.sent), ['C1', 'C2', 'C3'])
+
+    # Test that a full queue drops its least urgent, newest message
+    def test_full_queue(self):
+        self.scheduler = OutboundScheduler(channel_rate=1, channel_burst=1, max_queued=3, clock=self.clock)
+        for msg, priority in (('a', PRIORITY_NORMAL), ('b', PRIORITY_BULK), ('c', PRIORITY_BULK),
+                              ('d', PRIORITY_ERROR)):
+            self.scheduler.submit('C1', priority, self.send, msg)
+        self.assertEqual(self.scheduler.queue_depth(), 3)
+        for second in range(4):
+            self.clock.now = second
+            self.run_ready()
+        self.assertEqual(self.sent, ['d', 'a', 'b'])
+
+    # Test the scheduler thread, which must survive a failing send
+    def test_thread(self):
+        scheduler = OutboundScheduler(channel_rate=1000, channel_burst=10)
+        done = threading.Event()
+        scheduler.start()
+        scheduler.submit('C1', PRIORITY_NORMAL, MagicMock(side_effect=Exception("socket closed")))
+        scheduler.submit('C1', PRIORITY_NORMAL, done.set)
+        self.assertTrue(done.wait(5))
+        scheduler.join(5)
+        self.assertFalse(scheduler.is_alive())
+
+
+class TestMessageCoalescer(unittest.TestCase):
+    # Test merging in order, up to the length limit
+    def test_merge(self):
+        messages = [('a' * 5, PRIORITY_NORMAL), ('b' * 3, PRIORITY_ERROR), ('c' * 8, PRIORITY_NORMAL), ('d', PRIORITY_BULK)]
+        self.assertEqual(MessageCoalescer.merge(messages, max_length=10),
+                         [('aaaaa\nbbb', PRIORITY_ERROR), ('cccccccc\nd', PRIORITY_NORMAL)])
+        self.assertEqual(MessageCoalescer.merge([('x' * 20, PRIORITY_NORMAL)], max_length=10),
+                         [('x' * 20, PRIORITY_NORMAL)])
+
+    # Test that messages are held for the window, then flushed together
+    def test_window(self):
+        flushed = []
+        done = threading.Event()
+        coalescer = MessageCoalescer(0.05, lambda *args: (flushed.append(args), done.set()))
+        coalescer.start()
+        coalescer.add('C1', "one")
+        coalescer.add('C1', "two")
+        self.assertEqual(flushed, [])
+        self.assertTrue(done.wait(5))
+        self.assertEqual(flushed, [('C1', "one\ntwo", PRIORITY_NORMAL)])
+        coalescer.join(5)
+        self.assertFalse(coalescer.is_alive())
+
+
+class TestTokenRefresher(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.utcnow = datetime.datetime(2016, 7, 1, 12, 0, 0)
+        self.refresh = MagicMock(side_effect=self.extend)
+        self.refresher = TokenRefresher(self.refresh, lead=300, retry=60, max_failures=2, clock=self.clock,
+                                        utcnow=lambda: self.utcnow)
+
+    def extend(self, credentials):
+        credentials.token_expiry = self.utcnow + datetime.timedelta(hours=1)
+
+    def make_credentials(self, expires_in):
+        return Mock(refresh_token='refresh', token_expiry=self.utcnow + datetime.timedelta(seconds=expires_in))
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.utcnow += datetime.timedelta(seconds=seconds)
+
+    def run_due(self):
+        entry = self.refresher._take_due()
+        while entry is not None:
+            self.refresher._refresh_entry(*entry)
+            entry = self.refresher._take_due()
+
+    # Test that tokens are refreshed lead seconds before they expire, soonest first, and then tracked again
+    def test_refresh_before_expiry(self):
+        early, late = self.make_credentials(600), self.make_credentials(3600)
+        self.refresher.track('U2', late)
+        self.refresher.track('U1', early)
+        self.advance(299)
+        self.run_due()
+        self.refresh.assert_not_called()
+        self.advance(1)
+        self.run_due()
+        self.refresh.assert_called_once_with(early)
+        self.assertEqual(self.refresher._tracked['U1'][0], self.clock.now + 3300)
+        self.assertEqual(len(self.refresher), 2)
+
+    # Test that replaced credentials are not refreshed, and unrefreshable ones not tracked
+    def test_replaced(self):
+        old, new = self.make_credentials(300), self.make_credentials(3600)
+        self.refresher.track('U1', old)
+        self.refresher.track('U1', new)
+        self.refresher.track('U2', Mock(refresh_token=None))
+        self.run_due()
+        self.refresh.assert_not_called()
+        self.assertEqual(len(self.refresher), 1)
+
+    # Test that failed refreshes are retried, and given up on after max_failures
+    def test_failures(self):
+        self.refresh.side_effect = Exception("invalid_grant")
+        self.refresher.track('U1', self.make_credentials(300))
+        self.run_due()
+        self.assertEqual(len(self.refresher), 1)
+        self.advance(60)
+        self.run_due()
+        self.assertEqual(self.refresh.call_count, 2)
+        self.assertEqual(len(self.refresher), 0)
+
+    # Test that the thread refreshes due tokens and stops on join
+    def test_run(self):
+        refresher = TokenRefresher(self.refresh, lead=300)
+        refreshed = threading.Event()
+        self.refresh.side_effect = lambda credentials: refreshed.set()
+        refresher.start()
+        refresher.track('U1', Mock(refresh_token='refresh',
+                                   token_expiry=datetime.datetime.utcnow() + datetime.timedelta(seconds=300)))
+        self.assertTrue(refreshed.wait(5))
+        refresher.join(5)
+        self.assertFalse(refresher.is_alive())
+
+
+class TestReminderScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fired = []
+        self.scheduler = ReminderScheduler(clock=self.clock)
+
+    def fire(self):
+        for _, function, args, kwargs in self.scheduler._take_due():
+            function(*args, **kwargs)
+
+    # Test that reminders fire soonest first, repeat every interval, and stop once cancelled
+    def test_schedule_and_cancel(self):
+        self.scheduler.schedule('nag1', 10, self.fired.append, 'one', delay=0)
+        self.scheduler.schedule('nag2', 5, self.fired.append, 'two')
+        self.fire()
+        self.assertEqual(self.fired, ['one'])
+        self.clock.now = 10
+        self.fire()
+        self.assertEqual(self.fired, ['one', 'two', 'one'])
+        self.assertTrue(self.scheduler.cancel('nag1'))
+        self.assertFalse(self.scheduler.cancel('nag1'))
+        self.clock.now = 20
+        self.fire()
+        self.assertEqual(self.fired, ['one', 'two', 'one', 'two'])
+        self.assertNotIn('nag1', self.scheduler)
+
+    # Test that rescheduling a key replaces its reminder
+    def test_replace(self):
+        self.scheduler.schedule('nag1', 10, self.fired.append, 'old', delay=0)
+        self.scheduler.schedule('nag1', 10, self.fired.append, 'new', delay=5)
+        self.fire()
+        self.clock.now = 5
+        self.fire()
+        self.assertEqual(self.fired, ['new'])
+        self.assertEqual(len(self.scheduler), 1)
+
+    # Test that repeats are pushed back by up to jitter seconds
+    def test_jitter(self):
+        scheduler = ReminderScheduler(jitter=30, clock=self.clock)
+        for i in range(20):
+            scheduler.schedule(i, 100, self.fired.append, i, delay=0)
+        scheduler._take_due()
+        repeats = [reminder[0] for reminder in scheduler._reminders.values()]
+        self.assertTrue(all(100 <= due < 130 for due in repeats))
+        self.assertGreater(len(set(repeats)), 1)
+
+    # Test that the thread fires due reminders and stops on join
+    def test_run(self):
+        scheduler = ReminderScheduler()
+        fired = threading.Event()
+        scheduler.start()
+        scheduler.schedule('nag1', 3600, fired.set, delay=0.01)
+        self.assertTrue(fired.wait(5))
+        scheduler.join(5)
+        self.assertFalse(scheduler.is_alive())
+
+
+class TestFutureSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.resubmitted = []
+        self.delivered = []
+        self.supervisor = FutureSupervisor(self.resubmitted.append, self.delivered.append, clock=self.clock)
+
+    def watch(self, key, policy, attempt=0, start=True):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        task = {'intent_value': 'get-google-drive', 'idempotency_key': key, 'attempt': attempt}
+        self.supervisor.watch(future, task, policy)
+        if start:
+            self.supervisor.started(task, policy)
+        return future
+
+    def check(self):
+        for task, policy in self.supervisor._take_expired():
+            self.supervisor._timed_out(task, policy)
+
+    # Test that each future has its own deadline, so a slow one doesn't hold up the others
+    def test_deadlines(self):
+        slow = self.watch('a', IntentPolicy(timeout=10))
+        fast = self.watch('b', IntentPolicy(timeout=2))
+        self.assertEqual(self.supervisor.in_flight(), 2)
+        fast.set_result('fast state')
+        self.assertEqual(self.delivered, ['fast state'])
+        self.clock.now = 10
+        self.assertEqual([task['idempotency_key'] for task, _ in self.supervisor._take_expired()], ['a'])
+        slow.set_result('slow state')
+        self.assertEqual(self.supervisor.in_flight(), 0)
+
+    # Test that the deadline starts when a worker starts the task, not while it waits in the pool's queue
+    def test_deadline_from_start(self):
+        policy = IntentPolicy(timeout=5, retry=RETRY_IDEMPOTENT)
+        self.watch('a', policy, start=False)
+        self.clock.now = 8
+        self.check()
+        self.assertEqual(self.resubmitted, [])
+        self.supervisor.started({'intent_value': 'get-google-drive', 'idempotency_key': 'a', 'attempt': 0}, policy)
+        self.clock.now = 12
+        self.check()
+        self.assertEqual(self.resubmitted, [])
+        self.clock.now = 13
+        self.check()
+        self.assertEqual(len(self.resubmitted), 1)
+
+    # Test that at most once intents are never run again
+    def test_at_most_once(self):
+        self.watch('a', IntentPolicy(timeout=5, retry=RETRY_NEVER))
+        self.clock.now = 5
+        self.check()
+        self.assertEqual(self.resubmitted, [])
+
+    # Test that idempotent intents are run again with the same key, and only the first result is delivered
+    def test_idempotent_retry(self):
+        policy = IntentPolicy(timeout=5, retry=RETRY_IDEMPOTENT, max_retries=1)
+        first = self.watch('a', policy)
+        self.clock.now = 5
+        self.check()
+        self.assertEqual(self.resubmitted, [{'intent_value': 'get-google-drive', 'idempotency_key': 'a',
+                                             'attempt': 1}])
+        second = self.watch('a', policy, attempt=1)
+        second.set_result('second state')
+        first.set_result('first state')
+        self.assertEqual(self.delivered, ['second state'])
+        self.clock.now = 10
+        self.check()
+        self.assertEqual(len(self.resubmitted), 1)
+
+    # Test that a failed attempt delivers nothing
+    def test_failure(self):
+        future = self.watch('a', IntentPolicy(timeout=5))
+        future.set_exception(ValueError("bad file"))
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.supervisor.in_flight(), 0)
+
+
+class TestBulkheadPool(unittest.TestCase):
+    # Test that tasks beyond the queue limit are refused, and counted
+    def test_queue_limit(self):
+        pool = BulkheadPool('testing_full', max_workers=1, max_queued=1)
+        release = threading.Event()
+        running = pool.submit(release.wait, 5)
+        time.sleep(0.05)  # Let the worker take the first task
+        queued = pool.submit(lambda: 'queued')
+        self.assertRaises(PoolFullError, pool.submit, lambda: 'refused')
+        self.assertEqual(pool.queue_depth(), 1)
+        release.set()
+        self.assertEqual(queued.result(5), 'queued')
+        self.assertTrue(running.result(5))
+        self.assertEqual(pool._rejected.value(), 1)
+        pool.shutdown()
+
+
+class TestWorkerPoolThread(unittest.TestCase):
+    def setUp(self):
+        self.state_q = Queue()
+        self.pools = {name: BulkheadPool('testing_' + name, 1, 10) for name in (POOL_LOCAL, POOL_GOOGLE, POOL_DEFAULT)}
+        self.pool = WorkerPoolThread(Queue(), self.state_q, pools=self.pools)
+
+    def tearDown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.pool.supervisor.join(5)
+
+    def task(self, intent, pool=POOL_DEFAULT):
+        return {'intent': intent, 'policy': IntentPolicy(pool=pool), 'msg_writer': Mock(), 'event': {'channel': 'C1'},
+                'wit_entities': {}, 'credentials': None}
+
+    # Test that intents run on the pool and their states reach the state q
+    def test_submit(self):
+        intent = MagicMock(return_value='state')
+        task = self.task(intent)
+        self.pool.submit(task)
+        self.assertEqual(self.state_q.get(timeout=5), {'type': 'state_update', 'state': 'state'})
+        intent.assert_called_once_with(task['msg_writer'], {'channel': 'C1'}, {}, None)
+
+    # Test that local intents don't wait behind slow Google ones
+    def test_bulkheads(self):
+        release = threading.Event()
+        for _ in range(3):
+            self.pool.submit(self.task(lambda *args: release.wait(5), pool=POOL_GOOGLE))
+        local = self.pool.submit(self.task(lambda *args: 'heads', pool=POOL_LOCAL))
+        self.assertEqual(local.result(1), 'heads')
+        self.assertEqual(self.pools[POOL_GOOGLE].queue_depth(), 2)
+        release.set()
+
+    # Test that the user is told when a pool is full
+    def test_full(self):
+        self.pools[POOL_GOOGLE].max_queued = 0
+        task = self.task(MagicMock(), pool=POOL_GOOGLE)
+        self.assertIsNone(self.pool.submit(task))
+        self.assertEqual(task['msg_writer'].send_message.call_args[0][0], 'C1')
+
+    # Test that a retry refused by a full pool isn't reported to the user, as the first attempt is still running
+    def test_full_retry(self):
+        self.pools[POOL_GOOGLE].max_queued = 0
+        task = dict(self.task(MagicMock(), pool=POOL_GOOGLE), attempt=1)
+        self.assertIsNone(self.pool.submit(task))
+        task['msg_writer'].send_message.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
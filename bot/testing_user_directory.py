@@ -0,0 +1,50 @@
+import unittest
+from user_directory import UserDirectory, slim_user
+
+
+def make_user(user_id, real_name, name='handle', **profile):
+    profile.update({'real_name': real_name, 'image_512': 'https://example.com/avatar.png'})
+    return {'id': user_id, 'name': name, 'real_name': real_name, 'tz': 'America/New_York', 'profile': profile}
+
+
+class TestUserDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = UserDirectory([make_user('U1', 'John Casey', name='jcasey', last_name='Casey'),
+                                        make_user('U2', 'Jane Doe', name='jdoe')])
+
+    # Test that only the fields the bot uses are kept
+    def test_slim_user(self):
+        user = slim_user(make_user('U1', 'John Casey', last_name='Casey'))
+        self.assertEqual(user, {'id': 'U1', 'name': 'handle', 'real_name': 'John Casey',
+                                'profile': {'real_name': 'John Casey', 'last_name': 'Casey'}})
+
+    # Test lookups by id, exact real name, and normalized names
+    def test_lookups(self):
+        self.assertEqual(self.directory.get('U1')['profile']['last_name'], 'Casey')
+        self.assertEqual(self.directory.id_from_real_name('John Casey'), 'U1')
+        self.assertEqual(self.directory.find_by_name('john  casey')['id'], 'U1')
+        self.assertEqual(self.directory.find_by_name('JDOE')['id'], 'U2')
+        self.assertEqual(self.directory.find_by_name('Nobody'), None)
+
+    # Test that a changed name is reindexed
+    def test_user_change(self):
+        self.directory.upsert(make_user('U1', 'Johnny Casey', name='jcasey'))
+        self.assertEqual(self.directory.id_from_real_name('John Casey'), None)
+        self.assertEqual(self.directory.find_by_name('johnny casey')['id'], 'U1')
+        self.assertEqual(len(self.directory), 2)
+
+    # Test that an ambiguous normalized name matches nobody, while the exact name still works
+    def test_ambiguous(self):
+        self.directory.upsert(make_user('U3', 'john casey', name='jc2'))
+        self.assertEqual(self.directory.find_by_name('JOHN CASEY'), None)
+        self.assertEqual(self.directory.find_by_name('John Casey')['id'], 'U1')
+
+    # Test removal
+    def test_remove(self):
+        self.directory.remove('U2')
+        self.assertEqual(self.directory.get('U2'), None)
+        self.assertEqual(self.directory.find_by_name('jdoe'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,10 @@
+import gc
+import threading
 import unittest
+import weakref
+from mock import MagicMock
 import intenthandlers.utils as utils
+import metrics
 
 
 class TestUtils(unittest.TestCase):
@@ -20,5 +25,159 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.get_highest_confidence_entity(sample_entities_dict_1, sample_entity_1_3), None)
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = utils.TTLCache(maxsize=2, ttl=10, clock=self.clock)
+
+    # Test hits and misses
+    def test_get_put(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    # Test that the least recently used entry is evicted first
+    def test_lru_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+    # Test that entries expire after their ttl, including a per entry ttl
+    def test_ttl_expiry(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2, ttl=20)
+        self.clock.now = 15
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.expirations, 1)
+        self.assertEqual(len(self.cache), 1)
+
+    # Test explicit invalidation
+    def test_invalidate(self):
+        self.cache.put('a', 1)
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('b', 2)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
+class Lookup(object):
+    def __init__(self):
+        self.calls = 0
+
+    @utils.cached(maxsize=2, ttl=10, negative_ttl=0, is_negative=lambda value: value is None)
+    def find(self, key):
+        self.calls += 1
+        return None if key == 'missing' else key.upper()
+
+
+class TestCached(unittest.TestCase):
+    # Test that results are cached per instance
+    def test_per_instance(self):
+        first, second = Lookup(), Lookup()
+        self.assertEqual(first.find('a'), 'A')
+        self.assertEqual(first.find('a'), 'A')
+        self.assertEqual(second.find('a'), 'A')
+        self.assertEqual((first.calls, second.calls), (1, 1))
+
+    # Test that negative results use the negative ttl, here expiring immediately
+    def test_negative_ttl(self):
+        lookup = Lookup()
+        lookup.find('missing')
+        lookup.find('missing')
+        self.assertEqual(lookup.calls, 2)
+
+    # Test the size bound and explicit invalidation
+    def test_bounds_and_invalidation(self):
+        lookup = Lookup()
+        for key in ['a', 'b', 'c']:
+            lookup.find(key)
+        self.assertEqual(len(lookup.find.cache), 2)
+        lookup.find.invalidate('c')
+        lookup.find('c')
+        self.assertEqual(lookup.calls, 4)
+        lookup.find.clear()
+        self.assertEqual(len(lookup.find.cache), 0)
+
+    # Test that an instance's cache is dropped along with it, though its stats are published as named gauges
+    def test_dropped_with_instance(self):
+        lookup = Lookup()
+        lookup.find('a')
+        cache = weakref.ref(lookup.find.cache)
+        self.assertEqual(metrics.gauge('{}.size'.format(Lookup.find.metric_name)).value(), 1)
+        del lookup
+        gc.collect()
+        self.assertIsNone(cache())
+        self.assertIsNone(metrics.gauge('{}.size'.format(Lookup.find.metric_name)).value())
+
+    # Test that unhashable arguments bypass the cache
+    def test_unhashable(self):
+        lookup = Lookup()
+        self.assertRaises(AttributeError, lookup.find, ['a'])
+
+
+class TestRefreshingCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.load = MagicMock(side_effect=lambda creds: '{} at {}'.format(creds, self.clock.now))
+        self.background = []
+        self.cache = utils.RefreshingCache(self.load, 10, name='testing.refreshing', clock=self.clock,
+                                           background=lambda function, *args: self.background.append((function, args)))
+
+    def run_background(self):
+        for function, args in self.background:
+            function(*args)
+        self.background = []
+
+    # Test that a stale value is returned while it is reloaded in the background, once
+    def test_stale_while_revalidate(self):
+        self.assertEqual(self.cache.get('a'), 'a at 0')
+        self.clock.now = 10
+        self.assertEqual(self.cache.get('b'), 'a at 0')
+        self.assertEqual(self.cache.get('c'), 'a at 0')
+        self.assertEqual(len(self.background), 1)
+        self.run_background()
+        self.assertEqual(self.cache.get('d'), 'b at 10')
+        self.assertEqual(self.load.call_count, 2)
+
+    # Test that a failed reload keeps the old value, and is tried again
+    def test_failed_refresh(self):
+        self.cache.get('a')
+        self.clock.now = 10
+        self.load.side_effect = Exception("sheets is down")
+        self.cache.get('b')
+        self.run_background()
+        self.assertEqual(self.cache.get('c'), 'a at 0')
+        self.assertEqual(len(self.background), 1)
+
+    # Test that concurrent first gets share one load
+    def test_single_flight(self):
+        release = threading.Event()
+        self.load.side_effect = lambda creds: release.wait(5) and creds
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('a'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['a'] * 5)
+        self.assertEqual(self.load.call_count, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from workspace import WorkspaceMetadata
+
+login_data = {
+    'channels': [{'id': 'C1', 'name': 'general', 'members': ['U1', 'U2'], 'is_channel': True}],
+    'groups': [{'id': 'G1', 'name': 'secret', 'members': ['U1'], 'is_group': True}],
+    'ims': [{'id': 'D1', 'user': 'U1', 'is_im': True}],
+    'users': [{'id': 'U1', 'name': 'jcasey', 'profile': {'real_name': 'John Casey'}}]
+}
+
+
+class TestWorkspaceMetadata(unittest.TestCase):
+    def setUp(self):
+        self.workspace = WorkspaceMetadata()
+        self.workspace.seed(login_data)
+
+    # Test seeding from the rtm.start snapshot
+    def test_seed(self):
+        self.assertEqual(self.workspace.channel('C1'), {'id': 'C1', 'name': 'general', 'is_channel': True})
+        self.assertEqual(self.workspace.channel('G1')['name'], 'secret')
+        self.assertEqual(self.workspace.dm_for_user('U1'), 'D1')
+        self.assertEqual(self.workspace.users.get('U1')['name'], 'jcasey')
+        self.assertTrue(self.workspace.users.is_complete())
+
+    # Test that RTM events keep the metadata current
+    def test_events(self):
+        self.assertTrue(self.workspace.apply_event({'type': 'channel_created',
+                                                    'channel': {'id': 'C2', 'name': 'random', 'created': 1}}))
+        self.workspace.apply_event({'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'town-square'}})
+        self.workspace.apply_event({'type': 'im_created', 'user': 'U2', 'channel': {'id': 'D2'}})
+        self.workspace.apply_event({'type': 'channel_deleted', 'channel': 'G1'})
+        self.workspace.apply_event({'type': 'team_join', 'user': {'id': 'U2', 'profile': {'real_name': 'Jane Doe'}}})
+        self.assertEqual(self.workspace.channel('C2')['name'], 'random')
+        self.assertEqual(self.workspace.channel('C1')['name'], 'town-square')
+        self.assertEqual(self.workspace.dm_for_user('U2'), 'D2')
+        self.assertEqual(self.workspace.channel('G1'), None)
+        self.assertEqual(self.workspace.users.find_by_name('Jane Doe')['id'], 'U2')
+        self.assertFalse(self.workspace.apply_event({'type': 'message'}))
+
+    # Test that a channel event without a channel id is skipped
+    def test_channel_without_id(self):
+        self.assertTrue(self.workspace.apply_event({'type': 'channel_joined', 'channel': 'dummy_channel'}))
+        self.assertIsNone(self.workspace.add_channel({'name': 'nameless'}))
+        self.assertEqual(self.workspace.channel('C1')['name'], 'general')
+
+    # Test that a snapshot without users leaves the directory to be warmed up
+    def test_seed_without_users(self):
+        workspace = WorkspaceMetadata()
+        workspace.seed({'channels': [], 'groups': [], 'ims': []})
+        self.assertFalse(workspace.users.is_complete())
+
+
+if __name__ == '__main__':
+    unittest.main()
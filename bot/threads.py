@@ -1,15 +1,42 @@
 import threading
 import logging
+import os
+import heapq
+import itertools
+import datetime
+import random
+import uuid
 import flask
-from queue import Queue, Empty
-from time import sleep
+import metrics
+from collections import deque
+from queue import Empty
+from time import sleep, monotonic
 import concurrent.futures
-from concurrent.futures import TimeoutError
 
 logger = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
 
+# Priority classes for outbound messages, most urgent first
+PRIORITY_ERROR = 0
+PRIORITY_AUTH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BULK = 3  # e.g. nag reminders, which can wait behind anything a user is waiting on
+
+PRIORITY_NAMES = {PRIORITY_ERROR: 'error', PRIORITY_AUTH: 'auth', PRIORITY_NORMAL: 'normal', PRIORITY_BULK: 'bulk'}
+
+# Retry policies for intent handlers which time out, see IntentPolicy
+RETRY_NEVER = 'at-most-once'
+RETRY_IDEMPOTENT = 'idempotent'
+
+# Bulkhead pools which intent handlers run on, see IntentPolicy and BulkheadPool
+POOL_LOCAL = 'local'  # Answered without the network, e.g. coin flips, so must never wait behind the others
+POOL_GOOGLE = 'google'  # Calls to Google APIs, which can be slow
+POOL_DEFAULT = 'default'
+
+# Slack truncates longer messages, so coalesced messages are kept under this many characters
+MAX_MESSAGE_LENGTH = 4000
+
 
 class StoppableThread(threading.Thread):
     """
@@ -40,6 +67,24 @@ class StoppableThread(threading.Thread):
         threading.Thread.join(self, timeout)
 
 
+class WarmUpThread(threading.Thread):
+    """
+    A WarmUpThread runs a single function in the background, e.g. to fill a cache after start up. It is a daemon
+    thread, so an unfinished warm up never keeps the bot from exiting.
+    """
+    def __init__(self, function, *args, name='WarmUpThread', **kwargs):
+        self._function = function
+        self._fun_args = args
+        self._fun_kwargs = kwargs
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def run(self):
+        try:
+            self._function(*self._fun_args, **self._fun_kwargs)
+        except Exception as e:
+            logger.error("{} failed: {}".format(self.name, e))
+
+
 class FlaskThread(threading.Thread):
     """
     FlaskThread is a used to host the flask app as a REST endpoint. There should only be one
@@ -70,85 +115,903 @@ class FlaskThread(threading.Thread):
             return "<H1>Authentication Successful</H1>"
             # Useful to keep flask from breaking, despite no need for a response to google
 
+        @app.route("/metrics")
+        def _handle_metrics():
+            return flask.jsonify(metrics.snapshot())
+
         # This line must be the last line, or functions will not be defined before the server starts, resulting in 404s
         app.run(port=5555, host="0.0.0.0")
 
 
-class ValidationThread(threading.Thread):
+class PoolFullError(Exception):
     """
-    A validation thread is used by a worker pool thread to validate that all async requests are completed without
-    timing out, as a timeout would indicate that the thread crashed.
+    Raised when a task is submitted to a pool whose queue is full
     """
-    def __init__(self, validation_q, q, name='ValidationThread'):
-        self.q = q
-        self.validation_q = validation_q
-        threading.Thread.__init__(self, name=name)
+
+
+class OrderedWorkerPool(object):
+    """
+    An OrderedWorkerPool runs tasks on a bounded threadpool, while guaranteeing that tasks submitted with the same key
+    run one at a time, in the order they were submitted. Tasks with different keys run concurrently.
+    """
+    def __init__(self, max_workers, max_queued=None, name='OrderedWorkerPool'):
+        """
+        :param max_queued: How many tasks may wait for a worker before further submissions are refused. None for no
+        limit
+        """
+        self.name = name
+        self.max_queued = max_queued
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> deque of tasks not yet started. A key is present while a worker drains it
+        self._depth = 0
+        metrics.gauge('{}.queue_depth'.format(name), lambda: self._depth)
+        self._wait_time = metrics.histogram('{}.queue_wait_seconds'.format(name))
+        self._run_time = metrics.histogram('{}.stage_seconds'.format(name))
+        self._completed = metrics.counter('{}.completed'.format(name))
+        self._failed = metrics.counter('{}.failed'.format(name))
+        self._rejected = metrics.counter('{}.rejected'.format(name))
+
+    def submit(self, key, function, *args):
+        """
+        Queues function(*args) behind any other tasks with the same key. Never blocks.
+        :raises PoolFullError: if max_queued tasks are already waiting for a worker
+        """
+        with self._lock:
+            if self.max_queued is not None and self._depth >= self.max_queued:
+                self._rejected.inc()
+                raise PoolFullError("The {} pool has {} tasks waiting".format(self.name, self._depth))
+            self._depth += 1
+            if key in self._pending:
+                self._pending[key].append((function, args, monotonic()))
+                return
+            self._pending[key] = deque([(function, args, monotonic())])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                tasks = self._pending[key]
+                if not tasks:
+                    self._pending.pop(key)
+                    return
+                function, args, submitted = tasks.popleft()
+                self._depth -= 1
+            started = monotonic()
+            self._wait_time.observe(started - submitted)
+            try:
+                function(*args)
+                self._completed.inc()
+            except Exception as e:
+                self._failed.inc()
+                logger.error("{} task failed: {}".format(self.name, e))
+            finally:
+                self._run_time.observe(monotonic() - started)
+
+    def queue_depth(self):
+        return self._depth
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class TokenBucket(object):
+    """
+    A TokenBucket allows rate events a second on average, and bursts of up to capacity events. It is not thread safe,
+    its owner is expected to hold a lock around it.
+    """
+    def __init__(self, rate, capacity, clock=monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now=None):
+        """
+        :return: How many seconds until a token is available, 0 if one is available now
+        """
+        now = self._clock() if now is None else now
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now=None):
+        """
+        :return: True if a token was taken, False if the bucket is empty
+        """
+        now = self._clock() if now is None else now
+        self._refill(now)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def is_full(self, now=None):
+        now = self._clock() if now is None else now
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+class OutboundScheduler(threading.Thread):
+    """
+    An OutboundScheduler paces outbound Slack messages so that the bot stays inside Slack's rate limits: each channel
+    has a token bucket (Slack allows about one message a second per channel), and all channels share a workspace wide
+    bucket. Queued messages go out most urgent priority first, and in submission order within a priority. Submitting
+    never blocks; if a channel's queue is full, the least urgent, newest message in it is dropped.
+    """
+    def __init__(self, channel_rate=1.0, channel_burst=3, global_rate=10.0, global_burst=20, max_queued=50,
+                 clock=monotonic, name='OutboundScheduler'):
+        self._clock = clock
+        self._channel_rate = channel_rate
+        self._channel_burst = channel_burst
+        self._max_queued = max_queued
+        self._global_bucket = TokenBucket(global_rate, global_burst, clock)
+        self._channel_buckets = {}  # channel -> TokenBucket, dropped again once the bucket has refilled
+        self._queues = {}  # channel -> heap of (priority, sequence, submitted, function, args, kwargs)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._depth = 0
+
+        metrics.gauge('outbound.queue_depth', lambda: self._depth)
+        self._wait_time = metrics.histogram('outbound.queue_wait_seconds')
+        self._wait_times = {priority: metrics.histogram('outbound.{}.queue_wait_seconds'.format(priority_name))
+                            for priority, priority_name in PRIORITY_NAMES.items()}
+        self._sent = metrics.counter('outbound.sent')
+        self._failed = metrics.counter('outbound.failed')
+        self._dropped = metrics.counter('outbound.dropped')
+        self._throttled = metrics.counter('outbound.throttled')
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        :return: A scheduler configured by the OUTBOUND_CHANNEL_RATE, OUTBOUND_CHANNEL_BURST, OUTBOUND_GLOBAL_RATE,
+        OUTBOUND_GLOBAL_BURST and OUTBOUND_MAX_QUEUED env vars
+        """
+        return cls(channel_rate=float(os.getenv("OUTBOUND_CHANNEL_RATE") or 1.0),
+                   channel_burst=int(os.getenv("OUTBOUND_CHANNEL_BURST") or 3),
+                   global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE") or 10.0),
+                   global_burst=int(os.getenv("OUTBOUND_GLOBAL_BURST") or 20),
+                   max_queued=int(os.getenv("OUTBOUND_MAX_QUEUED") or 50))
+
+    def submit(self, channel, priority, function, *args, **kwargs):
+        """
+        Queues function(*args, **kwargs), which sends one message to channel, to run once the rate limits allow.
+        Never blocks.
+        """
+        with self._condition:
+            queue = self._queues.setdefault(channel, [])
+            heapq.heappush(queue, (priority, next(self._sequence), self._clock(), function, args, kwargs))
+            self._depth += 1
+            if len(queue) > self._max_queued:
+                # The heap's largest entry is the least urgent, newest message
+                queue.remove(max(queue, key=lambda entry: entry[:2]))
+                heapq.heapify(queue)
+                self._depth -= 1
+                self._dropped.inc()
+                logger.warning("Outbound queue for {} is full, dropped a message".format(channel))
+            self._condition.notify()
+
+    def queue_depth(self):
+        return self._depth
 
     def run(self):
         while True:
-            try:  # This try except is used in order to use the timeout on a queue get as a heartbeat timer
-                event = self.validation_q.get(timeout=5)
-                logger.info("Checking an Event")
+            with self._condition:
+                entry, wait = self._next_entry()
+                while entry is None:
+                    if self._stopped:
+                        return
+                    self._condition.wait(wait)
+                    entry, wait = self._next_entry()
+            priority, _, submitted, function, args, kwargs = entry
+            waited = self._clock() - submitted
+            self._wait_time.observe(waited)
+            self._wait_times.get(priority, self._wait_time).observe(waited)
+            try:
+                function(*args, **kwargs)
+                self._sent.inc()
+            except Exception as e:
+                self._failed.inc()
+                logger.error("Failed to send outbound message: {}".format(e))
+
+    def _next_entry(self):
+        """
+        Must be called with the condition held
+        :return: The most urgent entry whose channel has a token, with the tokens taken, or None, and how long to wait
+        before looking again (None to wait for a submission)
+        """
+        now = self._clock()
+        best_channel, wait = None, None
+        for channel, queue in self._queues.items():
+            bucket = self._channel_bucket(channel)
+            delay = bucket.delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best_channel is None or queue[0][:2] < self._queues[best_channel][0][:2]:
+                best_channel = channel
+        self._prune_buckets(now)
+        if best_channel is None:
+            if wait is not None:
+                self._throttled.inc()
+            return None, wait
+
+        global_delay = self._global_bucket.delay(now)
+        if global_delay > 0:
+            self._throttled.inc()
+            return None, global_delay
+
+        self._global_bucket.take(now)
+        self._channel_buckets[best_channel].take(now)
+        queue = self._queues[best_channel]
+        entry = heapq.heappop(queue)
+        if not queue:
+            del self._queues[best_channel]
+        self._depth -= 1
+        return entry, 0
+
+    def _channel_bucket(self, channel):
+        bucket = self._channel_buckets.get(channel)
+        if bucket is None:
+            bucket = TokenBucket(self._channel_rate, self._channel_burst, self._clock)
+            self._channel_buckets[channel] = bucket
+        return bucket
+
+    def _prune_buckets(self, now):
+        # A full bucket with nothing queued is the same as no bucket, so don't keep one per channel ever written to
+        idle = [channel for channel, bucket in self._channel_buckets.items()
+                if channel not in self._queues and bucket.is_full(now)]
+        for channel in idle:
+            del self._channel_buckets[channel]
+
+    def join(self, timeout=None):
+        """
+        Sends whatever is still queued, at the usual pace, then stops
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        threading.Thread.join(self, timeout)
+
+
+class MessageCoalescer(threading.Thread):
+    """
+    A MessageCoalescer holds messages for a short window, and merges those written to the same channel in that window
+    into as few messages as fit Slack's size limit, keeping their order. The merged text is handed to flush, along
+    with the most urgent priority of the messages it contains.
+    """
+    def __init__(self, window, flush, max_length=MAX_MESSAGE_LENGTH, clock=monotonic, name='MessageCoalescer'):
+        """
+        :param window: Seconds to hold the first message to a channel, waiting for more
+        :param flush: Called as flush(channel, text, priority) for each merged message
+        """
+        self.window = window
+        self._flush = flush
+        self._max_length = max_length
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._pending = {}  # channel -> (deadline, [(text, priority)])
+        self._stopped = False
+        self._coalesced = metrics.counter('outbound.coalesced')
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def add(self, channel, text, priority=PRIORITY_NORMAL):
+        """
+        Holds text until the channel's window closes. Never blocks.
+        """
+        with self._condition:
+            if channel in self._pending:
+                self._pending[channel][1].append((text, priority))
+            else:
+                self._pending[channel] = (self._clock() + self.window, [(text, priority)])
+                self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                due = self._take_due()
+                while not due:
+                    if self._stopped and not self._pending:
+                        return
+                    self._condition.wait(self._next_deadline_in())
+                    due = self._take_due()
+            for channel, messages in due:
+                self._flush_channel(channel, messages)
+
+    def _take_due(self):
+        # Must be called with the condition held. Everything is due once stopped
+        now = self._clock()
+        due = [(channel, messages) for channel, (deadline, messages) in self._pending.items()
+               if deadline <= now or self._stopped]
+        for channel, _ in due:
+            del self._pending[channel]
+        return due
+
+    def _next_deadline_in(self):
+        if not self._pending:
+            return None
+        return max(0, min(deadline for deadline, _ in self._pending.values()) - self._clock())
+
+    def _flush_channel(self, channel, messages):
+        merged = self.merge(messages, self._max_length)
+        self._coalesced.inc(len(messages) - len(merged))
+        for text, priority in merged:
+            try:
+                self._flush(channel, text, priority)
+            except Exception as e:
+                logger.error("Failed to flush coalesced messages to {}: {}".format(channel, e))
+
+    @staticmethod
+    def merge(messages, max_length=MAX_MESSAGE_LENGTH):
+        """
+        :param messages: A list of (text, priority), in the order they were written
+        :return: The messages joined by newlines into as few (text, priority) as fit in max_length characters. A
+        message which is already too long is left on its own.
+        """
+        merged = []
+        for text, priority in messages:
+            if merged and len(merged[-1][0]) + 1 + len(text) <= max_length:
+                merged[-1] = (merged[-1][0] + "\n" + text, min(merged[-1][1], priority))
+            else:
+                merged.append((text, priority))
+        return merged
+
+    def join(self, timeout=None):
+        """
+        Flushes whatever is held, then stops
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        threading.Thread.join(self, timeout)
+
+
+class TokenRefresher(threading.Thread):
+    """
+    A TokenRefresher refreshes OAuth access tokens shortly before they expire, so that commands find a fresh token
+    rather than exchanging the refresh token themselves, or asking the user to authorize again. Tracked credentials
+    are kept in a heap by when they are due to be refreshed.
+    """
+    def __init__(self, refresh, lead=None, retry=60, max_failures=3, clock=monotonic, utcnow=datetime.datetime.utcnow,
+                 name='TokenRefresher'):
+        """
+        :param refresh: Called as refresh(credentials) to exchange the refresh token for a new access token
+        :param lead: Seconds before expiry to refresh a token, defaults to the TOKEN_REFRESH_LEAD env var, or 300
+        :param retry: Seconds to wait before trying a failed refresh again
+        :param max_failures: How many refreshes in a row may fail before the credentials stop being tracked
+        """
+        self._refresh = refresh
+        self.lead = lead if lead is not None else float(os.getenv("TOKEN_REFRESH_LEAD") or 300)
+        self.retry = retry
+        self.max_failures = max_failures
+        self._clock = clock
+        self._utcnow = utcnow
+        self._condition = threading.Condition()
+        self._heap = []  # (due, sequence, key)
+        self._tracked = {}  # key -> (due, credentials, failures). Heap entries not matching it are stale
+        self._sequence = itertools.count()
+        self._stopped = False
+        self._successes = metrics.counter('token_refresh.successes')
+        self._failures = metrics.counter('token_refresh.failures')
+        metrics.gauge('token_refresh.tracked', lambda: len(self._tracked))
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def track(self, key, credentials):
+        """
+        Schedules credentials to be refreshed before their token expires, in place of any credentials tracked for key.
+        Credentials which can't be refreshed, having no refresh token or expiry, are not tracked.
+        :param key: e.g. the slack id of the user the credentials belong to
+        """
+        if getattr(credentials, 'refresh_token', None) is None or getattr(credentials, 'token_expiry', None) is None:
+            self.untrack(key)
+            return
+        self._schedule(key, credentials, self.due(credentials), 0)
+
+    def untrack(self, key):
+        with self._condition:
+            self._tracked.pop(key, None)
+
+    def due(self, credentials):
+        """
+        :return: The clock time at which to refresh credentials, lead seconds before they expire
+        """
+        expires_in = (credentials.token_expiry - self._utcnow()).total_seconds()
+        return self._clock() + expires_in - self.lead
+
+    def _schedule(self, key, credentials, due, failures):
+        with self._condition:
+            self._tracked[key] = (due, credentials, failures)
+            heapq.heappush(self._heap, (due, next(self._sequence), key))
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                entry = self._take_due()
+                while entry is None:
+                    if self._stopped:
+                        return
+                    self._condition.wait(self._next_due_in())
+                    entry = self._take_due()
+            self._refresh_entry(*entry)
+
+    def _take_due(self):
+        # Must be called with the condition held
+        now = self._clock()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, key = heapq.heappop(self._heap)
+            tracked = self._tracked.get(key)
+            if tracked is not None and tracked[0] == due:
+                return key, tracked[1], tracked[2]
+        return None
+
+    def _next_due_in(self):
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - self._clock())
+
+    def _refresh_entry(self, key, credentials, failures):
+        try:
+            self._refresh(credentials)
+        except Exception as e:
+            self._failures.inc()
+            failures += 1
+            if failures >= self.max_failures:
+                logger.error("Gave up refreshing the token for {}: {}".format(key, e))
+                self._untrack_if_current(key, credentials)
+            else:
+                logger.warning("Failed to refresh the token for {}, retrying: {}".format(key, e))
+                self._reschedule_if_current(key, credentials, self._clock() + self.retry, failures)
+            return
+        self._successes.inc()
+        logger.info("Refreshed the token for {}".format(key))
+        # A token granted for less than lead seconds would otherwise be refreshed over and over
+        due = max(self.due(credentials), self._clock() + self.retry)
+        self._reschedule_if_current(key, credentials, due, 0)
+
+    def _reschedule_if_current(self, key, credentials, due, failures):
+        # The credentials may have been replaced while refreshing, e.g. by the user authorizing again
+        with self._condition:
+            tracked = self._tracked.get(key)
+            if tracked is not None and tracked[1] is credentials:
+                self._schedule(key, credentials, due, failures)
+
+    def _untrack_if_current(self, key, credentials):
+        with self._condition:
+            tracked = self._tracked.get(key)
+            if tracked is not None and tracked[1] is credentials:
+                del self._tracked[key]
+
+    def __contains__(self, key):
+        return key in self._tracked
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def join(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        threading.Thread.join(self, timeout)
+
+
+class ReminderScheduler(threading.Thread):
+    """
+    A ReminderScheduler runs every recurring reminder, e.g. nags, on one thread. Reminders are kept in a heap by when
+    they next fire, so the thread sleeps until the soonest is due rather than waking to check, and scheduling or
+    cancelling one is O(log n). Each firing can be pushed back by a random jitter, so reminders created together
+    don't keep firing together.
+    """
+    def __init__(self, jitter=0, clock=monotonic, rng=None, name='ReminderScheduler'):
+        """
+        :param jitter: The most seconds a repeat may be pushed back by
+        """
+        self.jitter = jitter
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._condition = threading.Condition()
+        self._heap = []  # (due, sequence, key)
+        self._reminders = {}  # key -> (due, interval, function, args, kwargs). Heap entries not matching it are stale
+        self._sequence = itertools.count()
+        self._stopped = False
+        self._fired = metrics.counter('reminders.fired')
+        self._failed = metrics.counter('reminders.failed')
+        self._lateness = metrics.histogram('reminders.lateness_seconds')
+        metrics.gauge('reminders.scheduled', lambda: len(self._reminders))
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def schedule(self, key, interval, function, *args, delay=None, **kwargs):
+        """
+        Calls function(*args, **kwargs) every interval seconds until cancelled, in place of any reminder for key
+        :param key: e.g. the id of the conversation the reminder belongs to
+        :param delay: Seconds until the first call, defaults to interval
+        """
+        due = self._clock() + (interval if delay is None else delay)
+        with self._condition:
+            self._push(key, due, (interval, function, args, kwargs))
+            self._condition.notify()
+
+    def _push(self, key, due, reminder):
+        # Must be called with the condition held
+        self._reminders[key] = (due,) + reminder
+        heapq.heappush(self._heap, (due, next(self._sequence), key))
+
+    def cancel(self, key):
+        """
+        :return: True if a reminder was cancelled, False if there was none for key
+        """
+        with self._condition:
+            return self._reminders.pop(key, None) is not None
+
+    def __contains__(self, key):
+        return key in self._reminders
+
+    def __len__(self):
+        return len(self._reminders)
+
+    def run(self):
+        while True:
+            with self._condition:
+                due = self._take_due()
+                while not due:
+                    if self._stopped:
+                        return
+                    self._condition.wait(self._next_due_in())
+                    due = self._take_due()
+            for scheduled, function, args, kwargs in due:
+                self._lateness.observe(max(0, self._clock() - scheduled))
                 try:
-                    future = event['future']
-                    future.result(5)  # arbitrary 5 second check. How long should this be?
-                    logger.info("Checking an Event Worked")
-                except TimeoutError:
-                    self.q.put(event['calling_event'])
-                    logger.info("Checking an Event Failed with a Timeout Error,"
-                                " Now putting the event back into the queue")
+                    function(*args, **kwargs)
+                    self._fired.inc()
                 except Exception as e:
-                    logger.error("Checking an Event Failed with some other error {}".format(e))
-                finally:
-                    logger.info("Done Checking an Event")
-            except Empty:
-                pass
-            logger.info("Validation Thread Heartbeat")
+                    self._failed.inc()
+                    logger.error("Reminder failed: {}".format(e))
+
+    def _take_due(self):
+        """
+        Must be called with the condition held. Reschedules each due reminder's next firing
+        :return: A list of (due, function, args, kwargs) for the reminders due now
+        """
+        now = self._clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            scheduled, _, key = heapq.heappop(self._heap)
+            reminder = self._reminders.get(key)
+            if reminder is None or reminder[0] != scheduled:
+                continue  # Cancelled or replaced
+            interval, function, args, kwargs = reminder[1:]
+            # Catch up from now rather than from when it was due, so a late reminder doesn't fire again at once
+            self._push(key, now + interval + self._rng.uniform(0, self.jitter), reminder[1:])
+            due.append((scheduled, function, args, kwargs))
+        return due
+
+    def _next_due_in(self):
+        # Cancelled reminders' entries stay in the heap until due, so this may wake early, but never late
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - self._clock())
 
     def join(self, timeout=None):
-        threading.Thread.join(self, timeout=timeout)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        threading.Thread.join(self, timeout)
+
+
+class IntentPolicy(object):
+    """
+    How an intent's handler is supervised: how long it may run, and whether it is run again if it takes longer
+    """
+    def __init__(self, timeout=None, retry=RETRY_NEVER, max_retries=1, pool=POOL_DEFAULT):
+        """
+        :param timeout: Seconds the handler may run, defaults to the INTENT_TIMEOUT env var, or 5
+        :param retry: RETRY_NEVER for handlers with side effects, e.g. sending email, which must run at most once.
+        RETRY_IDEMPOTENT for handlers which may safely run twice, i.e. which only return state and send nothing
+        :param max_retries: How many times an idempotent handler is run again after timing out
+        :param pool: The name of the BulkheadPool the handler runs on
+        """
+        self.timeout = timeout if timeout is not None else float(os.getenv("INTENT_TIMEOUT") or 5)
+        self.retry = retry
+        self.max_retries = max_retries
+        self.pool = pool
+
+
+class FutureSupervisor(threading.Thread):
+    """
+    A FutureSupervisor watches every intent handler running on the worker pool. Each one's deadline, counted from when
+    a worker starts it, goes in a heap, and the thread sleeps until the soonest, so a slow handler never delays
+    noticing the others. A handler still running at its deadline is counted as timed out. If its intent's policy
+    allows it, the task is submitted again with the same idempotency key. Only the first attempt to finish delivers
+    its state.
+    """
+    def __init__(self, resubmit, deliver, clock=monotonic, name='FutureSupervisor'):
+        """
+        :param resubmit: Called as resubmit(task) to run a task again
+        :param deliver: Called as deliver(state) with the state returned by a task's first successful attempt
+        """
+        self._resubmit = resubmit
+        self._deliver = deliver
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._heap = []  # (deadline, sequence, future, task, policy)
+        self._sequence = itertools.count()
+        self._keys = {}  # idempotency key -> [attempts running, delivered]
+        self._attempts = {}  # (idempotency key, attempt) -> [future, when a worker started it]
+        self._in_flight = 0
+        self._stopped = False
+        self._watched = metrics.counter('intents.started')
+        self._completed = metrics.counter('intents.completed')
+        self._failed = metrics.counter('intents.failed')
+        self._timeouts = metrics.counter('intents.timeouts')
+        self._retries = metrics.counter('intents.retries')
+        self._duplicates = metrics.counter('intents.duplicates_dropped')
+        self._run_time = metrics.histogram('intents.run_seconds')
+        metrics.gauge('intents.in_flight', lambda: self._in_flight)
+        metrics.gauge('intents.timeout_rate',
+                      lambda: self._timeouts.value() / self._watched.value() if self._watched.value() else 0.0)
+        threading.Thread.__init__(self, name=name, daemon=True)
+
+    def watch(self, future, task, policy):
+        """
+        Supervises a submitted task. Its deadline starts when started is called for it, so that time spent queued
+        for a worker doesn't count against its timeout
+        :param task: The event json the future is running, with its idempotency_key
+        """
+        key = task['idempotency_key']
+        with self._condition:
+            self._keys.setdefault(key, [0, False])[0] += 1
+            self._in_flight += 1
+            attempt = self._attempts.setdefault(self._attempt_key(task), [None, None])
+            attempt[0] = future
+            self._push_deadline(attempt, task, policy)
+        self._watched.inc()
+        future.add_done_callback(lambda done: self._done(done, task))
+
+    def started(self, task, policy):
+        """
+        Called by the worker which runs a task, as it starts it. This may be before or after the task is watched
+        """
+        with self._condition:
+            attempt = self._attempts.setdefault(self._attempt_key(task), [None, None])
+            attempt[1] = self._clock()
+            self._push_deadline(attempt, task, policy)
+
+    @staticmethod
+    def _attempt_key(task):
+        return task['idempotency_key'], task.get('attempt', 0)
+
+    def _push_deadline(self, attempt, task, policy):
+        # Must be called with the condition held. The deadline is pushed once both the future and its start are known
+        future, started = attempt
+        if future is not None and started is not None and not future.done():
+            heapq.heappush(self._heap, (started + policy.timeout, next(self._sequence), future, task, policy))
+            self._condition.notify()
+
+    def _done(self, future, task):
+        key = task['idempotency_key']
+        error = future.exception()
+        with self._condition:
+            started = self._attempts.pop(self._attempt_key(task), [None, None])[1]
+            self._in_flight -= 1
+            entry = self._keys[key]
+            entry[0] -= 1
+            first = error is None and not entry[1]
+            if error is None:
+                entry[1] = True
+            if entry[0] == 0:
+                del self._keys[key]
+        if started is not None:
+            self._run_time.observe(self._clock() - started)
+        if error is not None:
+            self._failed.inc()
+            logger.error("{} failed: {}".format(task.get('intent_value', 'Intent'), error))
+        elif first:
+            self._completed.inc()
+            self._deliver(future.result())
+        else:
+            self._duplicates.inc()
+
+    def in_flight(self):
+        return self._in_flight
+
+    def run(self):
+        while True:
+            with self._condition:
+                expired = self._take_expired()
+                while not expired:
+                    if self._stopped:
+                        return
+                    self._condition.wait(self._next_deadline_in())
+                    expired = self._take_expired()
+            for task, policy in expired:
+                self._timed_out(task, policy)
+
+    def _take_expired(self):
+        # Must be called with the condition held
+        now = self._clock()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, future, task, policy = heapq.heappop(self._heap)
+            if not future.done():
+                expired.append((task, policy))
+        return expired
+
+    def _next_deadline_in(self):
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - self._clock())
+
+    def _timed_out(self, task, policy):
+        intent = task.get('intent_value', 'unknown')
+        self._timeouts.inc()
+        metrics.counter('intents.{}.timeouts'.format(intent)).inc()
+        attempt = task.get('attempt', 0)
+        if policy.retry == RETRY_IDEMPOTENT and attempt < policy.max_retries:
+            with self._condition:
+                delivered = task['idempotency_key'] in self._keys and self._keys[task['idempotency_key']][1]
+            if not delivered:
+                logger.warning("{} timed out after {}s, running it again".format(intent, policy.timeout))
+                self._retries.inc()
+                self._resubmit(dict(task, attempt=attempt + 1))
+                return
+        logger.warning("{} timed out after {}s, leaving it to finish as it must run at most once".format(
+            intent, policy.timeout))
+
+    def join(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        threading.Thread.join(self, timeout)
+
+
+DEFAULT_INTENT_POLICY = IntentPolicy()
+
+
+class BulkheadPool(object):
+    """
+    A BulkheadPool is a bounded thread pool for one class of intents, so that a burst of one class, e.g. slow Google
+    calls, can only fill its own pool and queue, and never delays the others. Once max_queued tasks are waiting,
+    further submissions are refused rather than queued.
+    """
+    UTILIZATION_BUCKETS = (0.25, 0.5, 0.75, 1.0)
+
+    def __init__(self, name, max_workers, max_queued, clock=monotonic):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._clock = clock
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._busy = 0
+        self._wait_time = metrics.histogram('pools.{}.wait_seconds'.format(name))
+        self._utilization = metrics.histogram('pools.{}.utilization'.format(name), buckets=self.UTILIZATION_BUCKETS)
+        self._rejected = metrics.counter('pools.{}.rejected'.format(name))
+        metrics.gauge('pools.{}.queue_depth'.format(name), lambda: self._queued)
+        metrics.gauge('pools.{}.busy'.format(name), lambda: self._busy)
+
+    @classmethod
+    def from_env(cls, name, max_workers, max_queued):
+        """
+        :return: A pool sized by the INTENT_POOL_<NAME>_WORKERS and INTENT_POOL_<NAME>_QUEUE env vars, defaulting to
+        max_workers and max_queued
+        """
+        prefix = "INTENT_POOL_{}_".format(name.upper())
+        return cls(name, int(os.getenv(prefix + "WORKERS") or max_workers),
+                   int(os.getenv(prefix + "QUEUE") or max_queued))
+
+    def submit(self, function, *args, on_start=None):
+        """
+        :param on_start: Called with no arguments by the worker which takes the task, just before it runs it
+        :return: A future of function(*args)
+        :raises PoolFullError: if max_queued tasks are already waiting for a worker
+        """
+        with self._lock:
+            if self._queued >= self.max_queued:
+                self._rejected.inc()
+                raise PoolFullError("The {} pool has {} tasks waiting".format(self.name, self._queued))
+            self._queued += 1
+        return self._executor.submit(self._run, self._clock(), function, args, on_start)
+
+    def _run(self, submitted, function, args, on_start):
+        with self._lock:
+            self._queued -= 1
+            self._busy += 1
+            busy = self._busy
+        self._wait_time.observe(self._clock() - submitted)
+        self._utilization.observe(busy / self.max_workers)
+        try:
+            if on_start is not None:
+                on_start()
+            return function(*args)
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    def queue_depth(self):
+        return self._queued
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def default_pools():
+    """
+    :return: The pools intents run on, by name, each sized by its INTENT_POOL_<NAME>_WORKERS and _QUEUE env vars
+    """
+    return {
+        POOL_LOCAL: BulkheadPool.from_env(POOL_LOCAL, 2, 50),
+        POOL_GOOGLE: BulkheadPool.from_env(POOL_GOOGLE, 8, 50),
+        POOL_DEFAULT: BulkheadPool.from_env(POOL_DEFAULT, 4, 50)
+    }
 
 
 class WorkerPoolThread(threading.Thread):
     """
-    A worker pool thread contains a threadpool, where the thread submits requests it pulls off the event q. Then,
-    the submissions are verified using the validation thread
+    A worker pool thread runs the requests it pulls off the event q on the bulkhead pool named by each intent's
+    policy. Then, the submissions are supervised by a FutureSupervisor
     """
-    def __init__(self, event_q, state_q, name='WorkerPoolThread'):
+    def __init__(self, event_q, state_q, pools=None, name='WorkerPoolThread'):
+        """
+        :param pools: BulkheadPools by name, defaults to default_pools(). Must include POOL_DEFAULT
+        """
         self.event_q = event_q
         self.state_q = state_q
         self._stopevent = threading.Event()
-        self.validation_q = Queue()
-        self.validation_thread = ValidationThread(self.validation_q, self.event_q)
-        self.validation_thread.start()
+        self.pools = pools or default_pools()
+        self.supervisor = FutureSupervisor(self.submit, self.deliver)
+        self.supervisor.start()
         threading.Thread.__init__(self, name=name)
 
-    def callback(self, future):
-        state = future.result()
+    def deliver(self, state):
         self.state_q.put({'type': 'state_update', 'state': state})
 
+    def submit(self, event_json):
+        """
+        Runs an event json's intent on its pool, supervised according to its policy. If the pool is full, the user is
+        told to try again, unless the event json is a retry, whose first attempt is still running
+        :return: The future, or None if the pool was full
+        """
+        event_json.setdefault('idempotency_key', uuid.uuid4().hex)
+        policy = event_json.get('policy') or DEFAULT_INTENT_POLICY
+        pool = self.pools.get(policy.pool) or self.pools[POOL_DEFAULT]
+        try:
+            future = pool.submit(event_json['intent'],
+                                 event_json['msg_writer'],
+                                 event_json['event'],
+                                 event_json['wit_entities'],
+                                 event_json['credentials'],
+                                 on_start=lambda: self.supervisor.started(event_json, policy))
+        except PoolFullError as e:
+            logger.warning("Refused {}: {}".format(event_json.get('intent_value', 'an intent'), e))
+            if event_json.get('attempt'):
+                return None
+            event_json['msg_writer'].send_message(event_json['event']['channel'],
+                                                  "I'm too busy to do that right now, please try again in a minute")
+            return None
+        self.supervisor.watch(future, event_json, policy)
+        return future
+
     def run(self):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            while True:
-                if not self._stopevent.is_set():
-                    try:  # This try except is used in order to use the timeout on a queue get as a heartbeat timer
-                        event_json = self.event_q.get(timeout=5)
-                        logger.info("Got an Event")
-                        future = executor.submit(event_json['intent'],
-                                                 event_json['msg_writer'],
-                                                 event_json['event'],
-                                                 event_json['wit_entities'],
-                                                 event_json['credentials'])
-                        future.add_done_callback(self.callback)
-                        self.validation_q.put({'future': future, 'calling_event': event_json})
-                    except Empty:
-                        pass
-                    logger.info("WorkerPool Thread Heartbeat")
+        while not self._stopevent.is_set():
+            try:  # This try except is used in order to use the timeout on a queue get as a heartbeat timer
+                event_json = self.event_q.get(timeout=5)
+                logger.info("Got an Event")
+                self.submit(event_json)
+            except Empty:
+                pass
+            logger.info("WorkerPool Thread Heartbeat")
 
     def join(self, timeout=None):
-        self.validation_q.join()
-        self.validation_thread.join()
         self._stopevent.set()
         threading.Thread.join(self, timeout=timeout)
-
-
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+        self.supervisor.join()
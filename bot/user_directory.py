@@ -0,0 +1,125 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The only profile fields the bot reads. Everything else in a users.list payload is dropped
+PROFILE_FIELDS = ('real_name', 'first_name', 'last_name', 'email')
+USER_FIELDS = ('id', 'name', 'real_name', 'deleted', 'is_bot')
+
+
+def normalize_name(name):
+    """
+    :return: name case folded, with whitespace collapsed, for forgiving name lookups
+    """
+    return ' '.join(name.split()).casefold()
+
+
+def slim_user(user):
+    """
+    :param user: A user object as returned by the Slack API
+    :return: A copy holding only the fields the bot uses, in the same shape
+    """
+    slim = {field: user[field] for field in USER_FIELDS if field in user}
+    profile = user.get('profile') or {}
+    slim['profile'] = {field: profile[field] for field in PROFILE_FIELDS if field in profile}
+    return slim
+
+
+def _real_name(user):
+    return user['profile'].get('real_name') or user.get('real_name')
+
+
+class UserDirectory(object):
+    """
+    A UserDirectory holds the workspace's users, indexed by id, by exact real name, and by normalized name, so that
+    every lookup is a dict access. It is kept current by upserting users from team_join and user_change events.
+    """
+    def __init__(self, users=()):
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_real_name = {}  # exact real name -> id
+        self._by_normalized_name = {}  # normalized real name or user name -> set of ids
+        self._complete = threading.Event()
+        for user in users:
+            self.upsert(user)
+
+    def mark_complete(self):
+        """
+        Called once every user in the workspace has been loaded
+        """
+        self._complete.set()
+
+    def is_complete(self):
+        return self._complete.is_set()
+
+    def wait_until_complete(self, timeout=None):
+        return self._complete.wait(timeout)
+
+    def upsert(self, user):
+        """
+        Adds a user, or replaces what we know about them, e.g. after they change their name
+        :return: The stored, slimmed down user
+        """
+        user = slim_user(user)
+        with self._lock:
+            self._unindex(user['id'])
+            self._by_id[user['id']] = user
+            real_name = _real_name(user)
+            if real_name:
+                self._by_real_name[real_name] = user['id']
+            for name in self._names(user):
+                self._by_normalized_name.setdefault(name, set()).add(user['id'])
+        return user
+
+    def remove(self, user_id):
+        with self._lock:
+            self._unindex(user_id)
+
+    def get(self, user_id):
+        return self._by_id.get(user_id)
+
+    def id_from_real_name(self, real_name):
+        return self._by_real_name.get(real_name)
+
+    def find_by_name(self, name):
+        """
+        :param name: A real name, or a user name, as typed
+        :return: The user with exactly that real name, or else the only user whose name matches once normalized, or
+        None if there is no such user or the name is ambiguous
+        """
+        with self._lock:
+            user_id = self._by_real_name.get(name)
+            if user_id is None:
+                candidates = self._by_normalized_name.get(normalize_name(name), ())
+                if len(candidates) != 1:
+                    return None
+                user_id = next(iter(candidates))
+            return self._by_id.get(user_id)
+
+    def _unindex(self, user_id):
+        # Must be called with the lock held
+        old = self._by_id.pop(user_id, None)
+        if old is None:
+            return
+        real_name = _real_name(old)
+        if real_name and self._by_real_name.get(real_name) == user_id:
+            del self._by_real_name[real_name]
+        for name in self._names(old):
+            ids = self._by_normalized_name.get(name)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self._by_normalized_name[name]
+
+    @staticmethod
+    def _names(user):
+        names = {user.get('name'), _real_name(user)}
+        return {normalize_name(name) for name in names if name}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_id.values()))
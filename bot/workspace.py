@@ -0,0 +1,96 @@
+import logging
+import threading
+from user_directory import UserDirectory
+
+logger = logging.getLogger(__name__)
+
+# The only channel fields the bot reads. Member lists and the like are dropped
+CHANNEL_FIELDS = ('id', 'name', 'is_channel', 'is_group', 'is_im', 'is_archived', 'created', 'creator')
+
+
+def slim_channel(channel):
+    return {field: channel[field] for field in CHANNEL_FIELDS if field in channel}
+
+
+class WorkspaceMetadata(object):
+    """
+    WorkspaceMetadata holds what the bot knows about its workspace: channels and private groups by id, the bot's DM
+    channel with each user, and the user directory. It is seeded from the rtm.start login snapshot and kept current
+    from RTM events, so that handling a message needs no Web API calls once the bot has settled in.
+    """
+    def __init__(self, users=None):
+        self.users = users if users is not None else UserDirectory()
+        self._lock = threading.Lock()
+        self._channels = {}  # channel id -> slim channel
+        self._dms = {}  # user id -> DM channel id
+
+    def seed(self, login_data):
+        """
+        :param login_data: The rtm.start response, as kept by slackclient in server.login_data
+        """
+        for channel in login_data.get('channels', []) + login_data.get('groups', []):
+            self.add_channel(channel)
+        for im in login_data.get('ims', []):
+            self.add_dm(im['user'], im['id'])
+        users = login_data.get('users')
+        for user in users or []:
+            self.users.upsert(user)
+        if users:
+            # rtm.start sends the whole team when it is small enough, in which case there is nothing left to warm up
+            self.users.mark_complete()
+        logger.info("Workspace seeded with {} channels, {} DMs and {} users".format(
+            len(self._channels), len(self._dms), len(self.users)))
+
+    def apply_event(self, event):
+        """
+        :param event: An RTM event
+        Updates the metadata if the event changes it, see https://api.slack.com/rtm
+        :return: True if the event was a metadata event
+        """
+        event_type = event.get('type')
+        if event_type in ('channel_created', 'channel_joined', 'group_joined'):
+            self.add_channel(event['channel'])
+        elif event_type in ('channel_rename', 'group_rename'):
+            self.rename_channel(event['channel']['id'], event['channel']['name'])
+        elif event_type in ('channel_deleted', 'group_archive'):
+            self.remove_channel(event['channel'])
+        elif event_type == 'im_created':
+            self.add_dm(event['user'], event['channel']['id'])
+        elif event_type in ('team_join', 'user_change'):
+            self.users.upsert(event['user'])
+        else:
+            return False
+        return True
+
+    def add_channel(self, channel):
+        """
+        :param channel: A channel object, as sent in rtm.start and channel events
+        :return: The channel as kept, or None if it has no id, in which case it is skipped
+        """
+        if not isinstance(channel, dict) or 'id' not in channel:
+            logger.warning("Skipping channel without an id: {}".format(channel))
+            return None
+        channel = slim_channel(channel)
+        with self._lock:
+            self._channels[channel['id']] = channel
+        return channel
+
+    def rename_channel(self, channel_id, name):
+        with self._lock:
+            channel = dict(self._channels.get(channel_id, {'id': channel_id}))
+            channel['name'] = name
+            self._channels[channel_id] = channel
+
+    def remove_channel(self, channel_id):
+        with self._lock:
+            self._channels.pop(channel_id, None)
+
+    def channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def add_dm(self, user_id, channel_id):
+        with self._lock:
+            self._dms[user_id] = channel_id
+
+    def dm_for_user(self, user_id):
+        return self._dms.get(user_id)